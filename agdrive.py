@@ -0,0 +1,246 @@
+"""Asyncio variant of the gdrive functions, talking to the google drive REST api directly over aiohttp.
+
+All calls of one client share a connection pool, so many uploads and downloads can be overlapped with asyncio.gather.
+The base url can be pointed at a local stand-in for the drive REST api for testing."""
+
+import asyncio
+import json
+import logging
+import os.path
+import uuid
+
+import aiohttp
+
+import gdrive
+
+DRIVE_URL = 'https://www.googleapis.com'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+class AsyncDriveError(Exception):
+    """Raised when the drive api answers with an error status"""
+
+    def __init__(self, status: int, content: str, retry_after: str = None):
+        """
+        :param status: http status of the response
+        :param content: body of the response
+        :param retry_after: value of the Retry-After header of the response, if any"""
+        super().__init__('Drive api returned {}: {}'.format(status, content))
+        self.status = status
+        self.content = content
+        self.retry_after = retry_after
+
+
+class AsyncDriveClient:
+    """Asynchronous google drive client. Use as async context manager, or call close() when done.
+
+    Credentials and the name to id cache are taken from a gdrive.DriveSession, so they are shared with the
+    synchronous functions."""
+
+    def __init__(self, session: gdrive.DriveSession = None, base_url: str = DRIVE_URL, max_connections: int = 20,
+                 token: str = None):
+        """
+        :param session: Drive session to take credentials and id cache from. If None, the default session is used
+        :param base_url: url of the drive REST api. Can point to a local stand-in
+        :param max_connections: maximum number of open connections in the pool
+        :param token: Optional fixed bearer token. If None, the token of the session credentials is used"""
+        self.session = session if session is not None else gdrive.get_session()
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self._token = token
+        self._http = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Close all pooled connections"""
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def _client(self) -> aiohttp.ClientSession:
+        """Return the pooled http client, creating it on first use. Must be called within the event loop"""
+        if self._http is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._http = aiohttp.ClientSession(connector=connector)
+        return self._http
+
+    async def _headers(self) -> dict:
+        """Authorization headers. Loading or refreshing credentials blocks, so it runs in the default executor"""
+        token = self._token
+        if token is None:
+            creds = await asyncio.get_running_loop().run_in_executor(None, self.session.credentials)
+            token = creds.token
+        return {'Authorization': 'Bearer {}'.format(token)}
+
+    async def _request(self, method: str, path: str, params: dict = None, data=None, headers: dict = None,
+                       expect: str = 'json'):
+        """Send a request to the api, retried with the retry policy and rate limiter of the session
+
+        :param expect: 'json' to return the decoded json body, 'bytes' for the raw body, None to ignore the body
+        :raise AsyncDriveError if the api answers with an error status"""
+        async def send():
+            return await self._send(method, path, params, data, headers, expect)
+        return await self.session.retry_policy.call_async(send, self.session.rate_limiter)
+
+    async def _send(self, method: str, path: str, params: dict, data, headers: dict, expect: str):
+        """Send a request to the api once, see _request"""
+        request_headers = await self._headers()
+        if headers is not None:
+            request_headers.update(headers)
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        async with self._client().request(method, self.base_url + path, params=params, data=data,
+                                          headers=request_headers) as response:
+            if response.status >= 400:
+                raise AsyncDriveError(response.status, await response.text(), response.headers.get('Retry-After'))
+            if expect == 'json':
+                return await response.json(content_type=None)
+            elif expect == 'bytes':
+                return await response.read()
+
+    async def _get_ids_from_name(self, file_name: str, is_folder: bool = False, parent_id: str = None) -> list:
+        """Get all ids of files with file_name, see gdrive._get_ids_from_name"""
+        cache = self.session.id_cache
+        file_ids = cache.get(file_name, is_folder, parent_id)
+        if file_ids is not None:
+            return file_ids
+
+        query = "mimeType {} '{}' and name = '{}' and trashed = false".format(
+            '=' if is_folder else '!=', FOLDER_MIME_TYPE, file_name)
+        if parent_id is not None:
+            query += " and '{}' in parents".format(parent_id)
+        response = await self._request('GET', '/drive/v3/files', {'q': query, 'spaces': 'drive',
+                                                                   'fields': 'files(id)'})
+        file_ids = [file['id'] for file in response.get('files', [])]
+        cache.put(file_name, is_folder, parent_id, file_ids)
+        return file_ids
+
+    async def _get_folder_id(self, parent_folder: str):
+        """:return: id of the folder named parent_folder, None if parent_folder is None
+        :raise FileNotFoundError if no such folder exists"""
+        if parent_folder is None:
+            return None
+        parent_ids = await self._get_ids_from_name(parent_folder, is_folder=True)
+        if not parent_ids:
+            raise FileNotFoundError('No parent folder with name "{}" exists'.format(parent_folder))
+        return parent_ids[0]
+
+    async def list_files(self, parent_folder: str = None, fields: str = '(id, name)', file_type: str = 'file'):
+        """List files in google drive, see gdrive.list_files
+
+        :return: list of file metadata dicts, None on error"""
+        if file_type == 'file':
+            query = "mimeType != '{}' and trashed = false".format(FOLDER_MIME_TYPE)
+        else:
+            query = "mimeType = '{}' and trashed = false".format(FOLDER_MIME_TYPE)
+
+        files = []
+        try:
+            if parent_folder is not None:
+                parent_ids = await self._get_ids_from_name(parent_folder, is_folder=True)
+                if parent_ids:
+                    query += " and '{}' in parents".format(parent_ids[0])
+
+            page_token = None
+            while True:
+                response = await self._request('GET', '/drive/v3/files', {
+                    'q': query, 'spaces': 'drive', 'fields': 'nextPageToken, files{}'.format(fields),
+                    'pageSize': gdrive.LIST_PAGE_SIZE, 'pageToken': page_token})
+                files.extend(response.get('files', []))
+                page_token = response.get('nextPageToken')
+                if page_token is None:
+                    return files
+        except (AsyncDriveError, aiohttp.ClientError) as err:
+            logging.error(err)
+            return None
+
+    async def download_file(self, file_id: str, target_path: str, file_name: str):
+        """Download the file with file_id to target_path/file_name"""
+        data = await self._request('GET', '/drive/v3/files/{}'.format(file_id), {'alt': 'media'}, expect='bytes')
+        with open(os.path.join(target_path, file_name), 'wb') as f:
+            f.write(data)
+
+    async def download_files(self, files: list, target_path: str = './',
+                             max_concurrency: int = gdrive.DOWNLOAD_WORKERS) -> dict:
+        """Download many files concurrently, see gdrive.download_files
+
+        :param files: list of dicts with 'id' and 'name' of each file
+        :param target_path: Path on PC to download to
+        :param max_concurrency: maximum number of downloads in progress at the same time
+        :return: dict of file name to the exception that made its download fail"""
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def download(file):
+            async with semaphore:
+                await self.download_file(file['id'], target_path, file['name'])
+
+        results = await asyncio.gather(*(download(file) for file in files), return_exceptions=True)
+        failures = {}
+        for file, result in zip(files, results):
+            if isinstance(result, Exception):
+                logging.error('Could not download "{}": {}'.format(file['name'], result))
+                failures[file['name']] = result
+        return failures
+
+    async def save_file(self, file_name: str, parent_folder: str = None, data: bytes = b''):
+        """Save data to google drive as file_name in parent_folder. The file is updated if it exists
+
+        :return: metadata of the saved file with the fields in gdrive.FILE_FIELDS, None on error"""
+        try:
+            parent_id = await self._get_folder_id(parent_folder)
+            file_ids = await self._get_ids_from_name(file_name, parent_id=parent_id)
+        except (FileNotFoundError, AsyncDriveError, aiohttp.ClientError) as err:
+            logging.error(err)
+            return None
+        if len(file_ids) > 1:
+            logging.error('There is more than one file named "{}" in this folder'.format(file_name))
+            return None
+
+        metadata = {'name': file_name}
+        if file_ids:
+            method, path = 'PATCH', '/upload/drive/v3/files/{}'.format(file_ids[0])
+        else:
+            method, path = 'POST', '/upload/drive/v3/files'
+            if parent_id is not None:
+                metadata['parents'] = [parent_id]
+
+        body, content_type = _multipart_body(metadata, data)
+        try:
+            file = await self._request(method, path, {'uploadType': 'multipart', 'fields': gdrive.FILE_FIELDS},
+                                       data=body, headers={'Content-Type': content_type})
+        except (AsyncDriveError, aiohttp.ClientError) as err:
+            logging.error(err)
+            self.session.id_cache.invalidate(file_name, False, parent_id)
+            return None
+        self.session.id_cache.put(file_name, False, parent_id, [file['id']])
+        return file
+
+    async def delete_file(self, file_name: str, parent_folder: str = None, is_folder: bool = False):
+        """Delete all files with file_name in parent_folder, see gdrive.delete_file"""
+        parent_id = None
+        if parent_folder is not None:
+            parent_ids = await self._get_ids_from_name(parent_folder, is_folder=True)
+            parent_id = parent_ids[0] if parent_ids else None
+        file_ids = await self._get_ids_from_name(file_name, is_folder, parent_id)
+        self.session.id_cache.invalidate(file_name, is_folder, parent_id)
+        await asyncio.gather(*(self._request('DELETE', '/drive/v3/files/{}'.format(file_id), expect=None)
+                               for file_id in file_ids))
+
+
+def _multipart_body(metadata: dict, data: bytes):
+    """Build a multipart/related body of json metadata and media, as expected by uploadType=multipart
+
+    :return: body bytes and content type header"""
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        '--{}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'.format(boundary).encode(),
+        json.dumps(metadata).encode(),
+        '\r\n--{}\r\nContent-Type: application/octet-stream\r\n\r\n'.format(boundary).encode(),
+        data,
+        '\r\n--{}--'.format(boundary).encode(),
+    ])
+    return body, 'multipart/related; boundary={}'.format(boundary)
@@ -0,0 +1,118 @@
+#! python3
+"""Batch mode: apply a stream of note operations without any prompts, e.g. to import many notes from a script.
+
+Every input line is one operation as a json object, on a page named like in the page menu, without .txt:
+
+    {"op": "add", "page": "todo", "note": "Buy milk"}
+    {"op": "insert", "page": "todo", "index": 0, "note": "Call Bob"}
+    {"op": "change", "page": "todo", "index": 1, "note": "Buy oat milk"}
+    {"op": "delete", "page": "todo", "index": 0}
+
+Pages that do not exist yet are created. Password protected pages can not be edited in batch mode. Every touched
+page is decrypted once, edited in memory, then encrypted and uploaded once at the end. One json result is printed
+per operation, like {"line": 1, "ok": true} or {"line": 2, "ok": false, "error": "..."}.
+The operations are sent to the daemon if it runs, see daemon.py.
+Usage: python batch.py [operations file], reading from stdin without a file"""
+
+import argparse
+import json
+import sys
+
+import functions
+import note
+import passwords
+import upload_queue
+
+OPERATIONS = ('add', 'insert', 'change', 'delete')
+
+
+def _apply(page, operation: dict):
+    """Apply one operation to an open page, with the same checks as the interactive note functions
+
+    :raise ValueError if the operation is invalid"""
+    op = operation['op']
+    if op != 'delete' and not isinstance(operation.get('note'), str):
+        raise ValueError('"{}" needs a note'.format(op))
+    if op == 'add':
+        page.add(operation['note'])
+        return
+    index = operation.get('index')
+    if isinstance(index, bool) or not isinstance(index, int) or index not in range(len(page)):   # json true is 1
+        raise ValueError('invalid note number {}'.format(index))
+    if op == 'insert':
+        page.insert(index, operation['note'])
+    elif op == 'change':
+        page.change(index, operation['note'])
+    else:
+        page.delete(index)
+
+
+def run(lines, file_path: str, files: list, manifest, folder_sync=None) -> list:
+    """Apply the operations in lines, then save and upload every touched page once
+
+    :param lines: iterable of json operations, see the module documentation
+    :param file_path: local folder of the note pages
+    :param files: names of all note pages. Created pages are added
+    :param manifest: sync manifest of the note pages
+    :param folder_sync: Optional background sync of the note pages, to wait for the touched pages to download
+    :return: list with a result dict for every operation"""
+    pages = {}      # file name -> open page
+    results = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        result = {'line': number, 'ok': True}
+        try:
+            operation = json.loads(line)
+            if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+                raise ValueError('operation must be one of {}'.format(', '.join(OPERATIONS)))
+            if not isinstance(operation.get('page'), str) or not operation['page']:
+                raise ValueError('operation needs a page')
+            file_name = operation['page'] + '.txt'
+            if file_name not in pages:
+                if not passwords.get_store().is_unlocked(file_name):
+                    raise ValueError('page "{}" is password protected'.format(operation['page']))
+                pages[file_name] = note.open_page(file_name, file_path, folder_sync)
+            _apply(pages[file_name], operation)
+        except ValueError as err:   # Includes invalid json
+            result.update(ok=False, error=str(err))
+        results.append(result)
+
+    for file_name, page in pages.items():
+        if page.dirty and file_name not in files:
+            files.append(file_name)
+        note.close_page(page, manifest, 'batch')    # One encrypt and one coalesced upload per page
+    upload_queue.get_queue().flush()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('operations', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+                        help='file with one json operation per line. Default stdin')
+    args = parser.parse_args()
+    import daemon
+    lines = list(args.operations)
+    try:
+        response = daemon.request({'op': 'batch', 'lines': lines}, timeout=daemon.BATCH_TIMEOUT)
+    except daemon.NoAnswer as err:  # Running the batch again in-process could apply operations twice
+        print('{}, check the pages before running the operations again'.format(err), file=sys.stderr)
+        sys.exit(1)
+    if response is None:    # No daemon
+        folder_sync, manifest, files = note.open_notebook('Storage')
+        functions._preload_password_file()
+        results = run(lines, 'Storage', files, manifest, folder_sync)
+    elif not response['ok']:
+        print(response['error'], file=sys.stderr)
+        sys.exit(1)
+    else:
+        results = response['results']
+    for result in results:
+        print(json.dumps(result))
+    failed = sum(not result['ok'] for result in results)
+    print('{} operations, {} failed'.format(len(results), failed), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#! python3
+"""Offline latency benchmarks of the sync paths, run against the in-memory fake google drive.
+
+Every scenario runs in a fresh temporary directory, with its own key.key and Storage folder.
+Usage: python benchmark.py [--pages 10 1000 10000] [--latency 20] [--lines 50] [--rate 0]
+       python benchmark.py --codecs [--lines 10 100 1000 10000]
+       python benchmark.py --ciphers [--lines 10 100 1000 5000]
+       python benchmark.py --imports"""
+
+import argparse
+import contextlib
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import encryption
+import fakedrive
+import functions
+import gdrive
+import note
+import page
+import retry
+import sync
+import usage
+
+RESULT_FORMAT = '{:>7} pages  {:<22} {:>10.4f} s  {:>7} requests'
+CODEC_FORMAT = '{:>7} lines  {:<8} {:>10} bytes  {:>6.1%} of legacy  {:>9.3f} ms encrypt  {:>9.3f} ms decrypt'
+CIPHER_FORMAT = '{:>7} lines  {:<17} {:>10} bytes  {:>+6} bytes overhead  {:>8.1f} MB/s encrypt  {:>8.1f} MB/s decrypt'
+IMPORT_FORMAT = '{:<12} {:>9.1f} ms import  {:>9.1f} ms process start with import'
+IMPORTED_MODULES = ['note', 'batch', 'gdrive', 'encryption']
+UNLIMITED = 1e9
+
+rate_limit = UNLIMITED  # Requests per second the client side rate limiter allows
+
+
+def _session(drive: fakedrive.FakeDrive) -> gdrive.DriveSession:
+    """:return: drive session on the fake drive, with the configured client side rate limit"""
+    return drive.session(rate_limiter=retry.TokenBucket(rate=rate_limit, capacity=max(rate_limit, 1)))
+
+
+@contextlib.contextmanager
+def _workspace():
+    """Run the enclosed code in a fresh temporary directory with a fresh encryption key"""
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='notes-benchmark-')
+    os.chdir(directory)
+    encryption.convert.key = None
+    try:
+        yield directory
+    finally:
+        os.chdir(cwd)
+        encryption.convert.key = None
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _populate(drive: fakedrive.FakeDrive, pages: int, lines: int):
+    """Fill the fake drive with a Notes folder of encrypted pages and a Password folder with a password file"""
+    with open('plain.tmp', 'w') as f:
+        f.writelines('Note number {} of a benchmark page\n'.format(i) for i in range(lines))
+    page = encryption.convert('plain.tmp', 'encrypt', './', 'return')
+    os.remove('plain.tmp')
+
+    notes_id = drive.add_folder('Notes')
+    for i in range(pages):
+        drive.add_file('page{}.txt'.format(i), page, notes_id)
+    drive.add_file('password.txt', b'', drive.add_folder('Password'))
+
+
+def _time(drive: fakedrive.FakeDrive, function, repeat: int = 1):
+    """:return: mean seconds and mean number of drive requests per call of function"""
+    requests = drive.request_count
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat, (drive.request_count - requests) // repeat
+
+
+def _startup(stats: usage.UsageStats = None):
+    """Everything note.main does at startup, until the whole notebook is synced"""
+    functions._preload_password_file.pre_loaded = False
+    folder_sync, _ = note.startup('Storage', stats)
+    files = folder_sync.join()
+    functions._preload_password_file()  # Waits for the concurrent download
+    return files
+
+
+def _first_page(stats: usage.UsageStats):
+    """Everything note.main does at startup, until the most used page can be opened"""
+    functions._preload_password_file.pre_loaded = False
+    folder_sync, _ = note.startup('Storage', stats)
+    folder_sync.wait_for(stats.most_used())
+    functions._preload_password_file()
+    return folder_sync
+
+
+def bench_startup(pages: int, lines: int, latency: float):
+    """Cold start with an empty Storage folder, then a warm start with everything already synced"""
+    with _workspace():
+        drive = fakedrive.FakeDrive(latency=latency)
+        _populate(drive, pages, lines)
+        gdrive.set_session(_session(drive))
+        yield 'startup (cold)', _time(drive, _startup)
+        gdrive.set_session(_session(drive))     # New process, but the manifest on disk is kept
+        yield 'startup (warm)', _time(drive, _startup)
+
+
+def bench_first_page(pages: int, lines: int, latency: float):
+    """Cold start until the most used page, the last one in the listing, is ready to be opened"""
+    with _workspace():
+        drive = fakedrive.FakeDrive(latency=latency)
+        _populate(drive, pages, lines)
+        gdrive.set_session(_session(drive))
+        stats = usage.UsageStats('usage.json')
+        stats.record('page{}.txt'.format(pages - 1))
+        folder_sync = []
+        yield 'first page (cold)', _time(drive, lambda: folder_sync.append(_first_page(stats)))
+        folder_sync[0].join()   # Let the background downloads finish before the workspace is removed
+
+
+def bench_save(pages: int, lines: int, latency: float, repeat: int = 10):
+    """Saving the open page after an edit, like list_notes does after every action, and uploading it after
+    compacting its edits, like list_notes does when the page is left"""
+    with _workspace():
+        drive = fakedrive.FakeDrive(latency=latency)
+        _populate(drive, pages, lines)
+        gdrive.set_session(_session(drive))
+        manifest = sync.Manifest(os.path.join('Storage', '.manifest.json'))
+        sync.sync_folder('Notes', 'Storage', manifest)
+        session = page.PageSession('page0.txt', 'Storage')
+
+        def save():
+            functions.add_note(session, 'A new note')
+            session.save()
+
+        def upload():
+            save()
+            sync.save_file('page0.txt', 'Notes', 'Storage', session.compact(), manifest)
+
+        upload()  # The first upload resolves and caches the ids
+        yield 'save after edit', _time(drive, save, repeat)
+        yield 'compact and upload', _time(drive, upload, repeat)
+
+
+def bench_page_switch(pages: int, lines: int, latency: float, repeat: int = 10):
+    """Opening the next page, like list_notes does on page selection"""
+    with _workspace():
+        drive = fakedrive.FakeDrive(latency=latency)
+        _populate(drive, min(pages, 2), lines)
+        gdrive.set_session(_session(drive))
+        sync.sync_folder('Notes', 'Storage', sync.Manifest(os.path.join('Storage', '.manifest.json')))
+        current = ['page0.txt', 'page1.txt']
+
+        def switch():
+            page.PageSession(current[1], 'Storage')
+            current.reverse()
+
+        yield 'page switch', _time(drive, switch, repeat)
+
+
+def bench_bulk_download(pages: int, lines: int, latency: float):
+    """Downloading every page of the Notes folder"""
+    with _workspace():
+        drive = fakedrive.FakeDrive(latency=latency)
+        _populate(drive, pages, lines)
+        gdrive.set_session(_session(drive))
+        os.mkdir('Download')
+        yield 'bulk download', _time(drive, lambda: gdrive.download_file(None, 'Notes', 'Download'))
+
+
+def bench_codecs(lines: int, repeat: int = 20):
+    """Bytes transferred and CPU time to encrypt and decrypt a page with every compression codec, compared with the
+    legacy format of a bare Fernet token"""
+    with _workspace():
+        page = ''.join('Note number {} of a benchmark page\n'.format(i) for i in range(lines)).encode()
+        legacy_size = len(encryption._fernet().encrypt(page))
+        for codec in encryption.CODECS:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                data = encryption.encrypt(page, codec)
+            encrypt_time = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for _ in range(repeat):
+                encryption.decrypt(data)
+            decrypt_time = (time.perf_counter() - start) / repeat
+            yield codec, len(data), len(data) / legacy_size, encrypt_time * 1000, decrypt_time * 1000
+
+
+def bench_ciphers(lines: int, repeat: int = 50):
+    """Ciphertext size and encrypt and decrypt throughput of every cipher backend, and of the legacy format of a bare
+    Fernet token. Pages are not compressed, so only the cipher is measured"""
+    with _workspace():
+        page = ''.join('Note number {} of a benchmark page\n'.format(i) for i in range(lines)).encode()
+        backends = [('legacy', encryption._fernet().encrypt, encryption._fernet().decrypt)]
+        backends += [(cipher, lambda data, cipher=cipher: encryption.encrypt(data, 'none', cipher=cipher),
+                      encryption.decrypt) for cipher in encryption.CIPHERS]
+        for name, encrypt, decrypt in backends:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                data = encrypt(page)
+            encrypt_time = (time.perf_counter() - start) / repeat
+            start = time.perf_counter()
+            for _ in range(repeat):
+                decrypt(data)
+            decrypt_time = (time.perf_counter() - start) / repeat
+            yield name, len(data), len(data) - len(page), len(page) / encrypt_time / 1e6, \
+                len(page) / decrypt_time / 1e6
+
+
+def bench_quick_add(pages: int, lines: int, latency: float):
+    """note.py -p: adding a note to one page, which only syncs that page, compared with the full startup"""
+    with _workspace():
+        drive = fakedrive.FakeDrive(latency=latency)
+        _populate(drive, pages, lines)
+        gdrive.set_session(_session(drive))
+        functions._preload_password_file.pre_loaded = False
+        yield 'quick add (cold)', _time(drive, lambda: note.quick_add('page0.txt', 'A new note', 'Storage'))
+        gdrive.set_session(_session(drive))
+        functions._preload_password_file.pre_loaded = False
+        yield 'quick add (warm)', _time(drive, lambda: note.quick_add('page0.txt', 'A new note', 'Storage'))
+
+
+def bench_imports(repeat: int = 5):
+    """Cold import time of the entry modules, each in a fresh interpreter, as reported by python -X importtime, and
+    the time to start an interpreter and import the module, less the time to start an empty one"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def process_time(code: str) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=directory, check=True)
+            times.append(time.perf_counter() - start)
+        return statistics.median(times)
+
+    empty = process_time('pass')
+    for module in IMPORTED_MODULES:
+        report = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=directory,
+                                check=True, stderr=subprocess.PIPE, universal_newlines=True).stderr
+        cumulative = int(report.strip().splitlines()[-1].split('|')[1])     # Last line is the module itself
+        yield module, cumulative / 1000, (process_time('import ' + module) - empty) * 1000
+
+
+BENCHMARKS = [bench_startup, bench_first_page, bench_quick_add, bench_save, bench_page_switch, bench_bulk_download]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, nargs='+', default=[10, 1000, 10000], help='notebook sizes to run')
+    parser.add_argument('--latency', type=float, default=20, help='latency of every drive request in milliseconds')
+    parser.add_argument('--lines', type=int, nargs='+', default=None,
+                        help='number of notes on every page. Default 50, 10 100 1000 10000 with --codecs, or '
+                             '10 100 1000 5000 with --ciphers')
+    parser.add_argument('--rate', type=float, default=0, help='client side rate limit in requests per second. '
+                                                              '0 means unlimited')
+    parser.add_argument('--codecs', action='store_true', help='compare the compression codecs instead')
+    parser.add_argument('--ciphers', action='store_true', help='compare the cipher backends instead')
+    parser.add_argument('--imports', action='store_true', help='time the cold import of the entry modules instead')
+    args = parser.parse_args()
+
+    if args.imports:
+        for result in bench_imports():
+            print(IMPORT_FORMAT.format(*result), flush=True)
+        return
+
+    if args.ciphers:
+        for lines in args.lines or [10, 100, 1000, 5000]:
+            for result in bench_ciphers(lines):
+                print(CIPHER_FORMAT.format(lines, *result), flush=True)
+        return
+
+    if args.codecs:
+        for lines in args.lines or [10, 100, 1000, 10000]:
+            for result in bench_codecs(lines):
+                print(CODEC_FORMAT.format(lines, *result), flush=True)
+        return
+
+    global rate_limit
+    rate_limit = args.rate or UNLIMITED
+
+    for pages in args.pages:
+        for benchmark in BENCHMARKS:
+            for name, (seconds, requests) in benchmark(pages, (args.lines or [50])[0], args.latency / 1000):
+                print(RESULT_FORMAT.format(pages, name, seconds, requests), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+#! python3
+"""Packed notebook layout: all note pages and the password file in one container file on google drive.
+
+A container starts with an encrypted table of contents holding the offset and length of every entry. The entries
+are the encrypted files, exactly as they are stored locally, so any single file can be read with random access.
+A cold start of a packed notebook takes one listing call plus one download, instead of one download per page.
+
+Migrate an existing notebook with: python container.py pack, and back with: python container.py unpack"""
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os.path
+import struct
+import threading
+
+import encryption
+import gdrive
+import page as page_module
+import segments
+import sync
+
+MAGIC = b'NOTES-PACK-1\n'
+HEADER = struct.Struct('>Q')    # Length of the encrypted table of contents
+CONTAINER_NAME = 'notebook.pack'
+CONTAINER_FOLDER = 'Notebook'
+PAGE_FOLDER = 'Notes'
+PASSWORD_FOLDER = 'Password'
+
+
+def entry_name(parent_folder: str, file_name: str) -> str:
+    """:return: name of the container entry of file_name in the remote folder parent_folder"""
+    return '{}/{}'.format(parent_folder, file_name)
+
+
+def _replace(location: str, data: bytes):
+    """Write data to location through a temporary file, so readers never see a partly written file"""
+    temp_location = location + '.tmp'
+    with open(temp_location, 'wb') as f:
+        f.write(data)
+    os.replace(temp_location, location)
+
+
+class Container:
+    """Random read access to a packed notebook. Only the table of contents is read up front"""
+
+    def __init__(self, stream):
+        """
+        :param stream: readable, seekable binary stream of the container
+        :raise ValueError if stream is not a container"""
+        self._stream = stream
+        if stream.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a packed notebook')
+        toc_length, = HEADER.unpack(stream.read(HEADER.size))
+        self._entries = json.loads(encryption.decrypt(stream.read(toc_length)))
+        self._data_start = len(MAGIC) + HEADER.size + toc_length
+
+    def names(self, parent_folder: str = None) -> list:
+        """:return: names of all entries, or only the file names of the entries in parent_folder"""
+        if parent_folder is None:
+            return list(self._entries)
+        prefix = entry_name(parent_folder, '')
+        return [name[len(prefix):] for name in self._entries if name.startswith(prefix)]
+
+    def md5(self, name: str) -> str:
+        """:return: md5 hex digest of the entry with name"""
+        return self._entries[name]['md5']
+
+    def read(self, name: str) -> bytes:
+        """:return: content of the entry with name
+        :raise KeyError if there is no such entry"""
+        entry = self._entries[name]
+        self._stream.seek(self._data_start + entry['offset'])
+        return self._stream.read(entry['length'])
+
+
+def pack(files: dict) -> bytes:
+    """Build a container
+
+    :param files: dict of entry name, see entry_name, to the content of the entry
+    :return: content of the container"""
+    entries = {}
+    offset = 0
+    for name, data in files.items():
+        entries[name] = {'offset': offset, 'length': len(data), 'md5': hashlib.md5(data).hexdigest()}
+        offset += len(data)
+    toc = encryption.encrypt(json.dumps(entries).encode())
+    return b''.join([MAGIC, HEADER.pack(len(toc)), toc] + list(files.values()))
+
+
+class ContainerStore:
+    """The container of a notebook on google drive, with a local copy of the last synced version. Thread safe.
+
+    Every change uploads the whole container, so the packed layout trades upload size for fewer downloads. Changes are
+    applied to the latest remote container, so entries changed from other devices are kept."""
+
+    def __init__(self, file_path: str = 'Storage', parent_folder: str = CONTAINER_FOLDER,
+                 session: gdrive.DriveSession = None):
+        """
+        :param file_path: local folder of the notebook
+        :param parent_folder: remote folder of the container
+        :param session: Drive session to use. If None, the default session is used"""
+        self.file_path = file_path
+        self.parent_folder = parent_folder
+        self.session = session
+        self.local_copy = os.path.join(file_path, '.' + CONTAINER_NAME)
+        self.manifest = sync.Manifest(os.path.join(file_path, '.container-manifest.json'))
+        self._lock = threading.RLock()
+
+    def _read_local(self) -> dict:
+        """:return: dict of entry name to content of every entry in the local copy, empty if there is none"""
+        try:
+            with open(self.local_copy, 'rb') as f:
+                container = Container(f)
+                return {name: container.read(name) for name in container.names()}
+        except FileNotFoundError:
+            return {}
+
+    def fetch(self):
+        """Bring the local copy up to date with one listing call, and one download if the container changed
+
+        :return: Container of the local copy, None if there is no container yet
+        :raise ConnectionError if drive could not be reached"""
+        with self._lock:
+            files = gdrive.list_files(self.parent_folder, fields='({})'.format(gdrive.FILE_FIELDS),
+                                      session=self.session)
+            if files is None:
+                raise ConnectionError('Could not list "{}"'.format(self.parent_folder))
+            remote = next((file for file in files if file['name'] == CONTAINER_NAME), None)
+            if remote is None:
+                return None
+            if not self.manifest.is_current(remote) or not os.path.exists(self.local_copy):
+                if not os.path.isdir(self.file_path):
+                    os.makedirs(self.file_path)
+                temp_location = self.local_copy + '.tmp'
+                with open(temp_location, 'wb') as f:
+                    gdrive.download_stream(remote['id'], f, session=self.session)
+                os.replace(temp_location, self.local_copy)
+                self.manifest.update(remote)
+            with open(self.local_copy, 'rb') as f:
+                return Container(io.BytesIO(f.read()))
+
+    def save(self, changes: dict):
+        """Bring the local copy up to date, apply changes to it and upload the whole container
+
+        :param changes: dict of entry name to new content, or to None to remove the entry
+        :return: metadata of the uploaded container, None if drive could not be reached or the upload failed"""
+        with self._lock:
+            try:
+                gdrive.ensure_folder(self.parent_folder, self.session)
+                self.fetch()    # Only downloads the container if another device changed it
+            except (ConnectionError, gdrive.HttpError) + gdrive.NETWORK_ERRORS as err:
+                logging.error('Could not fetch the packed notebook before saving: {}'.format(err))
+                return None
+            files = self._read_local()
+            for name, data in changes.items():
+                if data is None:
+                    files.pop(name, None)
+                else:
+                    files[name] = data
+            data = pack(files)
+            file = gdrive.save_file(CONTAINER_NAME, self.parent_folder, data=data, session=self.session)
+            if file is not None:
+                _replace(self.local_copy, data)
+                self.manifest.update(file)
+            return file
+
+
+class ContainerSync:
+    """Sync of a packed notebook into the local page files that runs in the background, with the same interface as
+    sync.FolderSync. Pages become available all at once, after the single download of the container"""
+
+    def __init__(self, store: ContainerStore, manifest: sync.Manifest, keep_local: set = frozenset()):
+        """
+        :param store: container of the notebook
+        :param manifest: manifest of the local pages
+        :param keep_local: names of local pages that must neither be replaced nor deleted"""
+        self.store = store
+        self.manifest = manifest
+        self.keep_local = keep_local
+        self.failures = {}
+        self._files = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='container-sync', daemon=True)
+
+    def start(self):
+        """Start syncing in the background. :return: self"""
+        self._thread.start()
+        return self
+
+    def files(self, timeout: float = None):
+        """Wait until the notebook is synced
+
+        :return: list of dicts with the name of every page, or None if drive could not be reached"""
+        self._done.wait(timeout)
+        return self._files
+
+    def wait_for(self, file_name: str, timeout: float = None) -> bool:
+        """Wait until the notebook is synced
+
+        :return: True if the local copy of file_name is up to date, False if the sync failed or timed out"""
+        return self._done.wait(timeout) and self._files is not None and file_name not in self.failures
+
+    def join(self, timeout: float = None):
+        """Wait until the notebook is synced, see files"""
+        self._thread.join(timeout)
+        return self._files
+
+    def _run(self):
+        import journal  # journal imports this module
+        password_file = os.path.join(self.store.file_path, 'password.txt')
+        try:
+            container = self.store.fetch()
+            pages = container.names(PAGE_FOLDER) if container is not None else []
+            if container is not None and entry_name(PASSWORD_FOLDER, 'password.txt') in container.names() \
+                    and 'password.txt' not in journal.unsynced_names(PASSWORD_FOLDER):  # Keep unsynced local changes
+                _replace(password_file, container.read(entry_name(PASSWORD_FOLDER, 'password.txt')))
+
+            # Local pages are only rewritten if they differ from the container
+            changed = []
+            for page in pages:
+                location = os.path.join(self.store.file_path, page)
+                entry = {'name': page, 'md5Checksum': container.md5(entry_name(PAGE_FOLDER, page))}
+                if page not in self.keep_local and not (self.manifest.is_current(entry) and os.path.exists(location)):
+                    _replace(location, container.read(entry_name(PAGE_FOLDER, page)))
+                    changed.append(entry)
+            self.manifest.update(*changed)
+
+            removed = [name for name in self.manifest.names() if name not in pages and name not in self.keep_local]
+            for name in removed:
+                logging.info('"{}" was removed remotely, deleting local copy'.format(name))
+                try:
+                    os.remove(os.path.join(self.store.file_path, name))
+                except FileNotFoundError:
+                    pass
+            self.manifest.remove(*removed)
+            self._files = [{'name': page} for page in pages]
+        except (ConnectionError, gdrive.HttpError) + gdrive.NETWORK_ERRORS as err:
+            logging.error('Could not sync the packed notebook: {}'.format(err))
+        finally:
+            if not os.path.exists(password_file):
+                os.makedirs(self.store.file_path, exist_ok=True)
+                with open(password_file, 'wb') as f:
+                    pass
+            self._done.set()
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_store() -> ContainerStore:
+    """Return the process wide container store of the default drive session, creating it on first use"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = ContainerStore()
+        return _default_store
+
+
+def migrate_to_container(file_path: str = 'Storage', session: gdrive.DriveSession = None):
+    """Pack all pages of the Notes folder and the password file into a container. The per-page files on drive are
+    kept, so the migration can be undone. Pages stored as segments are packed whole, and local pages and password
+    changes that are not uploaded yet are packed instead of their remote version
+
+    :return: metadata of the uploaded container, None if the upload failed
+    :raise ConnectionError if the pages could not be fetched"""
+    import journal  # journal imports this module
+    manifest = sync.Manifest(os.path.join(file_path, '.manifest.json'))
+    keep_local = journal.unsynced_names(PAGE_FOLDER) | page_module.logged_pages(file_path)
+    files = sync.sync_folder(PAGE_FOLDER, file_path, manifest, session=session, keep_local=keep_local,
+                             on_download=segments.SegmentStore(session=session).expand)
+    if files is None:
+        raise ConnectionError('Could not fetch the pages of "{}"'.format(PAGE_FOLDER))
+    entries = {}
+    for name in journal.local_pages(PAGE_FOLDER, [file['name'] for file in files]):
+        try:
+            with open(os.path.join(file_path, name), 'rb') as f:
+                entries[entry_name(PAGE_FOLDER, name)] = f.read()
+        except FileNotFoundError:
+            raise ConnectionError('Could not download "{}"'.format(name))
+    try:
+        if 'password.txt' not in journal.unsynced_names(PASSWORD_FOLDER):
+            gdrive.download_file('password.txt', PASSWORD_FOLDER, file_path, session=session)
+        with open(os.path.join(file_path, 'password.txt'), 'rb') as f:
+            entries[entry_name(PASSWORD_FOLDER, 'password.txt')] = f.read()
+    except FileNotFoundError:
+        pass
+    return ContainerStore(file_path, session=session).save(entries)
+
+
+def migrate_to_pages(file_path: str = 'Storage', session: gdrive.DriveSession = None) -> bool:
+    """Upload every entry of the container as its own file into the Notes and Password folders. The container is
+    kept, so the migration can be undone. Per-page files of pages that were deleted while the notebook was packed are
+    deleted, so they do not come back
+
+    :return: True if every file was uploaded and every deleted page removed
+    :raise ConnectionError if the container could not be fetched"""
+    container = ContainerStore(file_path, session=session).fetch()
+    if container is None:
+        raise ConnectionError('There is no packed notebook in "{}"'.format(CONTAINER_FOLDER))
+    saved = True
+    for name in container.names():
+        parent_folder, file_name = name.split('/', 1)
+        gdrive.ensure_folder(parent_folder, session)
+        saved = gdrive.save_file(file_name, parent_folder, data=container.read(name), session=session) is not None \
+            and saved
+
+    files = gdrive.list_files(PAGE_FOLDER, session=session)
+    if files is None:
+        return False
+    deleted = [file['id'] for file in files if file['name'] not in container.names(PAGE_FOLDER)]
+    if deleted:
+        logging.info('Deleting {} pages that were deleted while the notebook was packed'.format(len(deleted)))
+        saved = all(err is None for _, err in gdrive.delete_files(deleted, session=session)) and saved
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('direction', choices=['pack', 'unpack'],
+                        help='pack the per-page files into a container, or unpack the container into per-page files')
+    args = parser.parse_args()
+    if args.direction == 'pack':
+        migrate_to_container()
+    else:
+        migrate_to_pages()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#! python3
+"""Optional background daemon that keeps the notebook warm: the drive session with its credentials, service and id
+cache, the synced pages, the decrypted pages that were used, and the upload queue.
+
+note.py -p and batch.py send their commands to the daemon over a unix socket in the Storage folder if it is running,
+so they neither authenticate nor sync, and return once the change is journaled. Without a running daemon they work
+in-process like before. The daemon syncs the notebook again every RESYNC_INTERVAL seconds.
+
+Start it with: python daemon.py start, and stop it with: python daemon.py stop"""
+
+import argparse
+import getpass
+import json
+import logging
+import os.path
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import batch
+import functions
+import journal
+import note
+import page as page_module
+import passwords
+import upload_queue
+
+SOCKET_NAME = '.daemon.sock'
+RESYNC_INTERVAL = 60    # Seconds between syncs of the whole notebook
+REQUEST_TIMEOUT = 60    # Seconds the command line waits for a note to be added
+BATCH_TIMEOUT = 600     # Seconds the command line waits for a batch to be applied
+
+
+def socket_path(file_path: str = 'Storage') -> str:
+    """:return: path of the unix socket of the daemon of the notebook in file_path"""
+    return os.path.join(file_path, SOCKET_NAME)
+
+
+class NoAnswer(Exception):
+    """Raised when the daemon got a request but did not answer it, so it may or may not have been handled"""
+
+
+def request(message: dict, file_path: str = 'Storage', timeout: float = None):
+    """Send one request to the daemon and wait for its response
+
+    :param message: request with an 'op' and its arguments
+    :param timeout: seconds to wait for the response. Waits until done if None
+    :return: response dict, None if no daemon is running
+    :raise NoAnswer if the daemon got the request, but stopped or did not answer in time"""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        try:
+            client.connect(socket_path(file_path))
+        except OSError as err:  # No daemon, or the socket of one that did not stop properly
+            if not isinstance(err, (FileNotFoundError, ConnectionRefusedError)):
+                logging.warning('Could not connect to the daemon: {}'.format(err))
+            return None
+        try:
+            client.sendall(json.dumps(message).encode() + b'\n')
+            with client.makefile('rb') as f:
+                response = f.readline()
+        except OSError as err:  # It stopped or hung while handling the request
+            raise NoAnswer('The daemon did not answer: {}'.format(err)) from err
+    if not response.endswith(b'\n'):
+        raise NoAnswer('The daemon stopped while answering')
+    return json.loads(response)
+
+
+def quick_add(page_name: str, note: str, file_path: str = 'Storage'):
+    """Add a note to a page through the daemon, asking for the password of a locked page
+
+    :param page_name: name of the page, without .txt
+    :return: True if the note was added, False if not, None if no daemon is running"""
+    message = {'op': 'add', 'page': page_name, 'note': note}
+    try:
+        response = request(message, file_path, REQUEST_TIMEOUT)
+        if response is not None and response.get('password_required'):
+            message['password'] = getpass.getpass('Enter the password for note page "{}"\n'.format(page_name))
+            response = request(message, file_path, REQUEST_TIMEOUT)
+    except NoAnswer as err:     # Adding the note again in-process could add it twice
+        print('{}, the note may not have been added'.format(err), file=sys.stderr)
+        return False
+    if response is None:
+        return None
+    if not response['ok']:
+        print(response['error'], file=sys.stderr)
+    return response['ok']
+
+
+class Daemon:
+    """Warm notebook that answers the requests of the command line. Requests are handled one at a time"""
+
+    def __init__(self, file_path: str = 'Storage'):
+        """
+        :param file_path: local folder of the notebook"""
+        self.file_path = file_path
+        self.folder_sync = None
+        self.manifest = None
+        self.files = None
+        self._pages = {}    # file name -> (open page, fingerprint of the page file when it was last saved)
+        self._lock = threading.Lock()
+        self.server = None
+
+    def open(self):
+        """Set up the drive session and sync the notebook, see note.open_notebook"""
+        self.folder_sync, self.manifest, self.files = note.open_notebook(self.file_path)
+        functions._preload_password_file()
+
+    def resync(self):
+        """Sync the whole notebook and the password file again, to pick up changes made on other devices. Requests
+        are handled during the sync, only switching to its result waits for them"""
+        known = set(self.files or ())
+        functions._preload_password_file.pre_loaded = False
+        folder_sync, manifest = note.startup(self.file_path)
+        files = folder_sync.join()
+        functions._preload_password_file()
+        if files is None:
+            return
+        with self._lock:
+            self.folder_sync, self.manifest = folder_sync, manifest
+            files = journal.local_pages('Notes', [f['name'] for f in files])
+            # Pages created by requests during the sync, that it did not list yet
+            self.files = files + [name for name in self.files if name not in known and name not in files]
+
+    def _page(self, file_name: str):
+        """:return: the open page file_name, opened again if its file changed since it was last saved here"""
+        cached = self._pages.get(file_name)
+        if cached is not None and cached[1] == page_module.fingerprint(file_name, self.file_path):
+            return cached[0]
+        return note.open_page(file_name, self.file_path, self.folder_sync)
+
+    def handle(self, message: dict) -> dict:
+        """Handle one request
+
+        :return: response with 'ok', and an 'error' if it failed"""
+        op = message.get('op') if isinstance(message, dict) else None
+        handler = getattr(self, '_op_' + op, None) if isinstance(op, str) else None
+        if handler is None:
+            return {'ok': False, 'error': 'unknown request {}'.format(op)}
+        with self._lock:
+            return handler(message)
+
+    def _op_ping(self, message: dict) -> dict:
+        return {'ok': True, 'pid': os.getpid()}
+
+    def _op_add(self, message: dict) -> dict:
+        if not isinstance(message.get('page'), str) or not isinstance(message.get('note'), str):
+            return {'ok': False, 'error': 'add needs a page and a note'}
+        file_name = message['page'] + '.txt'
+        store = passwords.get_store()
+        if not store.is_unlocked(file_name):
+            if message.get('password') is None:
+                return {'ok': False, 'error': 'page is password protected', 'password_required': True}
+            if len(message['password']) > 1024 or not store.verify(file_name, message['password']):
+                return {'ok': False, 'error': 'Incorrect password'}
+        page = self._page(file_name)
+        page.add(message['note'])
+        note.close_page(page, self.manifest, 'add_note')    # Uploaded by the daemon in the background
+        self._pages[file_name] = (page, page_module.fingerprint(file_name, self.file_path))
+        if file_name not in self.files:
+            self.files.append(file_name)
+        return {'ok': True}
+
+    def _op_batch(self, message: dict) -> dict:
+        if not isinstance(message.get('lines'), list):
+            return {'ok': False, 'error': 'batch needs lines'}
+        self._pages.clear()     # Batch mode opens the pages itself
+        return {'ok': True, 'results': batch.run(message['lines'], self.file_path, self.files, self.manifest,
+                                                 self.folder_sync)}
+
+    def _op_stop(self, message: dict) -> dict:
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+        return {'ok': True}
+
+    def serve(self):
+        """Listen on the socket of the notebook until a stop request. Only the current user can connect"""
+        path = socket_path(self.file_path)
+        if os.path.exists(path):
+            os.remove(path)     # Left over from a daemon that did not stop properly, see main
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    response = daemon.handle(json.loads(self.rfile.readline()))
+                except Exception as err:    # One broken request should not stop the daemon
+                    logging.exception('Request failed')
+                    response = {'ok': False, 'error': str(err)}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        umask = os.umask(0o077)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        finally:
+            os.umask(umask)
+
+        def resync_regularly():
+            while True:
+                time.sleep(RESYNC_INTERVAL)
+                try:
+                    self.resync()
+                except Exception:   # Like a failed request, a failed resync should not stop later ones
+                    logging.exception('Resync failed')
+
+        threading.Thread(target=resync_regularly, name='daemon-resync', daemon=True).start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(path)
+            upload_queue.get_queue().flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['start', 'stop', 'status'],
+                        help='start the daemon in the foreground, stop the running daemon, or check if it runs')
+    args = parser.parse_args()
+    try:
+        running = request({'op': 'ping'}, timeout=5)
+        stopped = args.command == 'stop' and running is not None and \
+            (request({'op': 'stop'}, timeout=REQUEST_TIMEOUT) or {}).get('ok')
+    except NoAnswer as err:
+        print('{}, is it hanging?'.format(err), file=sys.stderr)
+        sys.exit(1)
+    if args.command == 'status':
+        print('Running, pid {}'.format(running['pid']) if running is not None else 'Not running')
+    elif args.command == 'stop':
+        print('Stopped' if stopped else 'Not running')
+    elif running is not None:
+        print('Already running, pid {}'.format(running['pid']))
+    else:
+        daemon = Daemon()
+        daemon.open()
+        print('Listening on {}'.format(socket_path()))
+        daemon.serve()
+
+
+if __name__ == '__main__':
+    main()
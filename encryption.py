@@ -1,18 +1,66 @@
-"""Module to encrypt and decrypt files using the cryptography module, and hash and verify words using hashlib"""
+"""Module to encrypt and decrypt files using the cryptography module, and hash and verify words using hashlib
 
-from cryptography.fernet import Fernet
+Encrypted data is stored in a versioned payload format: a header naming the format version, compression codec and
+level, cipher and the id of the key, followed by the nonce and the binary ciphertext of the compressed plaintext.
+The cipher is one of CIPHERS: AES-GCM or ChaCha20-Poly1305, both authenticated in a single pass with the header as
+associated data, or Fernet, stored as the binary Fernet token. Data in the older format, a bare base64 Fernet token
+of the plaintext, is still decrypted transparently.
+
+Data larger than STREAM_THRESHOLD is stored in the stream format instead:
+
+    header | nonce prefix | segment ... | 0 | encrypted index | index length
+
+Every segment holds whole lines of about SEGMENT_SIZE plaintext bytes, compressed and encrypted on its own with
+AES-GCM, with its position in the nonce. The authenticated index holds the offset, length and line count of every
+segment. Streams are encrypted and decrypted in constant memory, and single lines can be read without decrypting
+the other segments.
+
+New data is always encrypted with the current key in key.key. Keys replaced by a key rotation are kept in key.old,
+and the key of an unfinished rotation in key.next, so data encrypted with any of them can still be decrypted."""
+
+import base64
+import bisect
+import bz2
+import io
+import json
+import lzma
+import struct
+import zlib
 import os.path
 from typing import Optional
 import logging
 import hashlib
+import hmac
 import binascii
 
 
+def _invalid_token() -> type:
+    """:return: cryptography.fernet.InvalidToken, raised for data that does not decrypt. Like all of cryptography,
+    which takes long to import, it is imported when it is first needed"""
+    from cryptography.fernet import InvalidToken
+    return InvalidToken
+
+
+def __getattr__(name):
+    # InvalidToken is imported on first access, see _invalid_token
+    if name == 'InvalidToken':
+        globals()['InvalidToken'] = _invalid_token()
+        return globals()['InvalidToken']
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+def _invalid_tag() -> type:
+    """:return: cryptography.exceptions.InvalidTag, raised by AEAD ciphers for data that does not verify"""
+    from cryptography.exceptions import InvalidTag
+    return InvalidTag
+
+
 def _generate_key(file_path: str = './', file_name: str = 'key.key'):
     """Generate a key and save to file
 
     :param file_path: path to write file to
     :param file_name: Name of file to write to """
+    from cryptography.fernet import Fernet
     key = Fernet.generate_key()
     file = os.path.join(file_path, file_name)
     with open(file, 'wb') as f:
@@ -39,6 +87,469 @@ def _load_key(file_path: str = './', file_name: str = 'key.key'):
             raise
 
 
+def _fernet(key: bytes = None):
+    """:return: cryptography.fernet.Fernet instance for key, by default the current key in key.key. Keys and instances
+    are created once and then cached"""
+    # This checks if encrypt has an attribute key, and returns None if not, then assigns that to the attribute.
+    # This works because functions are objects in python so we can add attribute members to them
+    # This way, we have a kind of 'static' function variable
+    convert.key = getattr(convert, 'key', None)
+    if convert.key is None:
+        logging.debug('Creating new key')
+        convert.key = _load_key()
+    key = key or convert.key
+    _fernet.instances = getattr(_fernet, 'instances', {})
+    if key not in _fernet.instances:
+        from cryptography.fernet import Fernet
+        _fernet.instances[key] = Fernet(key)
+    return _fernet.instances[key]
+
+
+def _aead(key: bytes = None, cipher: str = 'aes-gcm'):
+    """:return: instance of the AEAD cipher in CIPHERS, with a key derived from key, by default the current key.
+    AES-GCM is also the cipher of the stream format"""
+    key = key or _current_key()
+    _aead.instances = getattr(_aead, 'instances', {})
+    if (key, cipher) not in _aead.instances:
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers import aead
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        info = b'GoogleDriveNotes stream format' if cipher == 'aes-gcm' else b'GoogleDriveNotes ' + cipher.encode()
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info)
+        aead_class = getattr(aead, CIPHERS[cipher][1])
+        _aead.instances[key, cipher] = aead_class(hkdf.derive(base64.urlsafe_b64decode(key)))
+    return _aead.instances[key, cipher]
+
+
+OLD_KEYS_FILE = 'key.old'   # Keys replaced by key rotations, one per line
+NEXT_KEY_FILE = 'key.next'  # New key of an unfinished key rotation
+KEY_ID_SIZE = 4
+
+
+def key_id(key: bytes) -> bytes:
+    """:return: id of key, as stored in payload headers"""
+    return hashlib.sha256(key).digest()[:KEY_ID_SIZE]
+
+
+def _current_key() -> bytes:
+    """:return: the current key in key.key, loaded once and then cached"""
+    _fernet()
+    return convert.key
+
+
+def _load_other_keys(file_path: str = './') -> list:
+    """:return: keys in key.old and key.next that can still be used to decrypt"""
+    keys = []
+    for file_name in (NEXT_KEY_FILE, OLD_KEYS_FILE):
+        try:
+            with open(os.path.join(file_path, file_name), 'rb') as f:
+                keys.extend(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            pass
+    return keys
+
+
+def _keyring() -> dict:
+    """:return: dict of key id to key of all known keys, the current key first. Loaded once per current key"""
+    current = _current_key()
+    if getattr(_keyring, 'key', None) is not current:
+        _keyring.keys = {key_id(current): current}
+        for key in _load_other_keys():
+            _keyring.keys.setdefault(key_id(key), key)
+        _keyring.key = current
+    return _keyring.keys
+
+
+def use_keys(current: bytes, others: list):
+    """Use current to encrypt, and current or any of others to decrypt, instead of the keys in the key files.
+    Used e.g. in worker processes of a key rotation"""
+    convert.key = current
+    _keyring.keys = {key_id(current): current}
+    for key in others:
+        _keyring.keys.setdefault(key_id(key), key)
+    _keyring.key = current
+
+
+def _candidate_keys(payload_key_id: bytes = None) -> list:
+    """:return: keys to try to decrypt a payload with: the key with payload_key_id, or all known keys if the payload
+    names no key
+    :raise cryptography.fernet.InvalidToken if the payload names a key that is not known"""
+    keyring = _keyring()
+    if payload_key_id is None:
+        return list(keyring.values())
+    if payload_key_id not in keyring:
+        raise _invalid_token()('Payload was encrypted with unknown key {}'.format(payload_key_id.hex()))
+    return [keyring[payload_key_id]]
+
+
+PAYLOAD_MAGIC = b'GDN'     # Start of versioned payloads. Legacy base64 Fernet tokens always start with 'gAAAAA'
+PAYLOAD_VERSION = 3     # Fernet token with key id. Version 1 is the same without key id
+STREAM_VERSION = 4      # Stream format with key id. Version 2 is the same without key id
+AEAD_VERSION = 5        # Nonce and ciphertext of an AEAD cipher, with cipher and key id
+STREAM_VERSIONS = (2, STREAM_VERSION)
+_HEADER_SIZES = {1: 3, 2: 3, PAYLOAD_VERSION: 3 + KEY_ID_SIZE, STREAM_VERSION: 3 + KEY_ID_SIZE,
+                 AEAD_VERSION: 4 + KEY_ID_SIZE}  # Header bytes after the magic, by version
+_AEAD_NONCE_SIZE = 12
+STREAM_THRESHOLD = 256 * 1024   # encrypt() uses the stream format for data larger than this many bytes
+SEGMENT_SIZE = 64 * 1024        # Plaintext bytes per segment of the stream format. Longer lines are not split
+_NONCE_PREFIX_SIZE = 8
+_LENGTH = struct.Struct('>I')   # Length of a segment, and position of a segment in its nonce
+_INDEX_LENGTH = struct.Struct('>Q')
+_INDEX_POSITION = 0xFFFFFFFF    # Position of the index in its nonce
+# Codec name -> (id in the payload header, compress(data, level), decompress(data))
+CODECS = {
+    'none': (0, lambda data, level: data, lambda data: data),
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'bz2': (2, bz2.compress, bz2.decompress),
+    'lzma': (3, lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+CODEC = 'zlib'  # Codec and level new payloads are compressed with
+LEVEL = 6
+# Cipher name -> (id in the payload header, name of the AEAD class in cryptography's aead module or None for Fernet)
+CIPHERS = {
+    'fernet': (0, None),
+    'aes-gcm': (1, 'AESGCM'),
+    'chacha20-poly1305': (2, 'ChaCha20Poly1305'),
+}
+CIPHER = 'aes-gcm'  # Cipher new payloads are encrypted with. Streams always use AES-GCM
+
+
+def _header(codec: str, level: int, version: int = PAYLOAD_VERSION, cipher: str = None) -> bytes:
+    """:return: payload header for the current key. cipher is only part of AEAD_VERSION headers"""
+    cipher_id = [CIPHERS[cipher][0]] if version == AEAD_VERSION else []
+    return bytes([version, CODECS[codec][0], level] + cipher_id) + key_id(_current_key())
+
+
+def _parse_header(start: bytes):
+    """Parse the header at the start of a versioned payload
+
+    :return: version, header as authenticated with the payload, key id or None if the version has none, and the
+    length of magic and header
+    :raise ValueError if the payload version is unknown"""
+    version = start[len(PAYLOAD_MAGIC)]
+    if version not in _HEADER_SIZES:
+        raise ValueError('Unsupported payload version {}'.format(version))
+    size = len(PAYLOAD_MAGIC) + _HEADER_SIZES[version]
+    header = start[len(PAYLOAD_MAGIC):size]
+    return version, header, header[-KEY_ID_SIZE:] if version >= PAYLOAD_VERSION else None, size
+
+
+def payload_key_id(data: bytes):
+    """:return: id of the key data was encrypted with, None if data is empty or in a format without key id"""
+    if not data.startswith(PAYLOAD_MAGIC):
+        return None
+    return _parse_header(data)[2]
+
+
+def _decompressor(codec_id: int):
+    """:return: decompress function of the codec with codec_id
+    :raise ValueError if the codec is unknown"""
+    for known_id, compress, decompress in CODECS.values():
+        if known_id == codec_id:
+            return decompress
+    raise ValueError('Unsupported payload codec {}'.format(codec_id))
+
+
+def _aead_cipher_name(cipher_id: int) -> str:
+    """:return: name of the AEAD cipher with cipher_id
+    :raise ValueError if the cipher is unknown or not an AEAD cipher"""
+    for name, (known_id, aead_class) in CIPHERS.items():
+        if known_id == cipher_id and aead_class is not None:
+            return name
+    raise ValueError('Unsupported payload cipher {}'.format(cipher_id))
+
+
+def encrypt(data: bytes, codec: str = None, level: int = None, cipher: str = None) -> bytes:
+    """Compress and encrypt data with the key in key.key into a versioned payload. Empty data stays empty, like in
+    convert
+
+    :param codec: name of the compression codec in CODECS. If None, CODEC is used. Falls back to 'none' if
+    compression does not make data smaller
+    :param level: compression level of the codec. If None, LEVEL is used
+    :param cipher: name of the cipher in CIPHERS. If None, CIPHER is used. Ignored for data in the stream format"""
+    if not data:
+        return data
+    if len(data) > STREAM_THRESHOLD:
+        sink = io.BytesIO()
+        encrypt_stream(io.BytesIO(data), sink, codec, level)
+        return sink.getvalue()
+    codec = codec or CODEC
+    level = LEVEL if level is None else level
+    compressed = CODECS[codec][1](data, level)
+    if len(compressed) >= len(data):
+        codec, level, compressed = 'none', 0, data
+    cipher = cipher or CIPHER
+    if CIPHERS[cipher][1] is not None:
+        header = _header(codec, level, AEAD_VERSION, cipher)
+        nonce = os.urandom(_AEAD_NONCE_SIZE)
+        return PAYLOAD_MAGIC + header + nonce + _aead(cipher=cipher).encrypt(nonce, compressed, header)
+    header = _header(codec, level)
+    # The header is repeated inside the token, so it is authenticated too
+    token = _fernet().encrypt(header + compressed)
+    return PAYLOAD_MAGIC + header + base64.urlsafe_b64decode(token)
+
+
+def _decrypt_token(token: bytes, keys: list) -> bytes:
+    """Decrypt a base64 Fernet token with the first of keys that verifies it"""
+    for key in keys[:-1]:
+        try:
+            return _fernet(key).decrypt(token)
+        except _invalid_token():
+            continue
+    return _fernet(keys[-1]).decrypt(token)
+
+
+def decrypt(data: bytes) -> bytes:
+    """Decrypt data that was encrypted with the key in key.key, in the versioned payload format or the legacy format.
+    Empty data stays empty, like in convert
+
+    :raise cryptography.fernet.InvalidToken if data is corrupted or was encrypted with another key
+    :raise ValueError if the payload version or codec is unknown"""
+    if not data:
+        return data
+    if not data.startswith(PAYLOAD_MAGIC):
+        return _decrypt_token(data, _candidate_keys())
+
+    version, header, payload_key, size = _parse_header(data)
+    if version in STREAM_VERSIONS:
+        sink = io.BytesIO()
+        decrypt_stream(io.BytesIO(data), sink)
+        return sink.getvalue()
+    if version == AEAD_VERSION:
+        key, = _candidate_keys(payload_key)
+        nonce = data[size:size + _AEAD_NONCE_SIZE]
+        try:
+            compressed = _aead(key, _aead_cipher_name(header[3])).decrypt(nonce, data[size + _AEAD_NONCE_SIZE:], header)
+        except _invalid_tag() as err:
+            raise _invalid_token()('Payload does not verify') from err
+        return _decompressor(header[1])(compressed)
+    plaintext = _decrypt_token(base64.urlsafe_b64encode(data[size:]), _candidate_keys(payload_key))
+    if plaintext[:len(header)] != header:
+        raise ValueError('Payload header does not match its encrypted copy')
+    return _decompressor(header[1])(plaintext[len(header):])
+
+
+def encrypt_line(data: bytes) -> bytes:
+    """Encrypt data like encrypt, as one line of base64 without line end, for line based files like the journal.
+    Binary payloads may contain line ends themselves"""
+    return base64.b64encode(encrypt(data))
+
+
+def decrypt_line(line: bytes) -> bytes:
+    """Decrypt a line written by encrypt_line. Lines holding a legacy base64 Fernet token are decrypted as well
+
+    :raise cryptography.fernet.InvalidToken if the line is corrupted or was encrypted with another key"""
+    line = line.strip()
+    if line.startswith(b'gAAAAA') or line.startswith(PAYLOAD_MAGIC):
+        return decrypt(line)
+    try:
+        return decrypt(base64.b64decode(line, validate=True))
+    except binascii.Error as err:
+        raise _invalid_token()('Line is not base64') from err
+
+
+def split_lines(data: bytes) -> list:
+    """Split data after every \\n, like reading it line by line. Unlike bytes.splitlines, \\r and other line
+    boundaries are kept inside their line, as notes may contain them
+
+    :return: list of lines with their line ends, which joined give data again"""
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def is_stream(data: bytes) -> bool:
+    """:return: True if data starts like a payload in the stream format"""
+    return data.startswith(PAYLOAD_MAGIC) and len(data) > len(PAYLOAD_MAGIC) and \
+        data[len(PAYLOAD_MAGIC)] in STREAM_VERSIONS
+
+
+def _segments(source):
+    """Read source in chunks, and cut it into segments of whole lines of about SEGMENT_SIZE bytes"""
+    buffer = b''
+    while True:
+        chunk = source.read(SEGMENT_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+        while len(buffer) >= SEGMENT_SIZE:
+            end = buffer.rfind(b'\n', 0, SEGMENT_SIZE) + 1 or buffer.find(b'\n', SEGMENT_SIZE) + 1
+            if not end:
+                break   # A line longer than a segment, that continues in the next chunk
+            yield buffer[:end]
+            buffer = buffer[end:]
+    if buffer:
+        yield buffer
+
+
+def _nonce(prefix: bytes, position: int) -> bytes:
+    return prefix + _LENGTH.pack(position)
+
+
+def encrypt_stream(source, sink, codec: str = None, level: int = None) -> int:
+    """Compress and encrypt a stream into the stream format, holding only about one segment in memory
+
+    :param source: readable binary stream of the plaintext
+    :param sink: writable binary stream for the payload
+    :param codec: name of the compression codec in CODECS. If None, CODEC is used
+    :param level: compression level of the codec. If None, LEVEL is used
+    :return: number of bytes written to sink"""
+    codec = codec or CODEC
+    level = LEVEL if level is None else level
+    compress = CODECS[codec][1]
+    header = _header(codec, level, STREAM_VERSION)
+    prefix = os.urandom(_NONCE_PREFIX_SIZE)
+    aead = _aead()
+
+    sink.write(PAYLOAD_MAGIC + header + prefix)
+    offset = len(PAYLOAD_MAGIC + header + prefix)
+    index = []      # [offset, length, line count] of every segment
+    for position, segment in enumerate(_segments(source)):
+        # The header is authenticated with every segment, and the position in the nonce prevents reordering
+        encrypted = aead.encrypt(_nonce(prefix, position), compress(segment, level), header)
+        sink.write(_LENGTH.pack(len(encrypted)) + encrypted)
+        index.append([offset, len(encrypted), len(split_lines(segment))])
+        offset += _LENGTH.size + len(encrypted)
+    sink.write(_LENGTH.pack(0))
+
+    encrypted_index = aead.encrypt(_nonce(prefix, _INDEX_POSITION), json.dumps(index).encode(), header)
+    sink.write(encrypted_index + _INDEX_LENGTH.pack(len(encrypted_index)))
+    return offset + _LENGTH.size + len(encrypted_index) + _INDEX_LENGTH.size
+
+
+def _read_exactly(source, size: int) -> bytes:
+    data = source.read(size)
+    if len(data) != size:
+        raise _invalid_token()('Stream payload is truncated')
+    return data
+
+
+def _read_stream_header(source):
+    """:return: header, keys to try and nonce prefix at the start of a stream payload"""
+    start = _read_exactly(source, len(PAYLOAD_MAGIC) + 1)
+    if not is_stream(start):
+        raise ValueError('Not a payload in the stream format')
+    start += _read_exactly(source, 2 + (KEY_ID_SIZE if start[-1] == STREAM_VERSION else 0))
+    _, header, payload_key, _ = _parse_header(start)
+    return header, _candidate_keys(payload_key), _read_exactly(source, _NONCE_PREFIX_SIZE)
+
+
+def _open(aead, keys: list, nonce: bytes, data: bytes, header: bytes):
+    """Decrypt a part of a stream payload with aead, or if it is None with the first of keys that verifies it
+
+    :return: AES-GCM instance that verified the part, and the plaintext
+    :raise cryptography.exceptions.InvalidTag if the part does not verify"""
+    for key in ([None] if aead is not None else keys[:-1]):
+        try:
+            return aead or _aead(key), (aead or _aead(key)).decrypt(nonce, data, header)
+        except _invalid_tag():
+            continue
+    aead = aead or _aead(keys[-1])
+    return aead, aead.decrypt(nonce, data, header)
+
+
+def decrypt_stream(source, sink) -> int:
+    """Decrypt a payload in the stream format segment by segment, holding only one segment in memory.
+
+    Every segment is verified before it is written to sink, but truncation after a segment is only detected at the
+    end, so write to a temporary location and only keep it if this returns.
+
+    :param source: readable binary stream of the payload
+    :param sink: writable binary stream for the plaintext
+    :return: number of plaintext bytes written to sink
+    :raise cryptography.fernet.InvalidToken if the payload is corrupted, truncated or was encrypted with another key"""
+    header, keys, prefix = _read_stream_header(source)
+    decompress = _decompressor(header[1])
+    aead = None     # Known once the first part verified
+    lengths = []
+    written = 0
+    try:
+        while True:
+            length, = _LENGTH.unpack(_read_exactly(source, _LENGTH.size))
+            if length == 0:
+                break
+            aead, segment = _open(aead, keys, _nonce(prefix, len(lengths)), _read_exactly(source, length), header)
+            segment = decompress(segment)
+            sink.write(segment)
+            written += len(segment)
+            lengths.append(length)
+        rest = source.read()
+        index_length, = _INDEX_LENGTH.unpack(rest[-_INDEX_LENGTH.size:])
+        if index_length != len(rest) - _INDEX_LENGTH.size:
+            raise _invalid_token()('Stream payload index is truncated')
+        aead, index = _open(aead, keys, _nonce(prefix, _INDEX_POSITION), rest[:index_length], header)
+        index = json.loads(index)
+    except (_invalid_tag(), struct.error) as err:
+        raise _invalid_token()('Stream payload does not verify') from err
+    if [entry[1] for entry in index] != lengths:
+        raise _invalid_token()('Stream payload segments do not match its index')
+    return written
+
+
+class StreamReader:
+    """Random access to the lines of a payload in the stream format. Only the index is decrypted up front, and
+    reading lines only decrypts the segments that hold them"""
+
+    def __init__(self, source):
+        """
+        :param source: readable, seekable binary stream of the payload
+        :raise cryptography.fernet.InvalidToken if the index is corrupted or was encrypted with another key"""
+        self._source = source
+        source.seek(0)
+        self._header, keys, self._prefix = _read_stream_header(source)
+        self._decompress = _decompressor(self._header[1])
+        source.seek(-_INDEX_LENGTH.size, io.SEEK_END)
+        index_length, = _INDEX_LENGTH.unpack(_read_exactly(source, _INDEX_LENGTH.size))
+        source.seek(-_INDEX_LENGTH.size - index_length, io.SEEK_END)
+        try:
+            self._aead, index = _open(None, keys, _nonce(self._prefix, _INDEX_POSITION),
+                                      _read_exactly(source, index_length), self._header)
+            self._index = json.loads(index)
+        except _invalid_tag() as err:
+            raise _invalid_token()('Stream payload index does not verify') from err
+        self._first_lines = [0]     # Number of the first line of every segment
+        for entry in self._index:
+            self._first_lines.append(self._first_lines[-1] + entry[2])
+
+    @property
+    def line_count(self) -> int:
+        """Number of lines of the plaintext"""
+        return self._first_lines[-1]
+
+    def _segment(self, position: int) -> list:
+        offset, length, _ = self._index[position]
+        self._source.seek(offset + _LENGTH.size)
+        try:
+            segment = self._aead.decrypt(_nonce(self._prefix, position), _read_exactly(self._source, length),
+                                         self._header)
+        except _invalid_tag() as err:
+            raise _invalid_token()('Stream payload segment {} does not verify'.format(position)) from err
+        return split_lines(self._decompress(segment))
+
+    def lines(self, start: int, stop: int) -> list:
+        """:return: lines start up to, but not including, stop of the plaintext, with their line ends"""
+        start, stop = max(start, 0), min(stop, self.line_count)
+        lines = []
+        position = bisect.bisect_right(self._first_lines, start) - 1
+        while start < stop:
+            segment = self._segment(position)
+            first = self._first_lines[position]
+            lines.extend(segment[start - first:stop - first])
+            start = self._first_lines[position + 1]
+            position += 1
+        return lines
+
+
+def content_id(data: bytes) -> str:
+    """Keyed hash of data, to address encrypted content by its plaintext without revealing it
+
+    :return: hex digest of the HMAC-SHA256 of data with the key in key.key"""
+    return hmac.new(_current_key(), data, hashlib.sha256).hexdigest()
+
+
 def convert(file_name: str, conversion_type: str, file_path: str = './', storage_type: str = 'write') -> Optional[bytes]:
     """Internal function for encrypting and decrypting a file.
     :param file_name: Name of file to convert
@@ -55,26 +566,18 @@ def convert(file_name: str, conversion_type: str, file_path: str = './', storage
     if storage_type not in ['write', 'return']:
         raise ValueError('storage_type "{}" is not supported'.format(storage_type))
 
-    # This checks if encrypt has an attribute key, and returns None if not, then assigns that to the attribute.
-    # This works because functions are objects in python so we can add attribute members to them
-    # This way, we have a kind of 'static' function variable
-    convert.key = getattr(convert, 'key', None)
-    if convert.key is None:
-        logging.debug('Creating new key')
-        convert.key = _load_key()
-
-    fer = Fernet(convert.key)
-
     try:
+        if storage_type == 'write' and os.path.getsize(file_name) > STREAM_THRESHOLD:
+            return _convert_stream(file_name, conversion_type)
         with open(file_name, 'r+b') as f:
             file_data = f.read()
             if file_data == b'':    # Apparently this library doesn't like empty data
                 return file_data
 
             if conversion_type == 'encrypt':
-                converted_data = fer.encrypt(file_data)
+                converted_data = encrypt(file_data)
             elif conversion_type == 'decrypt':
-                converted_data = fer.decrypt(file_data)
+                converted_data = decrypt(file_data)
             if storage_type == 'write':
                 f.seek(0)
                 f.write(converted_data)
@@ -86,6 +589,22 @@ def convert(file_name: str, conversion_type: str, file_path: str = './', storage
         raise
 
 
+def _convert_stream(file_name: str, conversion_type: str):
+    """Convert a large file in constant memory through a temporary file, see convert"""
+    temp_name = file_name + '.tmp'
+    with open(file_name, 'rb') as source:
+        is_stream_payload = is_stream(source.read(len(PAYLOAD_MAGIC) + 1))
+        source.seek(0)
+        with open(temp_name, 'wb') as sink:
+            if conversion_type == 'encrypt':
+                encrypt_stream(source, sink)
+            elif is_stream_payload:
+                decrypt_stream(source, sink)
+            else:   # Older formats are a single token anyway
+                sink.write(decrypt(source.read()))
+    os.replace(temp_name, file_name)
+
+
 def get_password_hash(word: str) -> str:
     """Function to apply a password hashing function to a word
 
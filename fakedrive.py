@@ -0,0 +1,426 @@
+"""In-memory stand-in for the google drive api, to test and benchmark the sync paths without a google account.
+
+The fake implements the part of the drive v3 files resource that gdrive uses: list with pagination, get, get_media,
+create, update, delete and batch requests. It can inject 403/5xx errors and simulate per-request latency.
+Plug it in through the service factory of a drive session:
+
+    drive = FakeDrive(latency=0.02)
+    gdrive.set_session(drive.session())
+
+The same fake can also be served as a local stand-in for the drive REST api, for agdrive.AsyncDriveClient:
+
+    runner = aiohttp.web.AppRunner(rest_app(drive))"""
+
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import gdrive
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DEFAULT_FIELDS = ('id', 'name', 'mimeType')
+ERROR_REASONS = {403: 'rateLimitExceeded', 404: 'notFound', 429: 'rateLimitExceeded', 500: 'backendError',
+                 502: 'backendError', 503: 'backendError', 504: 'backendError'}
+
+
+def _http_error(status: int) -> HttpError:
+    """Create an HttpError like the ones drive returns"""
+    reason = ERROR_REASONS.get(status, 'unknown')
+    content = json.dumps({'error': {'code': status, 'message': reason,
+                                    'errors': [{'reason': reason, 'message': reason}]}}).encode()
+    return HttpError(_response(status, {'content-type': 'application/json'}), content)
+
+
+def _response(status: int, headers: dict = None) -> httplib2.Response:
+    response = httplib2.Response(dict(headers or {}, status=status))
+    response.reason = ERROR_REASONS.get(status, 'OK')
+    return response
+
+
+def _select(file: dict, fields: str) -> dict:
+    """Return only the requested fields of a file, like the fields parameter of the api does"""
+    if fields is None:
+        names = DEFAULT_FIELDS
+    else:
+        match = re.search(r'files\(([^)]*)\)', fields)
+        names = [name.strip() for name in (match.group(1) if match else fields).split(',')]
+    return {name: file[name] for name in names if name in file}
+
+
+class FakeDrive:
+    """In-memory google drive. Thread safe.
+
+    Every api request sleeps for latency seconds, and fails with a random status from error_statuses with probability
+    error_rate. Errors can also be queued deterministically with fail_next."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, error_statuses=(403, 500, 503),
+                 page_size: int = 1000, seed: int = None):
+        """
+        :param latency: seconds every api request takes
+        :param error_rate: probability that a request fails
+        :param error_statuses: statuses random failures are chosen from
+        :param page_size: maximum number of files per list response. Without a pageSize, drive returns 100
+        :param seed: seed for the random failures"""
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.page_size = page_size
+        self.request_count = 0
+        self._files = {}
+        self._ids = itertools.count(1)
+        self._failures = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def session(self, **kwargs) -> gdrive.DriveSession:
+        """:return: drive session backed by this fake. kwargs are passed on to gdrive.DriveSession"""
+        return gdrive.DriveSession(service_factory=self.service, **kwargs)
+
+    def service(self):
+        """:return: fake drive api service instance"""
+        return _FakeService(self)
+
+    def fail_next(self, status: int, count: int = 1):
+        """Let the next count requests fail with status"""
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def add_folder(self, name: str, parent_id: str = None) -> str:
+        """Create a folder directly, without counting as a request. :return: id of the new folder"""
+        return self._create({'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent_id] if parent_id else []},
+                            b'')['id']
+
+    def add_file(self, name: str, data: bytes = b'', parent_id: str = None) -> str:
+        """Create a file directly, without counting as a request. :return: id of the new file"""
+        return self._create({'name': name, 'parents': [parent_id] if parent_id else []}, data)['id']
+
+    def content(self, file_id: str) -> bytes:
+        """:return: content of the file with file_id"""
+        with self._lock:
+            return self._files[file_id]['data']
+
+    def find(self, name: str) -> list:
+        """:return: metadata of all files called name"""
+        with self._lock:
+            return [self._public(file) for file in self._files.values() if file['name'] == name]
+
+    def _request(self, wait: bool = True):
+        """Account for one api request: wait for the latency, then maybe fail
+
+        :param wait: False for calls inside a batch request, which only waits once for the whole batch"""
+        if wait and self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.request_count += 1
+            if self._failures:
+                raise _http_error(self._failures.pop(0))
+            if self.error_rate and self._random.random() < self.error_rate:
+                raise _http_error(self._random.choice(self.error_statuses))
+
+    @staticmethod
+    def _public(file: dict) -> dict:
+        return {key: value for key, value in file.items() if key != 'data'}
+
+    def _set_data(self, file: dict, data: bytes):
+        file['data'] = data
+        file['size'] = str(len(data))
+        file['md5Checksum'] = hashlib.md5(data).hexdigest()
+        file['version'] = str(int(file.get('version', '0')) + 1)
+        file['modifiedTime'] = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+    def _get(self, file_id: str) -> dict:
+        file = self._files.get(file_id)
+        if file is None or file['trashed']:
+            raise _http_error(404)
+        return file
+
+    def _create(self, body: dict, data: bytes) -> dict:
+        with self._lock:
+            file_id = 'fake{}'.format(next(self._ids))
+            file = {'id': file_id, 'name': body.get('name', 'Untitled'),
+                    'mimeType': body.get('mimeType', 'application/octet-stream'),
+                    'parents': list(body.get('parents', [])), 'trashed': False}
+            self._set_data(file, data)
+            self._files[file_id] = file
+            return self._public(file)
+
+    def _update(self, file_id: str, body: dict, data: bytes = None) -> dict:
+        with self._lock:
+            file = self._get(file_id)
+            file.update({key: value for key, value in (body or {}).items() if key in ('name', 'mimeType')})
+            if data is not None:
+                self._set_data(file, data)
+            return self._public(file)
+
+    def _delete(self, file_id: str):
+        with self._lock:
+            self._get(file_id)
+            del self._files[file_id]
+
+    def _list(self, q: str = None, page_token: str = None, page_size: int = None) -> dict:
+        with self._lock:
+            matches = sorted((file for file in self._files.values() if _matches(file, q)), key=lambda f: f['id'])
+            start = int(page_token) if page_token else 0
+            end = start + min(page_size or 100, self.page_size)
+            response = {'files': [self._public(file) for file in matches[start:end]]}
+            if end < len(matches):
+                response['nextPageToken'] = str(end)
+            return response
+
+
+def _matches(file: dict, query: str) -> bool:
+    """Evaluate the subset of the drive query language that gdrive uses: clauses joined with 'and', and parenthesized
+    clauses joined with 'or'"""
+    if not query:
+        return not file['trashed']
+    for clause in re.split(r' and (?![^(]*\))', query):
+        clause = clause.strip()
+        if clause.startswith('(') and clause.endswith(')'):
+            if not any(_matches_clause(file, alternative.strip()) for alternative in clause[1:-1].split(' or ')):
+                return False
+        elif not _matches_clause(file, clause):
+            return False
+    return True
+
+
+def _matches_clause(file: dict, clause: str) -> bool:
+    match = re.fullmatch(r"(mimeType|name) (!?=) '(.*)'", clause)
+    if match:
+        field, operator, value = match.groups()
+        return (file[field] == value) == (operator == '=')
+    match = re.fullmatch(r"'(.*)' in parents", clause)
+    if match:
+        return match.group(1) in file['parents']
+    match = re.fullmatch(r'trashed = (true|false)', clause)
+    if match:
+        return file['trashed'] == (match.group(1) == 'true')
+    raise ValueError('Fake drive does not understand query clause "{}"'.format(clause))
+
+
+def _media_data(media_body) -> bytes:
+    """Read the whole content of a media upload"""
+    if media_body is None:
+        return None
+    return media_body.getbytes(0, media_body.size())
+
+
+class _FakeRequest:
+    """Stand-in for an api request. Executing it counts as one request"""
+
+    def __init__(self, drive: FakeDrive, function, fields: str = None, media_body=None):
+        self._drive = drive
+        self._function = function
+        self._fields = fields
+        self._media_body = media_body
+        self.resumable = media_body if media_body is not None and media_body.resumable() else None
+        self.resumable_progress = 0
+
+    def execute(self, wait: bool = True):
+        self._drive._request(wait)
+        return self._result(_media_data(self._media_body))
+
+    def next_chunk(self):
+        """Upload the next chunk of a resumable upload. The content is only stored once all chunks arrived"""
+        self._drive._request()
+        size = self.resumable.size()
+        self.resumable_progress = min(size, self.resumable_progress + self.resumable.chunksize())
+        if self.resumable_progress < size:
+            return self.resumable_progress, None
+        return None, self._result(_media_data(self._media_body))
+
+    def _result(self, data):
+        result = self._function(data)
+        return _select(result, self._fields) if isinstance(result, dict) and 'id' in result else result
+
+
+class _FakeHttp:
+    """Stand-in for the http object of a media download request, answering range requests"""
+
+    def __init__(self, drive: FakeDrive, file_id: str):
+        self._drive = drive
+        self._file_id = file_id
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        try:
+            self._drive._request()
+            data = self._drive.content(self._file_id)
+        except HttpError as err:
+            return err.resp, err.content
+        except KeyError:
+            return _response(404), b''
+        if not data:
+            return _response(416, {'content-range': 'bytes */0'}), b''
+        start, end = 0, len(data) - 1
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', (headers or {}).get('range', ''))
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+        if start >= len(data):
+            return _response(416, {'content-range': 'bytes */{}'.format(len(data))}), b''
+        headers = {'content-range': 'bytes {}-{}/{}'.format(start, end, len(data))}
+        return _response(206, headers), data[start:end + 1]
+
+
+class _FakeMediaRequest:
+    """Stand-in for a get_media request, used through gdrive.download_stream"""
+
+    def __init__(self, drive: FakeDrive, file_id: str):
+        self.uri = 'fake://files/{}?alt=media'.format(file_id)
+        self.http = _FakeHttp(drive, file_id)
+        self.headers = {}
+
+
+class _FakeBatch:
+    """Stand-in for a batch request. The whole batch counts as one request, but every call can fail on its own"""
+
+    def __init__(self, drive: FakeDrive, callback=None):
+        self._drive = drive
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self._requests.append((request, callback or self._callback, request_id or str(len(self._requests))))
+
+    def execute(self):
+        self._drive._request()
+        for request, callback, request_id in self._requests:
+            try:
+                response, exception = request.execute(wait=False), None
+            except HttpError as err:
+                response, exception = None, err
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class _FakeFiles:
+    """Stand-in for the files resource"""
+
+    def __init__(self, drive: FakeDrive):
+        self._drive = drive
+
+    def list(self, q=None, spaces=None, fields=None, pageToken=None, pageSize=None, **kwargs):
+        def list_files(_):
+            response = self._drive._list(q, pageToken, pageSize)
+            response['files'] = [_select(file, fields) for file in response['files']]
+            return response
+        return _FakeRequest(self._drive, list_files)
+
+    def get(self, fileId, fields=None, **kwargs):
+        return _FakeRequest(self._drive, lambda _: self._drive._public(self._drive._get(fileId)), fields)
+
+    def get_media(self, fileId, **kwargs):
+        return _FakeMediaRequest(self._drive, fileId)
+
+    def create(self, body=None, media_body=None, fields=None, **kwargs):
+        return _FakeRequest(self._drive, lambda data: self._drive._create(body or {}, data or b''), fields,
+                            media_body)
+
+    def update(self, fileId, body=None, media_body=None, fields=None, **kwargs):
+        return _FakeRequest(self._drive, lambda data: self._drive._update(fileId, body, data), fields, media_body)
+
+    def delete(self, fileId, **kwargs):
+        return _FakeRequest(self._drive, lambda _: self._drive._delete(fileId) or '')
+
+
+class _FakeService:
+    """Stand-in for a drive api service instance"""
+
+    def __init__(self, drive: FakeDrive):
+        self._drive = drive
+
+    def files(self):
+        return _FakeFiles(self._drive)
+
+    def new_batch_http_request(self, callback=None):
+        return _FakeBatch(self._drive, callback)
+
+
+def _parse_multipart(body: bytes, content_type: str):
+    """Split a multipart/related upload body into its json metadata and its media
+
+    :return: metadata dict and media bytes"""
+    boundary = re.search(r'boundary=([^;]+)', content_type).group(1).strip('"').encode()
+    parts = []
+    for part in body.split(b'--' + boundary)[1:-1]:
+        _, _, content = part.partition(b'\r\n\r\n')
+        parts.append(content[:-2] if content.endswith(b'\r\n') else content)
+    return json.loads(parts[0]), parts[1]
+
+
+def rest_app(drive: FakeDrive):
+    """Serve drive as a local stand-in for the part of the drive v3 REST api that agdrive uses: files.list,
+    files.get with and without alt=media, multipart uploads to create and update files, and files.delete.
+    Every http request counts as one request of drive, and can fail like one
+
+    :return: aiohttp.web.Application"""
+    import asyncio
+    from aiohttp import web
+
+    async def call(function, *args):
+        """Run a fake drive call without blocking the event loop, which its latency would. Drive errors become
+        error responses"""
+        def run():
+            drive._request()
+            return function(*args)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, run)
+        except HttpError as err:
+            raise _ErrorResponse(web.Response(status=err.resp.status, body=err.content,
+                                              content_type='application/json'))
+
+    async def list_files(request):
+        query = request.query
+        response = await call(drive._list, query.get('q'), query.get('pageToken'),
+                              int(query['pageSize']) if 'pageSize' in query else None)
+        response['files'] = [_select(file, query.get('fields')) for file in response['files']]
+        return web.json_response(response)
+
+    async def get_file(request):
+        file_id = request.match_info['file_id']
+        if request.query.get('alt') == 'media':
+            return web.Response(body=await call(lambda: drive._get(file_id)['data']))
+        return web.json_response(_select(await call(lambda: drive._public(drive._get(file_id))),
+                                         request.query.get('fields')))
+
+    async def upload(request):
+        metadata, data = _parse_multipart(await request.read(), request.headers['Content-Type'])
+        file_id = request.match_info.get('file_id')
+        if file_id is None:
+            file = await call(drive._create, metadata, data)
+        else:
+            file = await call(drive._update, file_id, metadata, data)
+        return web.json_response(_select(file, request.query.get('fields')))
+
+    async def delete_file(request):
+        await call(drive._delete, request.match_info['file_id'])
+        return web.Response(status=204)
+
+    @web.middleware
+    async def errors(request, handler):
+        try:
+            return await handler(request)
+        except _ErrorResponse as err:
+            return err.response
+
+    app = web.Application(middlewares=[errors])
+    app.router.add_get('/drive/v3/files', list_files)
+    app.router.add_get('/drive/v3/files/{file_id}', get_file)
+    app.router.add_post('/upload/drive/v3/files', upload)
+    app.router.add_patch('/upload/drive/v3/files/{file_id}', upload)
+    app.router.add_delete('/drive/v3/files/{file_id}', delete_file)
+    return app
+
+
+class _ErrorResponse(Exception):
+    """Carries the error response of a failed fake drive call to the middleware of rest_app"""
+
+    def __init__(self, response):
+        super().__init__(response.status)
+        self.response = response
@@ -1,34 +1,40 @@
 import sys
 import os
-import threading
 import gdrive
-import encryption
+import journal
+import passwords
+import search
 import logging
 import getpass
+import threading
 from typing import List
 
+import page as page_module
+from page import PageSession
+
+SHOWN_RESULTS = 50  # Search results shown at once
 
-def purge_notes(filename):
-    """Delete all notes in the note page at filename"""
+
+def purge_notes(page: PageSession):
+    """Delete all notes in the note page"""
     inp = input("Are you sure you want to delete all entries?(y/n)")
     if inp == 'y':
-        with open(filename, 'w') as f:
-            print("----Purged all entries----")
+        page.purge()
+        print("----Purged all entries----")
 
 
-def add_note(filename, note=None):
+def add_note(page: PageSession, note=None):
     """Add a note to the note page
 
-    :param filename: name of note page file
+    :param page: open note page
     :param note: Optional note to set. If None, user is promted for a note to enter"""
     if note is None:
         note = input('Enter note to add\n')
-    with open(filename, 'a+') as f:
-        f.write(note + '\n')
+    page.add(note)
 
 
-def delete_note(filename):
-    """Delete a note in the note page at filename"""
+def delete_note(page: PageSession):
+    """Delete a note in the note page"""
 
     try:
         note_number = int(input('Enter a number to delete\n'))
@@ -36,74 +42,58 @@ def delete_note(filename):
         print('Enter a note number')
         return
 
-    with open(filename, 'r') as f:
-        notes = f.readlines()
-    if note_number < 0 or note_number > (len(notes) - 1):
+    if note_number < 0 or note_number > (len(page) - 1):
         print('invalid note number')
         return
-    del notes[note_number]
-    with open(filename, 'w') as f:
-        for line in notes:
-            f.write(line)
+    page.delete(note_number)
 
 
-def change_note(filename):
-    """Change a note in the note page at filename"""
+def change_note(page: PageSession):
+    """Change a note in the note page"""
     try:
         note_number = int(input('Enter a number to change\n'))
     except ValueError:
         print('Enter a note number')
         return
 
-    with open(filename, 'r') as f:
-        notes = f.readlines()
-    if note_number < 0 or note_number > (len(notes) - 1):
+    if note_number < 0 or note_number > (len(page) - 1):
         print('invalid number')
         return
-    notes[note_number] = input('Enter replacement message\n') + '\n'
-    with open(filename, 'w') as f:
-        for line in notes:
-            f.write(line)
+    page.change(note_number, input('Enter replacement message\n'))
 
 
-def insert_note(file_name):
-    """Insert a note into the note page at filename"""
+def insert_note(page: PageSession):
+    """Insert a note into the note page"""
     try:
         note_number = int(input('Enter a number to insert\n'))
     except ValueError:
         print('Enter a note number')
         return
 
-    with open(file_name, 'r') as f:
-        notes = f.readlines()
-        notes = list(notes)
-    if note_number not in range(len(notes)):
+    if note_number not in range(len(page)):
         print('invalid number')
         return
-    notes.insert(note_number, input("Enter a message to insert\n") + '\n')
-    with open(file_name, 'w') as f:
-        for line in notes:
-            f.write(line)
+    page.insert(note_number, input("Enter a message to insert\n"))
 
 
-def _store_password(file_name: str, password: str, password_file: str = 'password.txt'):
-    """Append a hashed password to a password storage. Password storage is taken from google drive
+def _store_password(file_name: str, password: str):
+    """Protect a note page with a password, replacing its old password. The hashed password is saved to the password
+    file, which is uploaded to google drive in the background
     :param file_name: Name of file that the password protects
-    :param password: Password that should protect the file
-    :param password_file: Name of file the passwords are stored in. Is downloaded from google drive"""
+    :param password: Password that should protect the file"""
+    passwords.get_store().set_password(file_name, password)
+
 
-    password_data = encryption.convert(password_file, 'decrypt', 'Storage', 'return')
-    data = password_data.decode().rstrip().split('\n')
-    data = [l.rstrip() for l in data]   # I have no idea why I have to do this, but otherwise it keeps adding \r
+def _ask_new_password():
+    """Ask for a new password until it is confirmed
 
-    if data == ['']:
-        data = []
-    line = file_name + '\t' + encryption.get_password_hash(password)
-    data.append(line)
-    with open(os.path.join('Storage', password_file), 'w') as f:
-        f.writelines(l + '\n' for l in data)
-    encryption.convert(password_file, 'encrypt', 'Storage', 'write')
-    threading.Thread(target=gdrive.save_file, args=(password_file, 'Password', 'Storage')).start()
+    :return: the new password"""
+    while True:
+        pw = getpass.getpass('Enter password\n')
+        inp = getpass.getpass('Confirm password\n')
+        if pw == inp and len(pw) <= 1024:
+            return pw
+        print('Passwords do not match, or password is longer than 1024 characters')
 
 
 def _create_page(file_path, files):
@@ -119,13 +109,8 @@ def _create_page(file_path, files):
     while True:
         inp = input("Do you want to set up a password for this page?(y/n)\n")
         if inp == 'y':
-            pw = getpass.getpass('Enter password\n')
-            inp = getpass.getpass('Confirm password\n')
-            if pw == inp and len(pw) <= 1024:
-                _store_password(file_name, pw)
-                break
-            else:
-                print('Passwords do not match, or password is longer than 1024 characters')
+            _store_password(file_name, _ask_new_password())
+            break
         elif inp == 'n':
             break
 
@@ -134,43 +119,51 @@ def _create_page(file_path, files):
     path = os.path.join(file_path, file_name)
     with open(path, 'a') as f:
         files.append(file_name)
-        threading.Thread(target=gdrive.save_file, args=(file_name, 'Notes', file_path)).start()
+    journal.record('create page', 'Notes', file_name, file_path, b'')
 
 
 def _preload_password_file(password_file: str = 'password.txt'):
-    """Pre-download password file from google drive. Creates file it it doesnt exist remotely"""
+    """Pre-download password file from google drive. Creates file it it doesnt exist remotely.
+    Thread safe: if another thread is already downloading it, this waits for that download"""
 
     # To make sure this only downloads once
-    _preload_password_file.pre_loaded = getattr(_preload_password_file, 'pre_loaded', False)
-
-    if not _preload_password_file.pre_loaded:
-        file_location = os.path.join('Storage', password_file)
-        try:
-            gdrive.download_file(password_file, 'Password', 'Storage')
-        except FileNotFoundError:
-            logging.warning('Password file does not exist remotely, creating new file')
-            with open(file_location, 'w') as f:
-                pass
-        finally:
-            _preload_password_file.pre_loaded = True
-
-
-def _prompt_password(file_name: str, password_file='password.txt'):
-    """Prompt the user to input a password or this file, if it is password-protected
+    with _preload_lock:
+        _preload_password_file.pre_loaded = getattr(_preload_password_file, 'pre_loaded', False)
+
+        if not _preload_password_file.pre_loaded:
+            file_location = os.path.join('Storage', password_file)
+            os.makedirs('Storage', exist_ok=True)   # Runs concurrently with the page sync that also creates it
+            try:
+                if password_file not in journal.unsynced_names('Password'):     # Keep unsynced local password changes
+                    gdrive.download_file(password_file, 'Password', 'Storage')
+            except FileNotFoundError:
+                logging.warning('Password file does not exist remotely, creating new file')
+                with open(file_location, 'w') as f:
+                    pass
+            except (gdrive.HttpError,) + gdrive.NETWORK_ERRORS as err:   # Like the page sync, use the local copy
+                logging.warning('Could not download password file, using local copy: {}'.format(err))
+                if not os.path.exists(file_location):
+                    with open(file_location, 'w') as f:
+                        pass
+            finally:
+                _preload_password_file.pre_loaded = True
+                passwords.get_store().reload()
+
+
+_preload_lock = threading.Lock()
+
+
+def _prompt_password(file_name: str):
+    """Prompt the user to input a password or this file, if it is password-protected and not unlocked this session
 
     :param file_name: Name of file to check for password
-    :param password_file: Name of password file to check if file is protected
-    :return: True if file is not password protected, or the correct password has been entered. False otherwise"""
-    # I do not know why we would need to decode as latin-1 or why we would need to remove \r here
-    data = encryption.convert(password_file, 'decrypt', 'Storage', 'return').decode().rstrip().split('\n')
-    if data == ['']:
-        data = []
-    files = {s[0]: s[1].rstrip() for s in [line.split('\t') for line in data]}
-
-    if file_name in files:
-        password = getpass.getpass('Enter the password for note page "{}"\n'.format(file_name[:-4]))
-        return encryption.verify_password(password, files[file_name])
-    return True
+    :return: True if file is not password protected, is unlocked, or the correct password has been entered.
+    False otherwise"""
+    store = passwords.get_store()
+    if store.is_unlocked(file_name):
+        return True
+    password = getpass.getpass('Enter the password for note page "{}"\n'.format(file_name[:-4]))
+    return len(password) <= 1024 and store.verify(file_name, password)
 
 
 def _delete_page(file_path: str, files: List[str]) -> bool:
@@ -191,9 +184,13 @@ def _delete_page(file_path: str, files: List[str]) -> bool:
     if _prompt_password(files[inp]):
         delete_file_name = files[inp]
         os.remove(os.path.join(file_path, files[inp]))
+        if os.path.exists(page_module.edit_log_location(delete_file_name, file_path)):
+            os.remove(page_module.edit_log_location(delete_file_name, file_path))
         del files[inp]
-        delete_thread = threading.Thread(target=gdrive.delete_file, args=(delete_file_name, 'Notes', False))
-        delete_thread.start()
+        passwords.get_store().remove(delete_file_name)
+        search.get_index().remove(delete_file_name)
+        # Same upload queue key as saves of the page, so a pending save of the deleted page is dropped
+        journal.record(journal.DELETE_PAGE, 'Notes', delete_file_name, file_path)
         return True
 
 
@@ -212,7 +209,32 @@ def _add_password(file_path: str, files: List[str]) -> bool:
         return False
 
     if _prompt_password(files[inp]):
-        #TODO: Reassign password if already exists, otherwise add new password
+        _store_password(files[inp], _ask_new_password())
+        return True
+    print('Incorrect password')
+    return False
+
+
+def _search_notes(file_path: str, files: List[str]):
+    """Search the notes of all note pages for a query. Password protected pages are only searched while unlocked
+    :param file_path: path where files are located
+    :param files: list of note page names in file_path"""
+    query = input('Enter the words to search for\n')
+    index = search.get_index()
+    index.refresh(file_path, files)     # Only decrypts pages that changed since they were indexed
+    index.save()
+    results = index.search(query, passwords.get_store().is_unlocked)
+    pages = {}  # Only the pages of the shown results are read, and of large pages only the segments holding them
+    for file_name, note_number in results[:SHOWN_RESULTS]:
+        if file_name not in pages:
+            pages[file_name] = PageSession(file_name, file_path)
+        note = pages[file_name].lines(note_number, note_number + 1)[0]
+        print('{} {}: {}'.format(file_name[:-4], note_number, note.rstrip('\n')))
+    if len(results) > SHOWN_RESULTS:
+        print('Showing {} of {} results'.format(SHOWN_RESULTS, len(results)))
+    elif not results:
+        print('No results. Protected pages are only searched while they are unlocked')
+    input('Press enter to continue\n')
 
 
 def which_notes(file_path, files):
@@ -231,7 +253,7 @@ def which_notes(file_path, files):
         print(str(i) + ': ' + page[:-4])
         i += 1
     inp = input("Which note page do you want to access? Use n for creating a new page, d for deleting a page, "
-                "a for adding a password to a page\n")
+                "a for adding a password to a page, s for searching all pages\n")
 
     if inp == 'q':
         sys.exit()
@@ -244,6 +266,14 @@ def which_notes(file_path, files):
         if not _delete_page(file_path, files):
             return which_notes(file_path, files)
 
+    elif inp == 'a':
+        _add_password(file_path, files)
+        return which_notes(file_path, files)
+
+    elif inp == 's':
+        _search_notes(file_path, files)
+        return which_notes(file_path, files)
+
     if not inp.isdigit() or int(inp) not in range(len(files)):
         print("Not a valid note number")
         return which_notes(file_path, files)
@@ -252,7 +282,7 @@ def which_notes(file_path, files):
         return files[int(inp)]
     else:
         print('Incorrect password')
-        which_notes(file_path, files)
+        return which_notes(file_path, files)
 
 
 functionDict = {
@@ -1,28 +1,174 @@
 """Collection of easy to use functions for saving and downloading files to google drive.
-Assumes that credentials.json is in the directory"""
+Assumes that credentials.json is in the directory
+
+The google api client libraries take long to import, so they are only imported when they are first needed."""
 
 import io
-import json
 import pickle
 import os.path
-import random
+import socket
 import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import retry
+from idcache import IdCache
+
+SCOPES = ['https://www.googleapis.com/auth/drive']
+FILE_FIELDS = 'id, name, md5Checksum, modifiedTime, version'   # Metadata returned for uploaded and updated files
+DOWNLOAD_WORKERS = 8    # Default cap on concurrent downloads. Drive starts rate limiting if this gets much higher
+BATCH_SIZE = 100        # Maximum number of calls drive accepts in one batch request
+LIST_PAGE_SIZE = 1000   # Files per list response. Drive's default is 100, 1000 is the maximum it allows
+CHUNK_SIZE = 4 * 256 * 1024     # Transfer chunk size. Resumable upload chunks must be a multiple of 256 KiB
+
+
+def _http_error() -> type:
+    """:return: googleapiclient.errors.HttpError, the exception of failed drive requests. Imported on first use"""
+    from googleapiclient.errors import HttpError
+    return HttpError
+
+
+def _network_errors() -> tuple:
+    """:return: exceptions raised instead of HttpError when offline. Imports httplib2 on first use"""
+    import httplib2
+    from google.auth.exceptions import TransportError
+    return httplib2.HttpLib2Error, TransportError, OSError
+
+
+def __getattr__(name):
+    # HttpError and NETWORK_ERRORS are imported on first access, see _http_error and _network_errors
+    if name == 'HttpError':
+        globals()['HttpError'] = _http_error()
+        return globals()['HttpError']
+    if name == 'NETWORK_ERRORS':
+        globals()['NETWORK_ERRORS'] = _network_errors()
+        return globals()['NETWORK_ERRORS']
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+class DriveSession:
+    """Long-lived google drive session. Owns the credentials and one keep-alive http connection per thread.
+
+    Credentials are only loaded (and refreshed if expired) the first time a service is requested, and again whenever
+    they expire. Discovery clients are not thread safe, so every thread gets its own service instance, built once
+    and then reused for every call that thread makes."""
+
+    def __init__(self, scopes: list = None, service_factory=None, id_cache: IdCache = None,
+                 retry_policy: retry.RetryPolicy = None, rate_limiter: retry.TokenBucket = None):
+        """
+        :param scopes: google drive api scopes to authenticate with. Defaults to full drive access
+        :param service_factory: Optional callable without arguments that returns a drive api service instance.
+        Replaces the default authenticated discovery client
+        :param id_cache: Cache for name to id lookups. A new in-memory cache is used if None
+        :param retry_policy: Policy every api call is retried with. Default policy if None
+        :param rate_limiter: Rate limiter shared by all api calls of this session. Default limiter if None"""
+        self.scopes = scopes if scopes is not None else SCOPES
+        self._service_factory = service_factory
+        self.id_cache = id_cache if id_cache is not None else IdCache()
+        self.retry_policy = retry_policy if retry_policy is not None else retry.RetryPolicy()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else retry.TokenBucket()
+        self._creds = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def credentials(self):
+        """Return valid credentials, authenticating or refreshing them first if necessary"""
+        with self._lock:
+            if self._creds is None:
+                self._creds = _authenticate(self.scopes)
+            elif not self._creds.valid:
+                if self._creds.expired and self._creds.refresh_token:
+                    from google.auth.transport.requests import Request
+                    self._creds.refresh(Request())
+                    _save_credentials(self._creds)
+                else:
+                    self._creds = _authenticate(self.scopes)
+            return self._creds
+
+    def is_reachable(self, timeout: float = 3.0) -> bool:
+        """Cheaply check if google drive can be reached, without using any api quota
+
+        :param timeout: seconds to wait for a connection
+        :return: True if a connection to the api host could be opened. Always True with a custom service factory"""
+        if self._service_factory is not None:
+            return True
+        try:
+            socket.create_connection(('www.googleapis.com', 443), timeout=timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def service(self):
+        """Return the drive api service instance of the calling thread, building it on first use"""
+        if self._service_factory is not None:
+            service = getattr(self._local, 'service', None)
+            if service is None:
+                service = self._local.service = self._service_factory()
+            return service
+
+        creds = self.credentials()
+        service = getattr(self._local, 'service', None)
+        if service is None or service.http_creds is not creds:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            from googleapiclient.discovery import build
+            http = AuthorizedHttp(creds, http=httplib2.Http())   # httplib2 keeps the connection alive between calls
+            service = build('drive', 'v3', http=http, cache_discovery=False)
+            service.http_creds = creds
+            self._local.service = service
+        return service
+
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def get_session() -> DriveSession:
+    """Return the process wide drive session, creating it on first use"""
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = DriveSession()
+        return _default_session
+
+
+def set_session(session: DriveSession):
+    """Replace the process wide drive session that is used when no session is passed to a function"""
+    global _default_session
+    with _default_session_lock:
+        _default_session = session
+
+
+def _get_service(session: DriveSession = None):
+    """Get the drive api service instance for the calling thread from session, or the default session if None"""
+    if session is None:
+        session = get_session()
+    return session.service()
+
+
+def _get_cache(session: DriveSession = None) -> IdCache:
+    """Get the id cache of session, or of the default session if None"""
+    if session is None:
+        session = get_session()
+    return session.id_cache
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
-from googleapiclient.errors import HttpError
 
+def _execute(function, session: DriveSession = None):
+    """Call function, usually the execute method of an api request, with the retry policy and rate limiter of session
 
-def _build_service():   # This should probably be a decorator, but then I would have to restructure the actual functions
-    """Builds a google drive api service instance
+    :param function: function without arguments that makes one api call
+    :param session: Drive session to use. If None, the default session is used
+    :return: result of function"""
+    if session is None:
+        session = get_session()
+    return session.retry_policy.call(function, session.rate_limiter)
 
-    :returns: google drive api service instance"""
-    scopes = ['https://www.googleapis.com/auth/drive']
-    creds = _authenticate(scopes)
-    return build('drive', 'v3', credentials=creds, cache_discovery=False)
+
+def _save_credentials(creds):
+    """Save credentials to token.pickle so the next run does not have to log in again"""
+    with open('token.pickle', 'wb') as token:
+        pickle.dump(creds, token)
 
 
 def _authenticate(scopes):
@@ -38,18 +184,57 @@ def _authenticate(scopes):
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
                 'credentials.json', scopes)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+        _save_credentials(creds)
     return creds
 
 
-def _create_folder(service, folder_name=None):
+def _media_body(file_name: str = None, data: bytes = None, stream=None, chunk_size: int = CHUNK_SIZE):
+    """Create the media body for an upload from exactly one of a local file, bytes or a readable, seekable stream.
+
+    Media larger than one chunk is sent as a resumable upload in chunks of chunk_size, smaller media in one go.
+    :return: media upload instance"""
+    from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+    if stream is None and data is not None:
+        stream = io.BytesIO(data)
+    if stream is not None:
+        size = stream.seek(0, io.SEEK_END)
+        stream.seek(0)
+        if size <= chunk_size:
+            return MediaIoBaseUpload(stream, mimetype='*/*', resumable=False)
+        return MediaIoBaseUpload(stream, mimetype='application/octet-stream', chunksize=chunk_size, resumable=True)
+
+    # This is used for any simple file upload. Media refers to small files that are uploaded in one go.
+    # resumable as true is apparently a problem. Fuck these docs, they are less than useless.
+    # Seems like it will only upload a VERY limited set of encodings with resumable true. Such nonsense
+    # Binary octet-stream uploads work fine though, so large files are uploaded resumable with that mime type.
+    if os.path.getsize(file_name) <= chunk_size:
+        return MediaFileUpload(file_name, mimetype='*/*', resumable=False)
+    return MediaFileUpload(file_name, mimetype='application/octet-stream', chunksize=chunk_size, resumable=True)
+
+
+def _send_media(request, session: DriveSession = None):
+    """Execute a create or update request with a media body.
+
+    Resumable uploads are sent chunk by chunk. If a chunk fails, the retry first asks drive how much it received and
+    continues from that offset, so a dropped connection does not restart the whole upload.
+    :return: metadata of the uploaded file"""
+    if request.resumable is None:
+        return _execute(request.execute, session)
+    response = None
+    while response is None:
+        _, response = _execute(request.next_chunk, session)
+    return response
+
+
+def _create_folder(service, folder_name=None, session: DriveSession = None):
     """Create a folder on google drive"""
     if folder_name is None:
         print('Can\'t create a folder without name')
@@ -58,11 +243,13 @@ def _create_folder(service, folder_name=None):
         'name': folder_name,
         'mimeType': 'application/vnd.google-apps.folder'    # This means it's a folder, not actually a file
     }
-    file = service.files().create(body=file_metadata, fields='id').execute()
-    print('Folder ID: %s' % file.get('id'))
+    file = _execute(service.files().create(body=file_metadata, fields='id').execute, session)
+    logging.info('Created folder "{}" with id {}'.format(folder_name, file.get('id')))
+    return file.get('id')
 
 
-def _upload_file(service, file_name, parent_ids: list = None, file_path=None, data: bytes = None):
+def _upload_file(service, file_name, parent_ids: list = None, file_path=None, data: bytes = None,
+                 session: DriveSession = None, stream=None, chunk_size: int = CHUNK_SIZE):
     """Update an existing file's metadata and content.
 
     Args:
@@ -71,8 +258,11 @@ def _upload_file(service, file_name, parent_ids: list = None, file_path=None, da
         parent_ids: list of parent ids to set as the files parent
         file_path: Path to file on PC. Will not be copied, only used to find file. None means path is ignored
         data: data to write to file. If None, local data at file_name will be written
+        session: Drive session whose retry policy and rate limiter to use. If None, the default session is used
+        stream: readable, seekable stream to upload instead of data or the local file
+        chunk_size: chunk size for resumable uploads of media larger than one chunk
     Returns:
-        None
+        metadata of the uploaded file with the fields in FILE_FIELDS if successful, None otherwise
     """
     file_metadata = {
             'name': file_name
@@ -83,38 +273,23 @@ def _upload_file(service, file_name, parent_ids: list = None, file_path=None, da
     if parent_ids is not None:
         file_metadata['parents'] = parent_ids
 
-    if data is not None:
-        media = MediaIoBaseUpload(io.BytesIO(data), mimetype='*/*', resumable=False)
-
-    # This is used for any simple file upload. Media refers to small files that are uploaded in one go.
-    # resumable as true is apparently a problem. Fuck these docs, they are less than useless.
-    # Seems like it will only upload a VERY limited set of encodings with resumable true. Such nonsense
-    else:
-        media = MediaFileUpload(file_name, mimetype='*/*', resumable=False)
-
-    try_counter = 0
-    max_tries = 10
-    slot_time = 0.1     # This should be based on the time it takes to transfer the file
-    file = None
-    while try_counter < max_tries:
-        try:
-            file = service.files().create(body=file_metadata, media_body=media, fields='id, name').execute()
-            break
-        except HttpError as err:
-            if err.resp.status in [403, 500, 503, 502, 504]:
-                try_counter += 1
-                time.sleep(random.randint(0, 2**try_counter-1)*slot_time)    # Exponential back-off strategy
-            elif err.resp.get('content-type', '').startswith('application/json'):
-                reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
-                print('Could not upload file or retry because of: {0}'.format(reason))
-                return
-            else:
-                raise
-    if file is None:
-        print('Unable to upload file')
+    media = _media_body(file_name, data, stream, chunk_size)
+    request = service.files().create(body=file_metadata, media_body=media, fields=FILE_FIELDS)
+    try:
+        return _send_media(request, session)
+    except _http_error() as err:
+        if retry.is_retryable(err):
+            print('Unable to upload file')
+            return None
+        reason = retry.error_reason(err)
+        if reason is None:
+            raise
+        print('Could not upload file or retry because of: {0}'.format(reason))
+        return None
 
 
-def _update_file(service, file_id, new_filename, new_file_path=None, data: bytes = None):
+def _update_file(service, file_id, new_filename, new_file_path=None, data: bytes = None,
+                 session: DriveSession = None, stream=None, chunk_size: int = CHUNK_SIZE):
     """Update an existing file's metadata and content.
 
       Args:
@@ -123,31 +298,119 @@ def _update_file(service, file_id, new_filename, new_file_path=None, data: bytes
         new_filename: file name of the replacing file to upload
         new_file_path: Path to new file on PC. Only used to find file, ignored if None.
         data: data to write to file. If None, local data at file_name will be written
+        session: Drive session whose retry policy and rate limiter to use. If None, the default session is used
+        stream: readable, seekable stream to upload instead of data or the local file
+        chunk_size: chunk size for resumable uploads of media larger than one chunk
       Returns:
-        Updated file metadata if successful, None otherwise.
+        Updated file metadata with the fields in FILE_FIELDS if successful, None otherwise.
       """
     try:
-        file = service.files().get(fileId=file_id).execute()
-        del file['id']  # Apparently you need to delete all non-writable fields for this to work in version 3. Stupid
-        file['name'] = new_filename
+        # Update only patches the given fields, so the name is all we need. No need to fetch the old metadata first
+        file = {'name': new_filename}
 
         if new_file_path is not None:
             new_filename = os.path.join(new_file_path, new_filename)
 
-        if data is not None:
-            media_body = MediaIoBaseUpload(io.BytesIO(data), mimetype='*/*', resumable=False)
-        else:
-            media_body = MediaFileUpload(new_filename)
-
-        updated_file = service.files().update(fileId=file_id, body=file, media_body=media_body).execute()
-        return updated_file
+        media_body = _media_body(new_filename, data, stream, chunk_size)
+        request = service.files().update(fileId=file_id, body=file, media_body=media_body, fields=FILE_FIELDS)
+        return _send_media(request, session)
 
-    except HttpError as err:
+    except _http_error() as err:
         print(err)
         return None
 
 
-def _download_file(service, file_id: str, target_path='./', file_name: str = None):
+class Batch:
+    """Collects metadata gets, deletes and metadata updates and executes them as few multipart batch requests.
+
+    Usage:
+        batch = Batch(session)
+        batch.get(file_id, fields='id, name')
+        batch.delete(other_id)
+        results = batch.execute()
+
+    Media uploads and downloads can not be batched by google drive."""
+
+    def __init__(self, session: DriveSession = None, batch_size: int = BATCH_SIZE):
+        """
+        :param session: Drive session to use. Its retry policy applies to every call in the batch, and its rate
+        limiter to every batch request. If None, the default session is used
+        :param batch_size: maximum number of calls per batch request. Drive does not allow more than BATCH_SIZE"""
+        self._session = session if session is not None else get_session()
+        self._service = self._session.service()
+        self.batch_size = min(batch_size, BATCH_SIZE)
+        self._requests = []
+
+    def get(self, file_id: str, fields: str = 'id, name'):
+        """Queue a metadata get for file_id"""
+        self._requests.append(self._service.files().get(fileId=file_id, fields=fields))
+
+    def delete(self, file_id: str):
+        """Queue a delete of file_id"""
+        self._requests.append(self._service.files().delete(fileId=file_id))
+
+    def update(self, file_id: str, body: dict, fields: str = FILE_FIELDS):
+        """Queue a metadata update of file_id. Only the fields in body are changed"""
+        self._requests.append(self._service.files().update(fileId=file_id, body=body, fields=fields))
+
+    def __len__(self):
+        return len(self._requests)
+
+    def execute(self) -> list:
+        """Execute all queued calls. Calls that fail with a retryable error are retried in a later batch, with the
+        back-off of the session retry policy
+
+        :return: list with one (response, error) tuple per queued call, in the order they were queued.
+        error is None on success, otherwise response is None and error is the HttpError of the last try"""
+        policy = self._session.retry_policy
+        results = [(None, None)] * len(self._requests)
+        pending = list(range(len(self._requests)))
+        attempt = 0
+
+        while pending:
+            start = time.monotonic()
+            failed = []
+            for chunk_start in range(0, len(pending), self.batch_size):
+                failed.extend(self._execute_chunk(pending[chunk_start:chunk_start + self.batch_size], results))
+            pending = failed
+            attempt += 1
+            if not pending or attempt >= policy.max_tries:
+                break
+            time.sleep(policy.delay(attempt, results[pending[0]][1], time.monotonic() - start))
+
+        return results
+
+    def _execute_chunk(self, indices: list, results: list) -> list:
+        """Execute the queued calls at indices as one batch request and store their results
+
+        :return: list of indices that failed with a retryable error"""
+        limiter = self._session.rate_limiter
+        failed = []
+
+        def callback(request_id, response, exception):
+            index = int(request_id)
+            results[index] = (response, exception)
+            if exception is not None and retry.is_retryable(exception):
+                failed.append(index)
+                if retry.is_rate_limited(exception):
+                    limiter.throttle()
+
+        batch = self._service.new_batch_http_request(callback=callback)
+        for index in indices:
+            batch.add(self._requests[index], request_id=str(index))
+        limiter.acquire()   # One http request, however many calls it holds. Throttled calls still slow it down
+        try:
+            batch.execute()
+        except _http_error() as err:
+            if not retry.is_retryable(err):
+                raise
+            for index in indices:
+                results[index] = (None, err)
+            return list(indices)
+        return failed
+
+
+def _download_file(service, file_id: str, target_path='./', file_name: str = None, session: DriveSession = None):
     """Internal function to download a file from google drive to local target path
 
     Args:
@@ -155,32 +418,74 @@ def _download_file(service, file_id: str, target_path='./', file_name: str = Non
         file_id: Source file id on gdrive to download
         target_path: Path on PC to download to, including file name
         file_name: If not None, overwrites the remote name to save to
+        session: Drive session whose retry policy and rate limiter to use. If None, the default session is used
 
     Returns: None
     """
-    request = service.files().get_media(fileId=file_id)
-    file = service.files().get(fileId=file_id, fields='name').execute()
     if file_name is None:
+        file = _execute(service.files().get(fileId=file_id, fields='name').execute, session)
         file_location = os.path.join(target_path, file['name'])
     else:
         file_location = os.path.join(target_path, file_name)
+    temp_location = file_location + '.tmp'
     try:
-        fh = io.FileIO(file_location, 'wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-    except HttpError as err:
-        # This is so 0-Byte media doesn't just break the download. We just make an empty local file instead.
-        if err.resp.status == 416:
-            with open(file_location, 'wb') as f:
-                return
-        else:
+        # Like sync.FolderSync, the local copy is only replaced once the download is complete
+        with open(temp_location, 'wb') as fh:
+            download_stream(file_id, fh, session=session)   # 0-Byte media just makes an empty local file
+        os.replace(temp_location, file_location)
+    except BaseException:
+        try:
+            os.remove(temp_location)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def download_stream(file_id: str, sink, chunk_size: int = CHUNK_SIZE, offset: int = 0,
+                    session: DriveSession = None) -> int:
+    """Download a file from google drive chunk by chunk into a writable stream, with one range request per chunk.
+
+    Only one chunk is held in memory at a time. A failed chunk is retried from the last received offset, and an
+    interrupted download can be resumed later by passing the number of bytes already written as offset.
+
+    Args:
+        file_id: Source file id on gdrive to download
+        sink: writable stream the file content is written to
+        chunk_size: number of bytes requested per chunk
+        offset: number of bytes at the start of the file to skip, because they were already downloaded
+        session: Drive session to use. If None, the default session is used
+
+    Returns: total number of bytes downloaded into sink, including offset
+    """
+    request = _get_service(session).files().get_media(fileId=file_id)
+    # Like googleapiclient.http.MediaIoBaseDownload, which does not support starting at an offset
+    headers = {key: value for key, value in request.headers.items()
+               if key.lower() not in ('accept', 'accept-encoding', 'user-agent')}
+
+    def next_chunk():
+        headers['range'] = 'bytes={}-{}'.format(offset, offset + chunk_size - 1)
+        response, content = request.http.request(request.uri, 'GET', headers=headers)
+        if response.status >= 300:
+            raise _http_error()(response, content, uri=request.uri)
+        return response, content
+
+    while True:
+        try:
+            response, content = _execute(next_chunk, session)
+        except _http_error() as err:
+            if err.resp.status == 416:  # 0-Byte media, or offset already at the end of the file
+                return offset
             logging.error(err)
             raise
+        sink.write(content)
+        offset += len(content)
+        content_range = response.get('content-range')
+        if content_range is None or offset >= int(content_range.rsplit('/', 1)[1]) or not content:
+            return offset     # Without a content range, the whole file was sent at once
 
 
-def _get_ids_from_name(service, file_name, is_folder=False, custom_query=None, parent_id=None):
+def _get_ids_from_name(service, file_name, is_folder=False, custom_query=None, parent_id=None, cache: IdCache = None,
+                       session: DriveSession = None):
     """Helper function to get all ids for files with file_name as name
     Args:
         service: Drive API sevice instance
@@ -188,12 +493,19 @@ def _get_ids_from_name(service, file_name, is_folder=False, custom_query=None, p
         is_folder: Whether the file is a folder
         custom_query: Optional custom query to override the defaults
         parent_id: Optional id of parent. Searches only within that folder if set
+        cache: Optional id cache to answer from and fill. Never used together with custom_query
+        session: Drive session whose retry policy and rate limiter to use. If None, the default session is used
 
     Returns: list of file ids as strings, empty list if no folder matches the name
     """
     if file_name is None:
         return []
 
+    if cache is not None and custom_query is None:
+        file_ids = cache.get(file_name, is_folder, parent_id)
+        if file_ids is not None:
+            return file_ids
+
     if is_folder:
         query = "mimeType = 'application/vnd.google-apps.folder' and name = '{}' and trashed = false".format(file_name)
     else:
@@ -206,61 +518,108 @@ def _get_ids_from_name(service, file_name, is_folder=False, custom_query=None, p
         query = custom_query
 
     try:
-        response = service.files().list(q=query, spaces='drive', fields='files(id)').execute()
+        response = _execute(service.files().list(q=query, spaces='drive', fields='files(id)').execute, session)
         file_ids = [file['id'] for file in response.get('files', [])]
+        if cache is not None and custom_query is None:
+            cache.put(file_name, is_folder, parent_id, file_ids)
         return file_ids
-    except HttpError as err:
+    except _http_error() as err:
         logging.error(err)
         raise
 
 
-def download_file(file_name=None, parent_folder=None, target_path='./'):
+def download_files(files: list, target_path='./', max_workers: int = DOWNLOAD_WORKERS, session: DriveSession = None):
+    """Download many files in parallel, using at most max_workers concurrent downloads
+
+    Args:
+        files: list of dicts with the 'id' and 'name' of each file, as returned by list_files
+        target_path: Path on PC to download to
+        max_workers: maximum number of concurrent downloads
+        session: Drive session to use. If None, the default session is used
+
+    Returns:
+        dict of file name to the exception that made its download fail. Empty if all downloads succeeded
+    """
+    if session is None:
+        session = get_session()
+
+    def download(file):
+        _download_file(session.service(), file['id'], target_path, file['name'], session)
+
+    failures = {}
+    if not files:
+        return failures
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files)))) as executor:
+        futures = {executor.submit(download, file): file['name'] for file in files}
+        for future, name in futures.items():
+            try:
+                future.result()
+            except Exception as err:    # One broken file should not abort the whole batch
+                logging.error('Could not download "{}": {}'.format(name, err))
+                failures[name] = err
+    return failures
+
+
+def download_file(file_name=None, parent_folder=None, target_path='./', session: DriveSession = None,
+                  max_workers: int = DOWNLOAD_WORKERS):
     """Function to download all files with the given file name from google drive to local target path
 
     Args:
         file_name: Source file id on google drive to download. If None, download all files in parent_folder
         parent_folder: source file name on google drive to download. If None, search everywhere
         target_path: Path on PC to download to
+        session: Drive session to use. If None, the default session is used
+        max_workers: maximum number of concurrent downloads when downloading all files in parent_folder
 
     Returns:
-         None
+         None if file_name is set. Otherwise a dict of file name to exception for each failed download
     Raises:
         FileNotFoundError if remote file does not exist
     """
-    service = _build_service()
+    service = _get_service(session)
+    cache = _get_cache(session)
 
     if file_name is None:
-        file_ids = list_files(parent_folder, fields='(id)', file_type='file')
-        if file_ids is not None and file_ids:
-            for file_id in [i['id'] for i in file_ids]:
-                _download_file(service, file_id, target_path)
-        return
+        files = list_files(parent_folder, fields='(id, name)', file_type='file', session=session)
+        if not files:
+            return {}
+        return download_files(files, target_path, max_workers, session)
 
-    if parent_folder is None:
-        file_ids = _get_ids_from_name(service=service, file_name=file_name, is_folder=False)
-    else:
-        parent_ids = _get_ids_from_name(service, file_name=parent_folder, is_folder=True)
+    parent_id = None
+    if parent_folder is not None:
+        parent_ids = _get_ids_from_name(service, file_name=parent_folder, is_folder=True, cache=cache, session=session)
 
         if len(parent_ids) == 0:
             logging.error('No parent folder with name "{}" exists'.format(parent_folder))
             raise FileNotFoundError('No parent folder with name "{}" exists'.format(parent_folder))
         elif len(parent_ids) > 1:
             logging.warning('too many parent folders with name "{}" exist. Choosing one at random'.format(file_name))
+        parent_id = parent_ids[0]
 
-        file_ids = _get_ids_from_name(service, file_name, is_folder=False, parent_id=parent_ids[0])
+    for attempt in range(2):
+        file_ids = _get_ids_from_name(service, file_name, is_folder=False, parent_id=parent_id, cache=cache,
+                                      session=session)
 
-    if len(file_ids) > 1:
-        logging.warning('More than one of file with name "{}" exist, downloading all'.format(file_name))
-        for file_id in file_ids:
-            _download_file(service, file_id, target_path, file_id)
-
-    elif len(file_ids) == 0:
-        raise FileNotFoundError('No file with name "{}" exists.'.format(file_name))
-    else:
-        _download_file(service, file_ids[0], target_path)
+        if len(file_ids) > 1:
+            logging.warning('More than one of file with name "{}" exist, downloading all'.format(file_name))
+            download_files([{'id': file_id, 'name': file_id} for file_id in file_ids], target_path, max_workers,
+                           session)
+            return
+        elif len(file_ids) == 0:
+            raise FileNotFoundError('No file with name "{}" exists.'.format(file_name))
+        try:
+            _download_file(service, file_ids[0], target_path, session=session)
+            return
+        except _http_error() as err:
+            if attempt or cache is None or err.resp.status != 404:
+                raise
+            # The cached id might be stale, e.g. because the file was deleted or replaced from another device
+            cache.invalidate(file_name, False, parent_id)
 
 
-def save_file(file_name, parent_folder=None, file_path=None, data: bytes = None):
+def save_file(file_name, parent_folder=None, file_path=None, data: bytes = None, session: DriveSession = None,
+              stream=None, chunk_size: int = CHUNK_SIZE):
     """Save a file into google drive with folder_name as parent. File is updated if it exists.
 
     Args:
@@ -269,46 +628,89 @@ def save_file(file_name, parent_folder=None, file_path=None, data: bytes = None)
         file_path: Path to file on machine. The path will not be copied over to drive, only the name.
         If None, it will be ignored
         data: data to write to file. If None, local data at file_name will be written
+        session: Drive session to use. If None, the default session is used
+        stream: readable, seekable stream to upload instead of data or the local file
+        chunk_size: chunk size for resumable uploads of media larger than one chunk
 
     Returns:
-        None
+        metadata of the saved file with the fields in FILE_FIELDS if successful, None otherwise
     """
-    service = _build_service()
+    service = _get_service(session)
+    cache = _get_cache(session)
 
     parent_ids = None
+    parent_id = None
 
     if parent_folder is None:
-        file_ids = _get_ids_from_name(service=service, file_name=file_name, is_folder=False)
+        file_ids = _get_ids_from_name(service=service, file_name=file_name, is_folder=False, cache=cache,
+                                      session=session)
     else:
-        parent_ids = _get_ids_from_name(service=service, file_name=parent_folder, is_folder=True)
+        parent_ids = _get_ids_from_name(service=service, file_name=parent_folder, is_folder=True, cache=cache,
+                                        session=session)
         if len(parent_ids) == 0 or len(parent_ids) > 1:
             print("Found no folder or too many folders by that name")
             return
         else:
-            file_ids = _get_ids_from_name(service, file_name=file_name, is_folder=False, parent_id=parent_ids[0])
+            parent_id = parent_ids[0]
+            file_ids = _get_ids_from_name(service, file_name=file_name, is_folder=False, parent_id=parent_id,
+                                          cache=cache, session=session)
+
+    if len(file_ids) == 1:
+        file = _update_file(service, file_ids[0], file_name, file_path, data, session, stream, chunk_size)
+        if file is not None:
+            return file
+        # The cached id might be stale, e.g. because the file was deleted or replaced from another device
+        stale_id = file_ids[0]
+        cache.invalidate(file_name, False, parent_id)
+        file_ids = _get_ids_from_name(service, file_name=file_name, is_folder=False, parent_id=parent_id,
+                                      cache=cache, session=session)
+        if file_ids == [stale_id]:
+            return None     # The id is current, the update itself failed
 
     if len(file_ids) > 1:
         print('There is more than one file of that name in this folder')
         return
 
     elif len(file_ids) == 0:
-        _upload_file(service, file_name, parent_ids, file_path, data)
-        return
+        file = _upload_file(service, file_name, parent_ids, file_path, data, session, stream, chunk_size)
+        cache.put(file_name, False, parent_id, [file['id']] if file is not None else None)
+        return file
 
     else:
-        _update_file(service, file_ids[0], file_name, file_path, data)
-        return
+        return _update_file(service, file_ids[0], file_name, file_path, data, session, stream, chunk_size)
+
+
+def ensure_folder(folder_name: str, session: DriveSession = None) -> str:
+    """Create a folder on google drive, unless a folder with that name already exists
+
+    Args:
+        folder_name: name of the folder
+        session: Drive session to use. If None, the default session is used
+
+    Returns:
+        id of the folder
+    """
+    service = _get_service(session)
+    cache = _get_cache(session)
+    folder_ids = _get_ids_from_name(service, file_name=folder_name, is_folder=True, cache=cache, session=session)
+    if folder_ids:
+        return folder_ids[0]
+    folder_id = _create_folder(service, folder_name, session)
+    cache.put(folder_name, True, None, [folder_id])
+    return folder_id
 
 
-def delete_file(file_name: str, parent_folder: str = None, is_folder: bool = False):
+def delete_file(file_name: str, parent_folder: str = None, is_folder: bool = False, session: DriveSession = None):
     """Deletes all files with file_name in parent_folder on google drive
     :param parent_folder: parent folder of files. Only searches for files within this folder. All is searched if None
     :param file_name: name of file to delete
-    :param is_folder: whether the file is a folder. False means it's a file """
-    service = _build_service()
+    :param is_folder: whether the file is a folder. False means it's a file
+    :param session: Drive session to use. If None, the default session is used"""
+    service = _get_service(session)
+    cache = _get_cache(session)
 
     if parent_folder is not None:
-        parent_ids = _get_ids_from_name(service, parent_folder, is_folder=True)
+        parent_ids = _get_ids_from_name(service, parent_folder, is_folder=True, cache=cache, session=session)
     else:
         parent_ids = None
     if parent_ids:
@@ -316,35 +718,69 @@ def delete_file(file_name: str, parent_folder: str = None, is_folder: bool = Fal
     else:
         parent = None
 
-    file_ids = _get_ids_from_name(service, file_name, is_folder=is_folder, parent_id=parent)
+    file_ids = _get_ids_from_name(service, file_name, is_folder=is_folder, parent_id=parent, cache=cache,
+                                  session=session)
+    cache.invalidate(file_name, is_folder, parent)
+
+    if len(file_ids) == 1:
+        _execute(service.files().delete(fileId=file_ids[0]).execute, session)
+    elif len(file_ids) > 1:
+        delete_files(file_ids, session)
+
+
+def get_files_metadata(file_ids: list, fields: str = 'id, name', session: DriveSession = None) -> list:
+    """Get the metadata of many files with batch requests
 
+    :param file_ids: ids of the files to get metadata for
+    :param fields: fields of the files to return. Default id, name
+    :param session: Drive session to use. If None, the default session is used
+    :return: list of (metadata, error) tuples in the order of file_ids, see Batch.execute"""
+    batch = Batch(session)
     for file_id in file_ids:
-        service.files().delete(fileId=file_id).execute()
+        batch.get(file_id, fields)
+    return batch.execute()
 
 
-def list_files(parent_folder=None, fields='(id, name)', file_type='file'):
+def delete_files(file_ids: list, session: DriveSession = None) -> list:
+    """Delete many files by id with batch requests
+
+    :param file_ids: ids of the files to delete
+    :param session: Drive session to use. If None, the default session is used
+    :return: list of (response, error) tuples in the order of file_ids, see Batch.execute"""
+    batch = Batch(session)
+    for file_id in file_ids:
+        batch.delete(file_id)
+    results = batch.execute()
+    for file_id, (_, error) in zip(file_ids, results):
+        if error is not None:
+            logging.error('Could not delete file with id "{}": {}'.format(file_id, error))
+    return results
+
+
+def list_files(parent_folder=None, fields='(id, name)', file_type='file', session: DriveSession = None,
+               file_name: str = None, file_names: list = None):
     """List files in google drive.
 
     :param: parent_folder: Optional folder to limit search to
+    :param: file_name: Optional name to only list the files with
+    :param: file_names: Optional names to only list the files with any of. Keep it short, it is sent in the query
     :param: fields: fields of files to return on request. Enter fields in brackets as string. Default (id, name)
     :param: file_type: type of file. Possible values: 'file', 'folder'. Default 'file'
+    :param: session: Drive session to use. If None, the default session is used
 
     :returns list of file fields. Type is list of dict. [] if no files are found. None on error"""
     # TODO: MAybe this actually returns None on not found. Not quite sure if gdrive gives an httperror on not found or just empty list
 
-    service = _build_service()
-
     query = ''
 
     if file_type == 'file':
         query = "mimeType != 'application/vnd.google-apps.folder' and trashed = false"
     elif file_type == 'folder':
         query = "mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-
-    if parent_folder is not None:
-        parent_ids = _get_ids_from_name(service, parent_folder, is_folder=True)
-        if parent_ids:
-            query += " and '{}' in parents".format(parent_ids[0])
+    if file_name is not None:
+        query += " and name = '{}'".format(file_name)
+    if file_names:
+        query += " and ({})".format(' or '.join("name = '{}'".format(name) for name in file_names))
 
     fields = 'nextPageToken, files{}'.format(fields)
 
@@ -352,14 +788,24 @@ def list_files(parent_folder=None, fields='(id, name)', file_type='file'):
 
     page_token = None
     try:
+        service = _get_service(session)
+
+        if parent_folder is not None:
+            parent_ids = _get_ids_from_name(service, parent_folder, is_folder=True, cache=_get_cache(session),
+                                            session=session)
+            if parent_ids:
+                query += " and '{}' in parents".format(parent_ids[0])
+
         while True:
-            response = service.files().list(q=query, spaces='drive', fields=fields, pageToken=page_token).execute()
+            request = service.files().list(q=query, spaces='drive', fields=fields, pageSize=LIST_PAGE_SIZE,
+                                           pageToken=page_token)
+            response = _execute(request.execute, session)
             files.extend(response.get('files', []))
             page_token = response.get('nextPageToken', None)
             if page_token is None:
                 break
         return files
-    except HttpError as err:
+    except (_http_error(),) + _network_errors() as err:
         print(err)
         return None
 
@@ -0,0 +1,97 @@
+"""In-process cache of google drive name to id lookups, optionally persisted to disk"""
+
+import json
+import logging
+import os.path
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdCache:
+    """Thread safe cache mapping (name, is_folder, parent_id) to the list of matching google drive ids.
+
+    Entries expire after ttl seconds, and the least recently used entry is evicted once max_entries is exceeded.
+    If path is set, the cache is loaded from and written back to that json file, so it survives restarts."""
+
+    def __init__(self, ttl: float = 600, max_entries: int = 1024, path: str = None):
+        """
+        :param ttl: seconds an entry stays valid. None means entries never expire
+        :param max_entries: maximum number of entries before the least recently used one is evicted
+        :param path: Optional json file to persist the cache in. Not persisted if None"""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()   # key -> (timestamp, ids)
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    @staticmethod
+    def _key(name: str, is_folder: bool, parent_id: str = None):
+        return '{}\t{}\t{}'.format(name, int(is_folder), parent_id or '')
+
+    def get(self, name: str, is_folder: bool, parent_id: str = None):
+        """Get cached ids for name
+
+        :return: list of ids, or None if there is no valid entry"""
+        key = self._key(name, is_folder, parent_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            timestamp, ids = entry
+            if self.ttl is not None and time.time() - timestamp > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return list(ids)
+
+    def put(self, name: str, is_folder: bool, parent_id: str = None, ids: list = None):
+        """Cache ids for name. An empty or None list of ids invalidates the entry instead"""
+        if not ids:
+            self.invalidate(name, is_folder, parent_id)
+            return
+        key = self._key(name, is_folder, parent_id)
+        with self._lock:
+            self._entries[key] = (time.time(), list(ids))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def invalidate(self, name: str, is_folder: bool, parent_id: str = None):
+        """Remove the entry for name, if there is one"""
+        key = self._key(name, is_folder, parent_id)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._save()
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._save()
+
+    def _load(self):
+        """Load entries from self.path. A missing or unreadable file just means an empty cache"""
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+            self._entries = OrderedDict((key, (timestamp, ids)) for key, timestamp, ids in entries)
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as err:
+            logging.warning('Ignoring unreadable id cache {}: {}'.format(self.path, err))
+
+    def _save(self):
+        """Write entries to self.path. Must be called with the lock held"""
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump([[key, timestamp, ids] for key, (timestamp, ids) in self._entries.items()], f)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,277 @@
+"""Local write-ahead journal of note page mutations, replayed to google drive in the background.
+
+Every mutation is appended to the encrypted journal before it is uploaded, and dropped from the journal once drive
+confirmed it. Mutations made while offline stay in the journal until drive can be reached again."""
+
+import base64
+import hashlib
+import json
+import logging
+import os.path
+import threading
+import time
+
+import container
+import encryption
+import gdrive
+import segments
+import sync
+import upload_queue
+
+DELETE_PAGE = 'delete page'
+PAGES = 'pages'             # Layouts of the notebook on drive: one file per page,
+SEGMENTED = 'segmented'     # one index file per page plus shared segments, see segments.py,
+PACKED = 'packed'           # or one container for the whole notebook, see container.py
+REPLAY_INTERVAL = 30    # Seconds between attempts to replay the journal while there are unsynced mutations
+
+default_layout = PAGES  # Layout mutations are uploaded in, unless record is told otherwise
+
+
+class Journal:
+    """Append-only, encrypted journal of mutations. Every line is one encrypted json record. Thread safe.
+
+    An entry records the operation, the remote folder and file it affects, and the name of a side file in the data
+    folder next to the journal. That file holds the encrypted file content after the operation, as it is uploaded,
+    so replaying the latest entry of a file restores its remote state. Acknowledgements are appended as records too,
+    and the journal is only truncated once every entry is acknowledged, so journaling costs as much as the mutation."""
+
+    def __init__(self, path: str):
+        """
+        :param path: file the journal is stored in. Side files are stored in the folder path + '.data'"""
+        self.path = path
+        self.data_path = path + '.data'
+        self._lock = threading.Lock()
+        self._entries = []
+        last_seq = 0
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(encryption.decrypt_line(line))
+                        if 'ack' in record:
+                            self._drop(record)
+                        else:
+                            self._entries.append(record)
+                        last_seq = max(last_seq, record.get('seq', record.get('ack')))
+        except FileNotFoundError:
+            pass
+        self._next_seq = last_seq + 1
+        self._remove_orphans()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _write(self, record: dict):
+        """Durably append a record to the journal. Must be called with the lock held"""
+        with open(self.path, 'ab') as f:
+            f.write(encryption.encrypt_line(json.dumps(record).encode()) + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _data_location(self, entry: dict) -> str:
+        return os.path.join(self.data_path, str(entry['seq']))
+
+    def _remove_orphans(self):
+        """Remove side files without entry, left over from a crash between writing a side file and its entry"""
+        try:
+            names = os.listdir(self.data_path)
+        except FileNotFoundError:
+            return
+        referenced = {str(entry['seq']) for entry in self._entries}
+        for name in names:
+            if name not in referenced:
+                os.remove(os.path.join(self.data_path, name))
+
+    def append(self, op: str, parent_folder: str, file_name: str, data: bytes = None, layout: str = PAGES) -> dict:
+        """Durably record a mutation
+
+        :param op: name of the operation, e.g. 'add' or DELETE_PAGE
+        :param parent_folder: remote folder of the affected file
+        :param file_name: name of the affected file
+        :param data: encrypted content of the file after the mutation. None for deletes, or to upload the local file
+        :param layout: layout of the notebook on drive to upload the file in
+        :return: the new journal entry"""
+        with self._lock:
+            entry = {'seq': self._next_seq, 'op': op, 'folder': parent_folder, 'name': file_name, 'time': time.time(),
+                     'data': None}
+            if layout != PAGES:
+                entry['layout'] = layout
+            self._next_seq += 1
+            if data is not None:
+                # Already encrypted, so it is stored as it is. Written before the entry that refers to it
+                os.makedirs(self.data_path, exist_ok=True)
+                with open(self._data_location(entry), 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                entry['data'] = True
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._write(entry)
+            self._entries.append(entry)
+            return entry
+
+    def data(self, entry: dict):
+        """:return: encrypted content of the file after the mutation of entry, None if the entry has none"""
+        if entry['data'] is None:
+            return None
+        if entry['data'] is not True:   # Journals written before side files held the content in the entry
+            return base64.b64decode(entry['data'])
+        with open(self._data_location(entry), 'rb') as f:
+            return f.read()
+
+    def pending(self) -> list:
+        """:return: the latest unsynced entry of every affected file, oldest first"""
+        with self._lock:
+            latest = {}
+            for entry in self._entries:
+                latest.pop((entry['folder'], entry['name']), None)
+                latest[(entry['folder'], entry['name'])] = entry
+            return list(latest.values())
+
+    def _drop(self, ack: dict) -> bool:
+        """Drop the acknowledged entry and all older entries of the same file, with their side files
+
+        :param ack: acknowledgement record with the seq, folder and name of the acknowledged entry
+        :return: True if any entry was dropped"""
+        remaining = []
+        for entry in self._entries:
+            if (entry['folder'], entry['name']) == (ack['folder'], ack['name']) and entry['seq'] <= ack['ack']:
+                if entry['data'] is True:
+                    try:
+                        os.remove(self._data_location(entry))
+                    except FileNotFoundError:
+                        pass
+            else:
+                remaining.append(entry)
+        dropped = len(remaining) != len(self._entries)
+        self._entries = remaining
+        return dropped
+
+    def acknowledge(self, entry: dict):
+        """Drop entry and all older entries of the same file, because drive has confirmed their result"""
+        with self._lock:
+            ack = {'ack': entry['seq'], 'folder': entry['folder'], 'name': entry['name']}
+            if not self._drop(ack):
+                return
+            if self._entries:
+                self._write(ack)
+            else:
+                # Nothing left to replay, so the journal starts over. Sequence numbers keep counting up
+                with open(self.path, 'wb'):
+                    pass
+
+
+_default_journal = None
+_default_journal_lock = threading.Lock()
+
+
+def get_journal(path: str = os.path.join('Storage', '.journal')) -> Journal:
+    """Return the process wide journal, loading it from path on first use"""
+    global _default_journal
+    with _default_journal_lock:
+        if _default_journal is None:
+            _default_journal = Journal(path)
+        return _default_journal
+
+
+def _push(journal: Journal, entry: dict, file_path: str, manifest: sync.Manifest = None):
+    """Apply a journal entry to google drive, and acknowledge it if that worked"""
+    data = journal.data(entry)
+    if entry.get('layout') == PACKED:
+        name = container.entry_name(entry['folder'], entry['name'])
+        if entry['op'] == DELETE_PAGE:
+            file = container.get_store().save({name: None})
+        else:
+            if data is None:
+                with open(os.path.join(file_path, entry['name']), 'rb') as f:
+                    data = f.read()
+            file = container.get_store().save({name: data})
+        if file is not None:
+            if manifest is not None and entry['op'] == DELETE_PAGE:
+                manifest.remove(entry['name'])
+            elif manifest is not None:
+                manifest.update({'name': entry['name'], 'md5Checksum': hashlib.md5(data).hexdigest()})
+            journal.acknowledge(entry)
+        return
+
+    if entry['op'] == DELETE_PAGE:
+        gdrive.delete_file(entry['name'], entry['folder'], False)
+        if manifest is not None:
+            manifest.remove(entry['name'])
+        journal.acknowledge(entry)
+        return
+
+    if entry.get('layout') == SEGMENTED and data is not None:
+        # Only the changed segments are uploaded, and the page file on drive becomes their index
+        data = segments.get_store().save_page(encryption.decrypt(data))
+    if manifest is not None:
+        file = sync.save_file(entry['name'], entry['folder'], file_path, data, manifest)
+    else:
+        file = gdrive.save_file(entry['name'], entry['folder'], file_path, data)
+    if file is not None:
+        journal.acknowledge(entry)
+
+
+def record(op: str, parent_folder: str, file_name: str, file_path: str, data: bytes = None,
+           manifest: sync.Manifest = None, layout: str = None):
+    """Journal a mutation and queue its upload, or its remote delete for DELETE_PAGE, in the background.
+
+    Returns as soon as the mutation is journaled, so it never waits for the network.
+    :param op: name of the operation
+    :param parent_folder: remote folder of the file
+    :param file_name: name of the file
+    :param file_path: local folder of the file, used to upload the local file if data is None
+    :param data: encrypted content of the file after the mutation
+    :param manifest: Optional sync manifest to record the upload in
+    :param layout: layout of the notebook on drive to upload the file in. If None, default_layout is used"""
+    journal = get_journal()
+    entry = journal.append(op, parent_folder, file_name, data, layout or default_layout)
+    upload_queue.get_queue().submit((parent_folder, file_name), _push, journal, entry, file_path, manifest)
+
+
+def replay(file_path: str, manifest: sync.Manifest = None) -> int:
+    """Queue the latest unsynced mutation of every file in the journal
+
+    :return: number of queued files"""
+    journal = get_journal()
+    entries = journal.pending()
+    for entry in entries:
+        upload_queue.get_queue().submit((entry['folder'], entry['name']), _push, journal, entry, file_path, manifest)
+    return len(entries)
+
+
+def start_background_replay(file_path: str, manifest: sync.Manifest = None, interval: float = REPLAY_INTERVAL):
+    """Start a daemon thread that replays the journal whenever it has unsynced mutations and drive is reachable"""
+    def run():
+        while True:
+            time.sleep(interval)
+            if len(get_journal()) and gdrive.get_session().is_reachable():
+                logging.info('Replaying {} unsynced pages'.format(replay(file_path, manifest)))
+
+    threading.Thread(target=run, name='journal-replay', daemon=True).start()
+
+
+def local_pages(parent_folder: str, pages: list) -> list:
+    """Apply unsynced journal entries to a list of page names: pages created locally are added, pages deleted
+    locally are removed
+
+    :param parent_folder: remote folder of the pages
+    :param pages: names of the pages as far as drive or the sync manifest knows
+    :return: new list of page names"""
+    pages = list(pages)
+    for entry in get_journal().pending():
+        if entry['folder'] != parent_folder:
+            continue
+        if entry['op'] == DELETE_PAGE and entry['name'] in pages:
+            pages.remove(entry['name'])
+        elif entry['op'] != DELETE_PAGE and entry['name'] not in pages:
+            pages.append(entry['name'])
+    return pages
+
+
+def unsynced_names(parent_folder: str) -> set:
+    """:return: names of the files in parent_folder with unsynced journal entries"""
+    return {entry['name'] for entry in get_journal().pending() if entry['folder'] == parent_folder}
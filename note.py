@@ -2,80 +2,253 @@
 """ A simple CLI app for keeping personal notes. Add, remove and list all notes."""
 
 import sys
+import threading
 
+import functions
 from functions import functionDict, add_note, which_notes
 import gdrive
 import os
-import threading
-import encryption
+import container
+import journal
+import search
+import segments
+from page import PageSession, logged_pages
+import sync
+import upload_queue
+from idcache import IdCache
+from usage import UsageStats
+
+# Layout of the notebook on drive, see journal.PAGES, journal.SEGMENTED and journal.PACKED.
+# Pages stored as segments are read in either per-page layout. Migrate to and from PACKED with container.py
+LAYOUT = journal.PAGES
+SHOWN_NOTES = 100   # Notes shown at once. Longer pages only show the last ones, and can be scrolled with v
+COMPACT_IDLE = 30.0     # Seconds without edits after which an open page is compacted and its upload journaled
+
+
+def open_page(file_name, file_path, folder_sync: sync.FolderSync = None,
+              usage: UsageStats = None) -> PageSession:
+    """Decrypt the note page file_name into memory for editing, once the background sync has brought it up to date
+
+    :param folder_sync: Optional background sync of the note pages, to wait for the page to download
+    :param usage: Optional usage statistics to record the page opening in
+    :return: the open page"""
+    if folder_sync is not None and not folder_sync.wait_for(file_name):
+        print('Could not download the latest version of this page, using the local copy')
+    if usage is not None:
+        usage.record(file_name)
+    return PageSession(file_name, file_path)
+
+
+def close_page(page: PageSession, manifest: sync.Manifest, op: str = 'edit'):
+    """Compact the logged edits of page into its file, and journal its upload if it changed. The search index is
+    saved with the edits"""
+    data = page.compact()
+    if data is not None:
+        journal.record(op, 'Notes', page.file_name, page.file_path, data, manifest)
+    search.get_index().save()
+
 
+class _IdleUpload:
+    """Closes an open page with close_page once it was not edited for COMPACT_IDLE seconds, so edits reach google
+    drive while the page stays open, without compacting the page on every edit. The page may only be used while
+    holding lock, because the idle timer compacts it on another thread"""
 
-def list_notes(file_name, file_path, files):
-    """Lists all notes in the note page at filename. file_path specifies where the file is."""
+    def __init__(self, manifest: sync.Manifest, delay: float = COMPACT_IDLE):
+        self.manifest = manifest
+        self.delay = delay
+        self.lock = threading.Lock()
+        self._timer = None
 
-    encryption.convert(file_name, 'decrypt', file_path, 'write')
+    def edited(self, page: PageSession):
+        """Restart the idle timer after an edit of page"""
+        self.cancel()
+        self._timer = threading.Timer(self.delay, self._close, (page,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def cancel(self):
+        """Stop the idle timer, e.g. because the page is closed anyway"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def close(self, page: PageSession):
+        """Stop the idle timer and close page for good. A timer that fires later leaves the page alone, so it can't
+        write back a page that was deleted after it was left"""
+        self.cancel()
+        with self.lock:
+            close_page(page, self.manifest)
+            page.closed = True
+
+    def _close(self, page: PageSession):
+        with self.lock:
+            if not page.closed:
+                close_page(page, self.manifest)
+
+
+def list_notes(file_name, file_path, files, manifest: sync.Manifest, folder_sync: sync.FolderSync = None,
+               usage: UsageStats = None):
+    """Lists all notes in the note page at filename. file_path specifies where the file is.
+    Saved pages are recorded in manifest. Pages are opened with open_page, and uploaded when they are left"""
+
+    page = open_page(file_name, file_path, folder_sync, usage)
+    first_shown = None  # None shows the last notes
+    idle_upload = _IdleUpload(manifest)
 
-    save_thread = None
     try:
         while True:
-            os.system('cls' if os.name == 'nt' else 'clear')  # Clear screen
-            print('-' * 20)
-            with open(os.path.join(file_path, file_name), 'r') as f:
-                notes = f.readlines()
-            i = 0
-            for item in notes:
-                print(str(i) + ': ' + item)
-                i += 1
-            print('-' * 20)
+            with idle_upload.lock:
+                os.system('cls' if os.name == 'nt' else 'clear')  # Clear screen
+                print('-' * 20)
+                i = max(len(page) - SHOWN_NOTES if first_shown is None else first_shown, 0)
+                # Only decrypts the part of a large page that is shown
+                for item in page.lines(i, i + SHOWN_NOTES):
+                    print(str(i) + ': ' + item)
+                    i += 1
+                print('-' * 20)
+                if len(page) > SHOWN_NOTES:
+                    print('Showing some of {} notes, view others with v'.format(len(page)))
             inp = input('Do you want to delete, add, insert or change a note? Select page with n (d/a/i/c/q/p/n) \n')
 
             if inp == 'q':
                 sys.exit()
-            if inp == 'n':
-                encryption.convert(file_name, 'encrypt', file_path, 'write')
+            if inp == 'v':
+                try:
+                    first_shown = int(input('Enter the number of the first note to show\n'))
+                except ValueError:
+                    first_shown = None
+            elif inp == 'n':
+                idle_upload.close(page)     # Before the page menu, which can delete the page
                 file_name = which_notes(file_path, files)
-                encryption.convert(file_name, 'decrypt', file_path, 'write')
+                page = open_page(file_name, file_path, folder_sync, usage)
+                first_shown = None
+            elif inp in functionDict:
+                with idle_upload.lock:
+                    functionDict[inp](page)
+                    encrypted_data = page.save()    # Only logs the edit, unless the page was compacted
+
+                    # Journaled right away, uploaded in the background. Saves of the same page coalesce,
+                    # so fast edits only upload the latest version. Other edits are uploaded once the page is idle
+                    if encrypted_data is not None:
+                        journal.record(functionDict[inp].__name__, 'Notes', file_name, file_path, encrypted_data,
+                                       manifest)
+                    elif page.dirty:
+                        idle_upload.edited(page)
             else:
-                functionDict.get(inp, lambda _: print('Unavailable action'))(os.path.join(file_path, file_name))
+                print('Unavailable action')
+    finally:
+        idle_upload.close(page)
+        upload_queue.get_queue().flush()
 
-            if save_thread is not None:
-                save_thread.join()
-            encrypted_data = encryption.convert(file_name, 'encrypt', file_path, 'return')
 
-            save_thread = threading.Thread(
-                target=gdrive.save_file, args=(file_name, 'Notes', file_path, encrypted_data))
-            save_thread.start()
-    finally:
-        encryption.convert(file_name, 'encrypt', file_path, 'write')
+def startup(file_path, usage: UsageStats = None, layout: str = None):
+    """Start bringing the local note pages in file_path up to date with google drive in the background, using the
+    default drive session. The most used pages are downloaded first. Pages with unsynced local changes keep their
+    local version. The password file is downloaded at the same time
 
+    :param usage: Optional usage statistics to order the downloads by
+    :param layout: layout of the notebook on drive. If None, LAYOUT is used
+    :return: the running sync of the note pages, and the sync manifest"""
+    manifest = sync.Manifest(os.path.join(file_path, '.manifest.json'))
+    keep_local = journal.unsynced_names('Notes') | logged_pages(file_path)
+    if (layout or LAYOUT) == journal.PACKED:
+        functions._preload_password_file.pre_loaded = True  # The password file is part of the container
+        return container.ContainerSync(container.get_store(), manifest, keep_local).start(), manifest
 
-def main():
-    file_path = 'Storage'
-    # TODO: There's a long startup time for some reason. Doesn't make much sense. We only do one api call and starting a thread
+    threading.Thread(target=functions._preload_password_file, name='password-preload', daemon=True).start()
+
+    # Only downloads pages that changed remotely
+    folder_sync = sync.FolderSync('Notes', file_path, manifest, priority=usage.ranked if usage is not None else None,
+                                  keep_local=keep_local,
+                                  on_download=segments.get_store().expand).start()
+    return folder_sync, manifest
+
+
+def _set_session(file_path):
+    """Use a drive session with the persistent id cache in file_path as default session"""
+    gdrive.set_session(gdrive.DriveSession(id_cache=IdCache(path=os.path.join(file_path, '.idcache.json'))))
 
-    download_thread = threading.Thread(target=gdrive.download_file, args=(None, 'Notes', file_path))
-    download_thread.start() # TODO: Make more frequently used pages load first and accessible before others.
-    # TODO: Use metadata maybe? Batch request download doesnt seem possible. Possibly use multiple threads within download to make it faster
 
-    files = gdrive.list_files(parent_folder='Notes', fields='(name)', file_type='file')
+def open_notebook(file_path, usage: UsageStats = None):
+    """Set up the default drive session, start the sync of the notebook, and queue changes left over from earlier
+    sessions. Works offline with the local pages if google drive can not be reached
+
+    :param usage: Optional usage statistics to order the downloads by
+    :return: the running sync of the note pages, the sync manifest, and the names of all pages"""
+    _set_session(file_path)
+    journal.default_layout = LAYOUT
+
+    folder_sync, manifest = startup(file_path, usage)
+    files = folder_sync.files()     # Only waits for the listing, pages continue downloading in the background
     if files is None:
-        print("Could not fetch remote files.")
-        return None     # TODO: Use local files with only one save at the end if this happens
-    elif files:
-        files = [f['name'] for f in files]
+        print("Could not fetch remote files, working offline. Changes are synced once google drive is reachable",
+              file=sys.stderr)
+        files = journal.local_pages('Notes', manifest.names())
+    else:
+        files = journal.local_pages('Notes', [f['name'] for f in files])
+        journal.replay(file_path, manifest)     # Changes left over from an earlier offline session
+    for name in logged_pages(file_path):    # Edits of pages that were not left properly last time
+        close_page(PageSession(name, file_path), manifest)
+    journal.start_background_replay(file_path, manifest)
+    return folder_sync, manifest, files
 
-    file_name = which_notes(file_path, files)
 
-    download_thread.join()
+def quick_add(file_name, note, file_path):
+    """Add a note to the page file_name, only syncing that page and the password file instead of the whole notebook,
+    using the default drive session. The page is created if it does not exist
+
+    :return: True if the note was added"""
+    journal.default_layout = LAYOUT
+    password_preload = threading.Thread(target=functions._preload_password_file, name='password-preload', daemon=True)
+    password_preload.start()
+
+    manifest = sync.Manifest(os.path.join(file_path, '.manifest.json'))
+    if file_name in journal.unsynced_names('Notes') | logged_pages(file_path):
+        up_to_date = True   # Local changes win, like in startup
+    elif LAYOUT == journal.PACKED:
+        up_to_date = startup(file_path)[0].wait_for(file_name)
+    else:
+        up_to_date = sync.sync_file(file_name, 'Notes', file_path, manifest,
+                                    on_download=segments.get_store().expand)
+    if not up_to_date:
+        print('Could not download the latest version of this page, using the local copy', file=sys.stderr)
+    password_preload.join()
+    if not functions._prompt_password(file_name):
+        print('Incorrect password', file=sys.stderr)
+        return False
+
+    page = PageSession(file_name, file_path)
+    add_note(page, note)
+    close_page(page, manifest, add_note.__name__)
+    if up_to_date:
+        journal.replay(file_path, manifest)     # Changes left over from an earlier offline session
+    upload_queue.get_queue().flush()
+    return True
+
+
+def main():
+    file_path = 'Storage'
+    if len(sys.argv) > 3 and sys.argv[1] in ('-p', '--page'):
+        # Fast path: python note.py -p <page> <note>. Handled by the daemon if it runs, see daemon.py
+        import daemon
+        added = daemon.quick_add(sys.argv[2], ' '.join(sys.argv[3:]), file_path)
+        if added is None:
+            _set_session(file_path)
+            added = quick_add(sys.argv[2] + '.txt', ' '.join(sys.argv[3:]), file_path)
+        sys.exit(0 if added else 1)
+    usage = UsageStats(os.path.join(file_path, '.usage.json'))
+    folder_sync, manifest, files = open_notebook(file_path, usage)
+
+    file_name = which_notes(file_path, files)
 
     if len(sys.argv) < 2:
-        list_notes(file_name, file_path, files)
+        list_notes(file_name, file_path, files, manifest, folder_sync, usage)
 
     elif sys.argv[1] not in functionDict.keys():
-        encryption.convert(file_name, 'decrypt', file_path, 'write')
-        add_note(' '.join(sys.argv[1:]))
-        encryption.convert(file_name, 'encrypt', file_path, 'write')
-        gdrive.save_file(file_name, parent_folder='Notes')
+        page = open_page(file_name, file_path, folder_sync, usage)
+        add_note(page, ' '.join(sys.argv[1:]))
+        close_page(page, manifest, add_note.__name__)
+        upload_queue.get_queue().flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,275 @@
+"""In-memory editing session of a note page, so decrypted notes never touch the disk"""
+
+import hashlib
+import io
+import json
+import logging
+import os.path
+import time
+
+import encryption
+import search
+
+EDIT_LOG_SUFFIX = '.edits'
+COMPACT_EDITS = 100     # Saves logged before the page file is rewritten with all edits
+
+
+def edit_log_location(file_name: str, file_path: str = 'Storage') -> str:
+    """:return: path of the edit log of the note page file_name"""
+    return os.path.join(file_path, '.' + file_name + EDIT_LOG_SUFFIX)
+
+
+def logged_pages(file_path: str = 'Storage') -> set:
+    """:return: names of the note pages in file_path with edits that are not compacted into the page file yet"""
+    try:
+        names = os.listdir(file_path)
+    except FileNotFoundError:
+        return set()
+    return {name[1:-len(EDIT_LOG_SUFFIX)] for name in names
+            if name.startswith('.') and name.endswith(EDIT_LOG_SUFFIX)}
+
+
+def fingerprint(file_name: str, file_path: str = 'Storage') -> str:
+    """:return: fingerprint of the page file file_name and its edit log, that changes with every save"""
+    try:
+        with open(os.path.join(file_path, file_name), 'rb') as f:
+            page_md5 = hashlib.md5(f.read()).hexdigest()
+    except FileNotFoundError:
+        page_md5 = hashlib.md5(b'').hexdigest()
+    try:
+        log_size = os.path.getsize(edit_log_location(file_name, file_path))
+    except FileNotFoundError:
+        log_size = 0
+    return '{}:{}'.format(page_md5, log_size)
+
+
+def signature(file_name: str, file_path: str = 'Storage') -> list:
+    """:return: cheap signature of the page file file_name and its edit log, that changes whenever fingerprint
+    changes. It is made of file metadata, so it also changes if a file is rewritten with the same content"""
+    result = []
+    for location in os.path.join(file_path, file_name), edit_log_location(file_name, file_path):
+        try:
+            stat = os.stat(location)
+            result.extend([stat.st_ino, stat.st_mtime_ns, stat.st_size])
+        except FileNotFoundError:
+            result.extend([None, None, None])
+    return result
+
+
+class _Lines:
+    """Line access to a list of notes, like encryption.StreamReader"""
+
+    def __init__(self, notes: list):
+        self.notes = notes
+
+    @property
+    def line_count(self) -> int:
+        return len(self.notes)
+
+    def lines(self, start: int, stop: int) -> list:
+        return self.notes[start:stop]
+
+
+class PageSession:
+    """A note page, decrypted once into memory. Thread safety is up to the caller.
+
+    The notes are a piece table: a list of [source, start, stop] line ranges of either the page file or the notes
+    added this session, so edits never copy the notes of the page. Large pages in the stream format of encryption
+    are decrypted lazily, and reading lines only decrypts the segments holding them, even after edits.
+
+    save() appends the edits since the last save to an encrypted edit log next to the page file, so saving costs as
+    much as the edit, and updates the search index with the edits. compact() rewrites the page file with all edits
+    and removes the log. It runs on its own every COMPACT_EDITS saves, and the page file is only uploaded after it
+    ran, see note.list_notes for when else it runs."""
+
+    def __init__(self, file_name: str, file_path: str = 'Storage'):
+        """
+        :param file_name: name of the note page file
+        :param file_path: folder of the note page file. The file is stored encrypted"""
+        self.file_name = file_name
+        self.file_path = file_path
+        self.dirty = False  # True if the notes differ from the page file
+        self.closed = False     # True once the page was left, see note._IdleUpload.close
+        try:
+            with open(self.location, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        self._base_md5 = hashlib.md5(data).hexdigest()
+        if encryption.is_stream(data):
+            base = encryption.StreamReader(io.BytesIO(data))    # The compressed ciphertext is small
+        else:
+            base = _Lines([line.decode() for line in encryption.split_lines(encryption.decrypt(data))])
+        self._reset(base)
+        self._logged = self._replay_log()
+
+    def _reset(self, base):
+        self._base = base
+        self._added = _Lines([])
+        self._pieces = [[base, 0, base.line_count]] if base.line_count else []
+        self._length = base.line_count
+        self._edits = []    # Edits since the last save, see _apply
+
+    @property
+    def location(self) -> str:
+        """Path of the note page file"""
+        return os.path.join(self.file_path, self.file_name)
+
+    @property
+    def log_location(self) -> str:
+        """Path of the edit log of the page"""
+        return edit_log_location(self.file_name, self.file_path)
+
+    def _replay_log(self) -> int:
+        """Apply the edits in the edit log, if it belongs to the current page file. Otherwise the log is moved aside,
+        so its edits are kept for the user to recover, but not applied to a page they were not made on
+
+        :return: number of saves in the log"""
+        try:
+            with open(self.log_location, 'rb') as f:
+                saves = [json.loads(encryption.decrypt_line(line)) for line in f if line.strip()]
+        except FileNotFoundError:
+            return 0
+        if any(save['base'] != self._base_md5 for save in saves):
+            rejected_location = '{}.{}.rejected'.format(self.log_location, time.strftime('%Y%m%d-%H%M%S'))
+            os.replace(self.log_location, rejected_location)
+            logging.error('The edits of "{}" were made on another version of the page and are not applied. They are '
+                          'kept in "{}"'.format(self.file_name, rejected_location))
+            return 0
+        for save in saves:
+            for edit in save['edits']:
+                self._apply(*edit)
+        self._edits = []
+        return len(saves)
+
+    def __len__(self):
+        return self._length
+
+    def _split(self, index: int) -> int:
+        """Split the piece holding line index, so a piece starts at index
+
+        :return: position of the piece starting at index, len(self._pieces) if index is the end of the page"""
+        first = 0
+        for position, (source, start, stop) in enumerate(self._pieces):
+            if index == first:
+                return position
+            if index < first + stop - start:
+                split = start + index - first
+                self._pieces[position:position + 1] = [[source, start, split], [source, split, stop]]
+                return position + 1
+            first += stop - start
+        return len(self._pieces)
+
+    def _apply(self, op: str, index: int = 0, note: str = None):
+        """Apply one edit to the piece table and remember it for the next save
+
+        :param op: 'i' to insert note before line index, 'd' to delete line index, 'p' to delete all lines"""
+        if op == 'p':
+            self._pieces = []
+            self._length = 0
+        elif op == 'i':
+            position = self._split(index)
+            self._added.notes.append(note)
+            previous = self._pieces[position - 1] if position else None
+            if previous is not None and previous[0] is self._added and previous[2] == len(self._added.notes) - 1:
+                previous[2] += 1    # Consecutive notes, e.g. several added ones, share a piece
+            else:
+                self._pieces.insert(position, [self._added, len(self._added.notes) - 1, len(self._added.notes)])
+            self._length += 1
+        elif op == 'd':
+            position = self._split(index)
+            self._split(index + 1)
+            del self._pieces[position]
+            self._length -= 1
+        else:
+            raise ValueError('Unknown edit "{}"'.format(op))
+        self._edits.append([op, index, note])
+        self.dirty = True
+
+    def lines(self, start: int, stop: int) -> list:
+        """:return: notes start up to, but not including, stop"""
+        start, stop = max(start, 0), min(stop, self._length)
+        lines = []
+        first = 0
+        for source, piece_start, piece_stop in self._pieces:
+            if first >= stop:
+                break
+            length = piece_stop - piece_start
+            if first + length > start:
+                lines.extend(line if isinstance(line, str) else line.decode() for line in
+                             source.lines(piece_start + max(start - first, 0), piece_start + min(stop - first, length)))
+            first += length
+        return lines
+
+    @property
+    def notes(self) -> list:
+        """All notes of the page, each ending with a newline. Decrypts every segment of a page in the stream format"""
+        return self.lines(0, self._length)
+
+    def add(self, note: str):
+        """Append a note"""
+        self._apply('i', self._length, note + '\n')
+
+    def insert(self, index: int, note: str):
+        """Insert a note before the note at index"""
+        self._apply('i', index, note + '\n')
+
+    def change(self, index: int, note: str):
+        """Replace the note at index"""
+        self._apply('d', index)
+        self._apply('i', index, note + '\n')
+
+    def delete(self, index: int):
+        """Delete the note at index"""
+        self._apply('d', index)
+
+    def purge(self):
+        """Delete all notes"""
+        self._apply('p')
+
+    def content(self) -> bytes:
+        """:return: plaintext of the page"""
+        return ''.join(self.notes).encode()
+
+    def save(self) -> bytes:
+        """Durably append the edits since the last save to the edit log. Compacts the page every COMPACT_EDITS saves
+
+        :return: encrypted content of the page if it was compacted, None otherwise"""
+        if self._edits:
+            entry = encryption.encrypt_line(json.dumps({'base': self._base_md5, 'edits': self._edits}).encode())
+            with open(self.log_location, 'ab') as f:
+                previous_size = f.tell()
+                f.write(entry + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+                log_size = f.tell()
+            search.get_index().apply_edits(self.file_name, self._edits, '{}:{}'.format(self._base_md5, previous_size),
+                                           '{}:{}'.format(self._base_md5, log_size))
+            self._edits = []
+            self._logged += 1
+        if self._logged >= COMPACT_EDITS:
+            return self.compact()
+        return None
+
+    def compact(self) -> bytes:
+        """Encrypt the page with all edits and atomically replace the page file with it, then remove the edit log
+
+        :return: encrypted content of the page, None if it was not changed"""
+        if not self.dirty:
+            return None
+        content = self.notes
+        data = encryption.encrypt(''.join(content).encode())
+        temp_location = self.location + '.tmp'
+        with open(temp_location, 'wb') as f:
+            f.write(data)
+        os.replace(temp_location, self.location)
+        try:
+            os.remove(self.log_location)
+        except FileNotFoundError:
+            pass
+        self._base_md5 = hashlib.md5(data).hexdigest()
+        search.get_index().set_page(self.file_name, content, '{}:0'.format(self._base_md5))
+        self._reset(_Lines(content))
+        self._logged = 0
+        self.dirty = False
+        return data
@@ -0,0 +1,125 @@
+"""Password protection of note pages: the password hashes, loaded once into memory, and the pages unlocked this
+session"""
+
+import os.path
+import threading
+import time
+
+import encryption
+import journal
+
+UNLOCK_TIMEOUT = 300    # Seconds a page stays unlocked after its password was entered. 0 asks every time
+
+
+class PasswordStore:
+    """Salted password hashes of the protected pages, indexed by page name. Thread safe.
+
+    The encrypted password file is decrypted and parsed once, on first use. Changes update the index in memory and
+    write the file from it, and a page whose password was verified stays unlocked for unlock_timeout seconds, so
+    neither the file nor the password hash has to be processed again to open it."""
+
+    def __init__(self, password_file: str = 'password.txt', file_path: str = 'Storage',
+                 unlock_timeout: float = UNLOCK_TIMEOUT):
+        """
+        :param password_file: name of the encrypted password file, locally and in the Password folder on drive
+        :param file_path: local folder of the password file
+        :param unlock_timeout: seconds a page stays unlocked after its password was entered"""
+        self.password_file = password_file
+        self.file_path = file_path
+        self.unlock_timeout = unlock_timeout
+        self._hashes = None     # page name -> salted password hash
+        self._unlocked = {}     # page name -> time.monotonic() when it locks again
+        self._lock = threading.RLock()
+
+    def _index(self) -> dict:
+        """Return the index of password hashes, loading it from the password file on first use"""
+        with self._lock:
+            if self._hashes is None:
+                try:
+                    with open(os.path.join(self.file_path, self.password_file), 'rb') as f:
+                        data = encryption.decrypt(f.read())
+                except FileNotFoundError:
+                    data = b''
+                self._hashes = {}
+                for line in data.decode().split('\n'):
+                    if line.strip():
+                        page, password_hash = line.split('\t', 1)
+                        self._hashes[page] = password_hash.rstrip()
+            return self._hashes
+
+    def reload(self):
+        """Forget the loaded index, e.g. because a newer password file was downloaded. Unlocked pages stay unlocked"""
+        with self._lock:
+            self._hashes = None
+
+    def _save(self):
+        """Write the index to the encrypted password file, and queue its upload. Must be called with the lock held"""
+        data = encryption.encrypt(''.join('{}\t{}\n'.format(page, password_hash)
+                                          for page, password_hash in self._hashes.items()).encode())
+        location = os.path.join(self.file_path, self.password_file)
+        with open(location + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(location + '.tmp', location)
+        journal.record('store password', 'Password', self.password_file, self.file_path, data)
+
+    def is_protected(self, page: str) -> bool:
+        """:return: True if page has a password"""
+        return page in self._index()
+
+    def is_unlocked(self, page: str) -> bool:
+        """:return: True if page has no password, or its password was entered less than unlock_timeout seconds ago"""
+        with self._lock:
+            if not self.is_protected(page):
+                return True
+            return self._unlocked.get(page, 0) > time.monotonic()
+
+    def verify(self, page: str, password: str) -> bool:
+        """Check the password of a page, and unlock the page if it is correct
+
+        :raise ValueError if password is longer than 1024 characters
+        :return: True if page has no password or password is correct"""
+        with self._lock:
+            password_hash = self._index().get(page)
+        if password_hash is None:
+            return True
+        if not encryption.verify_password(password, password_hash):     # Slow on purpose, so not under the lock
+            return False
+        self._unlock(page)
+        return True
+
+    def _unlock(self, page: str):
+        with self._lock:
+            self._unlocked[page] = time.monotonic() + self.unlock_timeout
+
+    def set_password(self, page: str, password: str):
+        """Protect page with password, replacing its old password. The page is unlocked"""
+        password_hash = encryption.get_password_hash(password)
+        with self._lock:
+            self._index()[page] = password_hash
+            self._save()
+        self._unlock(page)
+
+    def remove(self, page: str):
+        """Remove the password of page, e.g. because the page was deleted"""
+        with self._lock:
+            self._unlocked.pop(page, None)
+            if self._index().pop(page, None) is not None:
+                self._save()
+
+    def lock_all(self):
+        """Lock all unlocked pages again"""
+        with self._lock:
+            self._unlocked.clear()
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_store() -> PasswordStore:
+    """Return the process wide password store, creating it on first use"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = PasswordStore()
+        return _default_store
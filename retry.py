@@ -0,0 +1,203 @@
+"""Retry policy with jittered exponential back-off and a shared client side rate limiter for google drive calls"""
+
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'sharingRateLimitExceeded')
+
+
+def _error_details(err: Exception):
+    """Get status, body and Retry-After header of an api error.
+
+    Works for googleapiclient HttpErrors as well as agdrive.AsyncDriveErrors
+    :return: tuple of status (None for non-http errors), body bytes or str, Retry-After header value or None"""
+    resp = getattr(err, 'resp', None)
+    if resp is not None:    # googleapiclient HttpError, resp is a httplib2 response with lower case header keys
+        return resp.status, err.content, resp.get('retry-after')
+    return getattr(err, 'status', None), getattr(err, 'content', None), getattr(err, 'retry_after', None)
+
+
+def error_reason(err: Exception):
+    """:return: reason of the first error in the json body of an api error, None if there is none"""
+    _, content, _ = _error_details(err)
+    try:
+        return json.loads(content).get('error').get('errors')[0].get('reason')
+    except (TypeError, ValueError, AttributeError, IndexError):
+        return None
+
+
+def is_rate_limited(err: Exception) -> bool:
+    """:return: True if err means drive wants us to slow down"""
+    status, _, _ = _error_details(err)
+    return status == 429 or (status == 403 and error_reason(err) in RATE_LIMIT_REASONS)
+
+
+def is_retryable(err: Exception) -> bool:
+    """:return: True if the call that raised err may succeed when it is tried again"""
+    if isinstance(err, (ConnectionError, TimeoutError)):
+        return True
+    aiohttp = sys.modules.get('aiohttp')    # Only imported by agdrive, and slow to import
+    if aiohttp is not None and isinstance(err, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return True     # Includes ServerDisconnectedError, and connections dropped while reading the body
+    status, _, _ = _error_details(err)
+    return status in RETRY_STATUSES or is_rate_limited(err)
+
+
+def retry_after(err: Exception):
+    """:return: seconds the server asked us to wait with a Retry-After header, None if it did not"""
+    _, _, value = _error_details(err)
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils  # Rarely needed, and slow to import
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Thread safe token bucket limiting the rate of api calls of a whole process.
+
+    The rate adapts: it is halved whenever drive reports rate limiting and slowly grows back to max_rate on success."""
+
+    def __init__(self, rate: float = 10.0, capacity: float = 10.0, min_rate: float = 0.5):
+        """
+        :param rate: maximum number of calls per second
+        :param capacity: maximum number of calls that can burst at once
+        :param min_rate: lowest rate the bucket slows down to when throttled"""
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        """Take tokens from the bucket, going into debt if there are not enough
+
+        :return: seconds the caller has to wait before it may make its calls"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self, tokens: float = 1):
+        """Block until tokens may be used"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: float = 1):
+        """Wait without blocking the event loop until tokens may be used"""
+        import asyncio  # Only imported by async callers, it takes long to import
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def throttle(self):
+        """Halve the rate after drive reported rate limiting"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeed(self):
+        """Let the rate grow back towards max_rate after a successful call"""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class RetryPolicy:
+    """Retry a call on transient errors with jittered exponential back-off.
+
+    The back-off slot time is the larger of base_delay and the duration of the failed attempt, so large transfers
+    back off proportionally longer. A Retry-After header from the server is always respected."""
+
+    def __init__(self, max_tries: int = 8, base_delay: float = 0.1, max_delay: float = 32.0):
+        """
+        :param max_tries: how often a call is tried before the last error is raised
+        :param base_delay: minimum back-off slot time in seconds
+        :param max_delay: maximum back-off in seconds, not counting Retry-After"""
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, err: Exception = None, elapsed: float = 0.0) -> float:
+        """Seconds to wait before the next try
+
+        :param attempt: number of failed tries so far, starting at 1
+        :param err: error of the failed try
+        :param elapsed: seconds the failed try took"""
+        slot_time = max(self.base_delay, elapsed)
+        delay = random.uniform(0, min(self.max_delay, slot_time * 2**attempt))     # Full jitter
+        server_delay = retry_after(err) if err is not None else None
+        if server_delay is not None:
+            delay = max(delay, server_delay)
+        return delay
+
+    def _failed(self, err: Exception, attempt: int, limiter: TokenBucket) -> bool:
+        """Handle a failed try
+
+        :return: True if the call should be tried again"""
+        if not is_retryable(err) or attempt >= self.max_tries:
+            return False
+        if limiter is not None and is_rate_limited(err):
+            limiter.throttle()
+        logging.debug('Try {} failed, retrying: {}'.format(attempt, err))
+        return True
+
+    def call(self, function, limiter: TokenBucket = None, tokens: float = 1):
+        """Call function until it succeeds, a non-retryable error occurs or max_tries is reached
+
+        :param function: function without arguments to call
+        :param limiter: Optional rate limiter to take tokens from before every try
+        :param tokens: number of tokens one try takes, e.g. the number of calls in a batch
+        :return: result of function
+        :raise the last error if all tries failed"""
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire(tokens)
+            start = time.monotonic()
+            try:
+                result = function()
+            except Exception as err:
+                attempt += 1
+                if not self._failed(err, attempt, limiter):
+                    raise
+                time.sleep(self.delay(attempt, err, time.monotonic() - start))
+            else:
+                if limiter is not None:
+                    limiter.succeed()
+                return result
+
+    async def call_async(self, coroutine_function, limiter: TokenBucket = None, tokens: float = 1):
+        """Asynchronous variant of call. coroutine_function is called without arguments and awaited"""
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await limiter.acquire_async(tokens)
+            start = time.monotonic()
+            try:
+                result = await coroutine_function()
+            except Exception as err:
+                attempt += 1
+                if not self._failed(err, attempt, limiter):
+                    raise
+                import asyncio
+                await asyncio.sleep(self.delay(attempt, err, time.monotonic() - start))
+            else:
+                if limiter is not None:
+                    limiter.succeed()
+                return result
@@ -0,0 +1,185 @@
+#! python3
+"""Key rotation: re-encrypt every local note page and the password file with a new key, in parallel worker processes.
+
+The rotation is checkpointed, so an interrupted rotation continues where it stopped when it is run again. The new key
+is kept in key.next until every file is converted, then it replaces key.key and the old key is added to key.old, so
+anything still encrypted with it, like the journal or files on other devices, can be decrypted. Edits that are not
+compacted into their page yet are compacted first. Only the converted files are uploaded again, through the journal.
+
+Other devices need the new key.key and key.old before they can read the converted files.
+Rotate the key with: python rotation.py"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os.path
+
+from cryptography.fernet import Fernet
+
+import encryption
+import journal
+import page
+import sync
+import upload_queue
+
+CHECKPOINT = '.rotation.json'
+PASSWORD_FILE = 'password.txt'
+
+
+def _write_atomic(location: str, data: bytes):
+    with open(location + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(location + '.tmp', location)
+
+
+def _reencrypt(location: str) -> bool:
+    """Re-encrypt the file at location with the current key. Runs in a worker process, see encryption.use_keys
+
+    :return: True if the file was converted, False if it already was encrypted with the current key"""
+    with open(location, 'rb') as f:
+        data = f.read()
+    if encryption.payload_key_id(data) == encryption.key_id(encryption._current_key()):
+        return False
+    _write_atomic(location, encryption.encrypt(encryption.decrypt(data)))
+    return True
+
+
+class Rotation:
+    """A key rotation of the files in one local folder, with its checkpoint"""
+
+    def __init__(self, file_path: str = 'Storage', key_path: str = './'):
+        """
+        :param file_path: local folder of the note pages and the password file
+        :param key_path: folder of key.key, key.old and key.next"""
+        self.file_path = file_path
+        self.key_path = key_path
+        self.checkpoint_location = os.path.join(file_path, CHECKPOINT)
+        try:
+            with open(self.checkpoint_location) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {'converted': [], 'uploaded': [], 'switched': False}
+
+    def _save_state(self):
+        with open(self.checkpoint_location + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.checkpoint_location + '.tmp', self.checkpoint_location)
+
+    def _key_file(self, file_name: str) -> str:
+        return os.path.join(self.key_path, file_name)
+
+    def _next_key(self) -> bytes:
+        """:return: the new key, generating it if the rotation just started"""
+        try:
+            with open(self._key_file(encryption.NEXT_KEY_FILE), 'rb') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            key = Fernet.generate_key()
+            _write_atomic(self._key_file(encryption.NEXT_KEY_FILE), key)
+            return key
+
+    def files(self) -> list:
+        """:return: names of the local files to convert: every page and the password file"""
+        return sorted(name for name in os.listdir(self.file_path)
+                      if not name.startswith('.') and not name.endswith('.tmp')
+                      and os.path.isfile(os.path.join(self.file_path, name)))
+
+    def compact_logs(self):
+        """Compact the pages with edit logs, so their edits are re-encrypted with them. An edit log only applies to
+        the page file it was saved on, and would be rejected after the page file is re-encrypted"""
+        for name in sorted(page.logged_pages(self.file_path)):
+            page.PageSession(name, self.file_path).compact()
+            if name in self.state['converted']:     # Compacted with the old key again
+                self.state['converted'].remove(name)
+                self._save_state()
+
+    def convert(self, workers: int = None) -> dict:
+        """Re-encrypt every file not converted yet with the new key, in worker processes. Progress is checkpointed
+        after every file
+
+        :param workers: number of worker processes. If None, one per CPU
+        :return: dict of file name to the error of every file that could not be converted"""
+        self.compact_logs()
+        new_key = self._next_key()
+        old_keys = list(encryption._keyring().values())
+        todo = [name for name in self.files() if name not in self.state['converted']]
+        failures = {}
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=encryption.use_keys,
+                                                    initargs=(new_key, old_keys)) as pool:
+            futures = {pool.submit(_reencrypt, os.path.join(self.file_path, name)): name for name in todo}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                except Exception as err:
+                    logging.error('Could not re-encrypt "{}": {}'.format(name, err))
+                    failures[name] = err
+                else:
+                    self.state['converted'].append(name)
+                    self._save_state()
+        return failures
+
+    def switch_keys(self):
+        """Make the new key the current key, and keep the old key in key.old. Safe to repeat after an interruption"""
+        if self.state['switched']:
+            return
+        with open(self._key_file('key.key'), 'rb') as f:
+            old_key = f.read().strip()
+        if old_key not in encryption._load_other_keys(self.key_path):
+            with open(self._key_file(encryption.OLD_KEYS_FILE), 'ab') as f:
+                f.write(old_key + b'\n')
+        os.replace(self._key_file(encryption.NEXT_KEY_FILE), self._key_file('key.key'))
+        encryption.convert.key = None   # Loaded again with the new key on next use
+        self.state['switched'] = True
+        self._save_state()
+
+    def upload(self):
+        """Journal the upload of every converted file not uploaded yet, and wait for the uploads"""
+        manifest = sync.Manifest(os.path.join(self.file_path, '.manifest.json'))
+        for name in self.state['converted']:
+            if name in self.state['uploaded']:
+                continue
+            with open(os.path.join(self.file_path, name), 'rb') as f:
+                data = f.read()
+            if name == PASSWORD_FILE:
+                journal.record('rotate key', 'Password', name, self.file_path, data)
+            else:
+                journal.record('rotate key', 'Notes', name, self.file_path, data, manifest)
+            self.state['uploaded'].append(name)     # The journal retries the upload if it fails now
+            self._save_state()
+        upload_queue.get_queue().flush()
+
+    def run(self, workers: int = None) -> bool:
+        """Convert, switch keys and upload, continuing an interrupted rotation
+
+        :return: True if the rotation finished, False if some files could not be converted and it must be run again"""
+        if not self.state['switched']:
+            failures = self.convert(workers)
+            if failures:
+                return False
+            self.switch_keys()
+        self.upload()
+        os.remove(self.checkpoint_location)
+        return True
+
+
+def main():
+    import gdrive
+    import note
+    from idcache import IdCache
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, default one per CPU')
+    args = parser.parse_args()
+    file_path = 'Storage'
+    gdrive.set_session(gdrive.DriveSession(id_cache=IdCache(path=os.path.join(file_path, '.idcache.json'))))
+    journal.default_layout = note.LAYOUT
+    if Rotation(file_path).run(args.workers):
+        print('Key rotated, copy key.key and key.old to your other devices')
+    else:
+        print('Some files could not be re-encrypted, run again to retry them')
+
+
+if __name__ == '__main__':
+    main()
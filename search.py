@@ -0,0 +1,316 @@
+"""Full-text search across all note pages, with a persistent encrypted inverted index.
+
+The index maps every token to the note numbers holding it on every page, so queries only read the index, and only the
+pages with matches are read to show them. Saved edits update the index incrementally, see page.PageSession.save, and
+pages that changed otherwise, e.g. by a download, are indexed again by refresh.
+
+Changes are appended to an encrypted log next to the index, so saving costs as much as the change, and the log is
+only compacted into the index once it grew larger than the index."""
+
+import bisect
+import logging
+import os.path
+import json
+import re
+import threading
+
+import encryption
+
+_TOKEN = re.compile(r'\w+')
+COMPACT_LOG_SIZE = 1 << 20  # Bytes the log may always grow to before it is compacted, however small the index is
+
+
+def tokens(text: str) -> set:
+    """:return: the lower case words of text"""
+    return set(_TOKEN.findall(text.lower()))
+
+
+def _postings(lines: list) -> dict:
+    """:return: dict of token to the sorted numbers of the lines holding it"""
+    postings = {}
+    for number, line in enumerate(lines):
+        for token in tokens(line):
+            postings.setdefault(token, []).append(number)
+    return postings
+
+
+class SearchIndex:
+    """Inverted index of the notes of all pages, stored encrypted. Thread safe.
+
+    Changes are only kept in memory until save(). The fingerprint of every page tells refresh whether the index
+    still matches the page, so an index that was not saved, e.g. after a crash, is repaired on the next refresh.
+    refresh only computes fingerprints of pages whose page.signature changed since the last refresh.
+
+    The postings of every token are stored as one json string, and only parsed when a query or an edit needs them, so
+    loading the index does not build the postings of every token. Changes are recorded without loading the index at
+    all, so saving the edits of a page does not decrypt it. Replaying the log on the index it was already compacted
+    into, after a crash, is harmless: edits of a page whose fingerprint does not match drop the page, and refresh
+    indexes it again."""
+
+    def __init__(self, path: str):
+        """
+        :param path: file the index is stored in. Its log is stored in path + '.log'"""
+        self.path = path
+        self.log_path = path + '.log'
+        self._lock = threading.RLock()
+        self._pages = None      # page name -> {'id', 'fingerprint', 'signature', 'lines': note count, 'tokens': set}
+        self._names = {}        # page id -> page name
+        self._next_id = 0
+        self._postings = {}     # token -> {page id: sorted numbers of its notes holding the token}, or its json
+        self._unsaved = []      # json of the changes since the last save
+
+    def _index(self) -> dict:
+        """Return the indexed pages, loading the index and replaying its log on first use"""
+        with self._lock:
+            if self._pages is None:
+                try:
+                    with open(self.path, 'rb') as f:
+                        index = json.loads(encryption.decrypt(f.read()))
+                except FileNotFoundError:
+                    index = {}
+                if set(index) != {'pages', 'postings'}:
+                    index = {'pages': {}, 'postings': {}}   # An index of the notes themselves, redone by refresh
+                self._pages, self._postings = index['pages'], index['postings']
+                self._names = {entry['id']: name for name, entry in self._pages.items()}
+                self._next_id = max(self._names, default=-1) + 1
+                for change in self._logged_changes() + [json.loads(change) for change in self._unsaved]:
+                    self._apply(change)
+            return self._pages
+
+    def _logged_changes(self) -> list:
+        changes = []
+        try:
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        changes.extend(json.loads(encryption.decrypt_line(line)))
+                    except (encryption.InvalidToken, ValueError) as err:
+                        # Torn by a crash. The pages it changed no longer match their fingerprint, see refresh
+                        logging.warning('Skipped a damaged line of the search index log: {}'.format(err))
+        except FileNotFoundError:
+            pass
+        return changes
+
+    def _token(self, token: str, create: bool = False) -> dict:
+        """:return: the postings of token, parsed. None if no note holds it, unless create"""
+        pages = self._postings.get(token)
+        if isinstance(pages, str):
+            pairs = json.loads(pages)   # [page id, numbers, page id, numbers, ...], the shortest json for it
+            pages = self._postings[token] = dict(zip(pairs[::2], pairs[1::2]))
+        elif pages is None and create:
+            pages = self._postings[token] = {}
+        return pages
+
+    @staticmethod
+    def _tokens(entry: dict) -> set:
+        """:return: the tokens of the notes of an indexed page, parsed"""
+        if isinstance(entry['tokens'], str):
+            entry['tokens'] = set(entry['tokens'].split())
+        return entry['tokens']
+
+    def _unpost(self, page_id: int, token: str):
+        pages = self._token(token)
+        del pages[page_id]
+        if not pages:
+            del self._postings[token]
+
+    def _drop(self, name: str):
+        entry = self._pages.pop(name, None)
+        if entry is not None:
+            del self._names[entry['id']]
+            for token in self._tokens(entry):
+                self._unpost(entry['id'], token)
+
+    def _change(self, change: dict):
+        """Apply a change to the loaded index, and keep it for the log. Must be called with the lock held"""
+        self._unsaved.append(json.dumps(change))    # Now, as the postings of the change are edited later
+        if self._pages is not None:
+            self._apply(change)
+
+    def _apply(self, change: dict):
+        name = change['name']
+        if change['op'] == 'set':
+            self._drop(name)
+            page_id = self._next_id
+            self._next_id += 1
+            self._names[page_id] = name
+            self._pages[name] = {'id': page_id, 'fingerprint': change['fingerprint'],
+                                 'signature': change['signature'], 'lines': change['lines'],
+                                 'tokens': set(change['postings'])}
+            for token, numbers in change['postings'].items():
+                self._token(token, create=True)[page_id] = numbers
+        elif change['op'] == 'edits':
+            entry = self._pages.get(name)
+            if entry is None or entry['fingerprint'] != change['previous']:
+                # Not indexed yet, or the index was stale already. refresh indexes the whole page
+                self._drop(name)
+                return
+            for op, index, note in change['edits']:
+                if op == 'i':
+                    self._insert(entry, index, note)
+                elif op == 'd':
+                    self._delete(entry, index)
+                elif op == 'p':
+                    for token in self._tokens(entry):
+                        self._unpost(entry['id'], token)
+                    entry['tokens'] = set()
+                    entry['lines'] = 0
+            entry['fingerprint'] = change['fingerprint']
+        elif change['op'] == 'signature':
+            entry = self._pages.get(name)
+            if entry is not None and entry['fingerprint'] == change['fingerprint']:
+                entry['signature'] = change['signature']
+        else:
+            self._drop(name)
+
+    def _insert(self, entry: dict, index: int, note: str):
+        page_tokens = self._tokens(entry)
+        if index < entry['lines']:  # Not added at the end, so the numbers of the notes after it change
+            for token in page_tokens:
+                numbers = self._token(token)[entry['id']]
+                for position in range(bisect.bisect_left(numbers, index), len(numbers)):
+                    numbers[position] += 1
+        for token in tokens(note):
+            bisect.insort(self._token(token, create=True).setdefault(entry['id'], []), index)
+            page_tokens.add(token)
+        entry['lines'] += 1
+
+    def _delete(self, entry: dict, index: int):
+        page_tokens = self._tokens(entry)
+        for token in list(page_tokens):
+            numbers = self._token(token)[entry['id']]
+            start = bisect.bisect_left(numbers, index)
+            if start < len(numbers) and numbers[start] == index:
+                del numbers[start]
+                if not numbers:
+                    self._unpost(entry['id'], token)
+                    page_tokens.discard(token)
+                    continue
+            for position in range(start, len(numbers)):
+                numbers[position] -= 1
+        entry['lines'] -= 1
+
+    def set_page(self, name: str, lines: list, page_fingerprint: str, signature: list = None):
+        """Index all notes of a page, replacing its old notes
+
+        :param signature: Optional page.signature of the page files the notes were read from"""
+        with self._lock:
+            self._change({'op': 'set', 'name': name, 'fingerprint': page_fingerprint, 'signature': signature,
+                          'lines': len(lines), 'postings': _postings(lines)})
+
+    def apply_edits(self, name: str, edits: list, previous_fingerprint: str, page_fingerprint: str):
+        """Apply the edits of a page session to the notes of a page, see page.PageSession._apply
+
+        :param edits: list of [op, index, note] edits
+        :param previous_fingerprint: fingerprint of the page before the edits
+        :param page_fingerprint: fingerprint of the page after the edits"""
+        with self._lock:
+            self._change({'op': 'edits', 'name': name, 'edits': edits, 'previous': previous_fingerprint,
+                          'fingerprint': page_fingerprint})
+
+    def remove(self, name: str):
+        """Remove a page from the index, e.g. because it was deleted"""
+        with self._lock:
+            self._change({'op': 'remove', 'name': name})
+
+    def refresh(self, file_path: str, pages: list) -> int:
+        """Index the pages whose files changed since they were indexed, and remove pages that no longer exist.
+        Only the changed pages are decrypted, and only pages whose files were written since the last refresh are read
+
+        :param file_path: local folder of the pages
+        :param pages: names of all pages
+        :return: number of pages indexed again"""
+        import page     # page imports this module
+        with self._lock:
+            indexed = self._index()
+            for name in set(indexed) - set(pages):
+                self.remove(name)
+        refreshed = 0
+        for name in pages:
+            signature = page.signature(name, file_path)
+            with self._lock:
+                entry = indexed.get(name)
+                if entry is not None and entry.get('signature') == signature:
+                    continue
+            current = page.fingerprint(name, file_path)
+            with self._lock:
+                entry = indexed.get(name)
+                if entry is not None and entry['fingerprint'] == current:
+                    # Indexed by saves of the page, see apply_edits
+                    self._change({'op': 'signature', 'name': name, 'fingerprint': current, 'signature': signature})
+                    continue
+            self.set_page(name, page.PageSession(name, file_path).notes, current, signature)
+            refreshed += 1
+        return refreshed
+
+    def search(self, query: str, visible=None) -> list:
+        """Find the notes holding every word of query
+
+        :param visible: Optional function that tells if a page may be searched, e.g. because it is unlocked
+        :return: list of (page name, note number) of the matching notes, ordered by page and note number"""
+        words = tokens(query)
+        if not words:
+            return []
+        with self._lock:
+            self._index()
+            postings = [self._token(word) or {} for word in words]
+            results = []
+            for name, page_id in sorted((self._names[page_id], page_id)
+                                        for page_id in set(postings[0]).intersection(*postings[1:])):
+                if visible is not None and not visible(name):
+                    continue
+                numbers = sorted((pages[page_id] for pages in postings), key=len)
+                matches = set(numbers[0]).intersection(*numbers[1:])
+                results.extend((name, number) for number in sorted(matches))
+            return results
+
+    def save(self):
+        """Append the changes since the last save to the log, and compact the log into the index once it grew larger
+        than the index"""
+        with self._lock:
+            if not self._unsaved:
+                return
+            with open(self.log_path, 'ab') as f:
+                f.write(encryption.encrypt_line('[{}]'.format(', '.join(self._unsaved)).encode()) + b'\n')
+                log_size = f.tell()
+            self._unsaved = []
+            try:
+                index_size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                index_size = 0
+            if log_size > max(index_size, COMPACT_LOG_SIZE):
+                self.compact()
+
+    def compact(self):
+        """Write the whole index to its encrypted file, and remove the log"""
+        with self._lock:
+            pages = {name: dict(entry, tokens=entry['tokens'] if isinstance(entry['tokens'], str) else
+                                ' '.join(entry['tokens'])) for name, entry in self._index().items()}
+            postings = {token: token_pages if isinstance(token_pages, str) else
+                        json.dumps([item for pair in token_pages.items() for item in pair], separators=(',', ':'))
+                        for token, token_pages in self._postings.items()}
+            # The fastest level, as the index is only kept locally and rewritten whenever its log grew large
+            data = encryption.encrypt(json.dumps({'pages': pages, 'postings': postings}).encode(), level=1)
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(self.path + '.tmp', self.path)
+            self._unsaved = []  # Applied by _index
+            try:
+                os.remove(self.log_path)
+            except FileNotFoundError:
+                pass
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def get_index(path: str = os.path.join('Storage', '.search-index')) -> SearchIndex:
+    """Return the process wide search index, loading it from path on first use"""
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = SearchIndex(path)
+        return _default_index
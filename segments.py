@@ -0,0 +1,190 @@
+"""Segmented storage of note pages on google drive.
+
+A segmented page is split into content addressed, encrypted segments that are stored as files in the Segments folder.
+On drive, the page itself only holds a small encrypted index of its segments. An edit then uploads just the segments
+it touched and the index, and a download only fetches the segments that are not in the local segment cache yet."""
+
+import hashlib
+import json
+import logging
+import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import encryption
+import gdrive
+
+INDEX_MAGIC = b'NOTES-SEGMENT-INDEX-1\n'    # Prefix of index files. Fernet tokens never start with it
+SEGMENT_FOLDER = 'Segments'
+SEGMENT_LINES = 16      # Average number of lines per segment
+MAX_SEGMENT_LINES = 64
+LOOKUP_NAMES = 50       # Segment names looked up per request, see SegmentStore._lookup
+CACHE_PATH = os.path.join('Storage', '.segments')
+
+
+def split(data: bytes) -> list:
+    """Split page content into segments at content defined boundaries: a segment ends after a line whose hash is
+    divisible by SEGMENT_LINES, or after MAX_SEGMENT_LINES lines. Inserting or removing a line therefore only changes
+    the segment that contains it, not all segments after it
+
+    :return: list of segments, which joined give data again"""
+    segments = []
+    current = []
+    for line in encryption.split_lines(data):
+        current.append(line)
+        digest = hashlib.md5(line).digest()
+        if len(current) >= MAX_SEGMENT_LINES or int.from_bytes(digest[:4], 'big') % SEGMENT_LINES == 0:
+            segments.append(b''.join(current))
+            current = []
+    if current:
+        segments.append(b''.join(current))
+    return segments
+
+
+def is_index(data: bytes) -> bool:
+    """:return: True if data is a segment index, rather than a whole encrypted page"""
+    return data.startswith(INDEX_MAGIC)
+
+
+class SegmentStore:
+    """Segments on google drive, with a local cache of the encrypted segments. Thread safe.
+
+    Segments are named by the keyed hash of their plaintext, so equal segments are stored once and never change."""
+
+    def __init__(self, cache_path: str = CACHE_PATH, parent_folder: str = SEGMENT_FOLDER,
+                 session: gdrive.DriveSession = None):
+        """
+        :param cache_path: local folder the encrypted segments are cached in
+        :param parent_folder: remote folder the segments are stored in
+        :param session: Drive session to use. If None, the default session is used"""
+        self.cache_path = cache_path
+        self.parent_folder = parent_folder
+        self.session = session
+        self._remote = {}       # segment name -> remote file id, of the segments looked up or uploaded so far
+        self._lock = threading.Lock()
+
+    def _lookup(self, segment_ids: list) -> dict:
+        """Look up the segments that are not known yet by name, LOOKUP_NAMES names per request. Segments are content
+        addressed, so a known segment never changes and the whole folder never has to be listed
+
+        :return: dict of the names of those segment_ids that are on drive to their file ids
+        :raise ConnectionError if the segments could not be looked up"""
+        with self._lock:
+            unknown = sorted({segment_id for segment_id in segment_ids if segment_id not in self._remote})
+        if unknown:
+            gdrive.ensure_folder(self.parent_folder, self.session)   # Else list_files would search all of drive
+        for start in range(0, len(unknown), LOOKUP_NAMES):
+            files = gdrive.list_files(self.parent_folder, session=self.session,
+                                      file_names=unknown[start:start + LOOKUP_NAMES])
+            if files is None:
+                raise ConnectionError('Could not look up the segments in "{}"'.format(self.parent_folder))
+            with self._lock:
+                self._remote.update((file['name'], file['id']) for file in files)
+        with self._lock:
+            return {segment_id: self._remote[segment_id] for segment_id in segment_ids if segment_id in self._remote}
+
+    def _cache_file(self, segment_id: str) -> str:
+        return os.path.join(self.cache_path, segment_id)
+
+    def _upload(self, segment_id: str, segment: bytes):
+        encrypted = encryption.encrypt(segment)
+        with open(self._cache_file(segment_id), 'wb') as f:
+            f.write(encrypted)
+        folder_id = gdrive.ensure_folder(self.parent_folder, self.session)
+        # Not save_file: _lookup already knows the segment is not on drive, so there is nothing to update
+        file = gdrive._upload_file(gdrive._get_service(self.session), segment_id, [folder_id], data=encrypted,
+                                   session=self.session)
+        if file is None:
+            raise ConnectionError('Could not upload segment {}'.format(segment_id))
+        with self._lock:
+            self._remote[segment_id] = file['id']
+
+    def save_page(self, data: bytes) -> bytes:
+        """Upload the segments of a page that are not on drive yet
+
+        :param data: plaintext content of the page
+        :return: encrypted index of the page, to be saved as the page file
+        :raise ConnectionError if a segment could not be uploaded"""
+        parts = split(data)
+        segment_ids = [encryption.content_id(segment) for segment in parts]    # In order, with repeated segments
+        segments = dict(zip(segment_ids, parts))    # Equal segments are only uploaded once
+        remote = self._lookup(list(segments))
+        missing = [(segment_id, segment) for segment_id, segment in segments.items() if segment_id not in remote]
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+        if missing:
+            logging.info('Uploading {} of {} segments'.format(len(missing), len(segments)))
+            with ThreadPoolExecutor(max_workers=min(gdrive.DOWNLOAD_WORKERS, len(missing))) as executor:
+                for future in [executor.submit(self._upload, *segment) for segment in missing]:
+                    future.result()
+        return INDEX_MAGIC + encryption.encrypt(json.dumps({'segments': segment_ids}).encode())
+
+    def _cached(self, segment_id: str):
+        """:return: plaintext of a cached segment, or None if it is not cached or does not match its id, e.g. because
+        an older version left a partial download in the cache"""
+        try:
+            with open(self._cache_file(segment_id), 'rb') as f:
+                segment = encryption.decrypt(f.read())
+        except (FileNotFoundError, encryption.InvalidToken, ValueError):
+            return None
+        if encryption.content_id(segment) != segment_id:
+            return None
+        return segment
+
+    def load_page(self, index: bytes) -> bytes:
+        """Download the segments of a page that are not cached yet, and join them. Every segment is checked against
+        its id, so a broken cached segment is downloaded again instead of silently dropping lines
+
+        :param index: encrypted index of the page, as returned by save_page
+        :return: plaintext content of the page
+        :raise ConnectionError if a segment could not be downloaded"""
+        segment_ids = json.loads(encryption.decrypt(index[len(INDEX_MAGIC):]))['segments']
+        content = {}
+        for segment_id in set(segment_ids):
+            segment = self._cached(segment_id)
+            if segment is not None:
+                content[segment_id] = segment
+        missing = sorted(set(segment_ids) - content.keys())
+        if missing:
+            remote = self._lookup(missing)
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            files = [{'id': remote[segment_id], 'name': segment_id} for segment_id in missing if segment_id in remote]
+            failures = gdrive.download_files(files, self.cache_path, session=self.session)
+            if failures or len(files) < len(missing):
+                raise ConnectionError('Could not download {} segments'.format(len(missing) - len(files) +
+                                                                              len(failures)))
+            for segment_id in missing:
+                segment = self._cached(segment_id)
+                if segment is None:
+                    raise ConnectionError('Downloaded segment {} does not match its id'.format(segment_id))
+                content[segment_id] = segment
+        return b''.join(content[segment_id] for segment_id in segment_ids)
+
+    def expand(self, file_location: str):
+        """Replace a downloaded segment index at file_location by the whole encrypted page. Other files are left alone.
+        Pass the temporary path of the download, see sync.FolderSync, so a failure never touches the local page
+
+        :raise ConnectionError if a segment could not be downloaded"""
+        with open(file_location, 'rb') as f:
+            data = f.read()
+        if not is_index(data):
+            return
+        page = encryption.encrypt(self.load_page(data))     # Before opening the file, so a failure leaves it alone
+        temp_location = file_location + '.tmp'
+        with open(temp_location, 'wb') as f:
+            f.write(page)
+        os.replace(temp_location, file_location)
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_store() -> SegmentStore:
+    """Return the process wide segment store of the default drive session, creating it on first use"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = SegmentStore()
+        return _default_store
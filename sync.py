@@ -0,0 +1,279 @@
+"""Incremental synchronisation of a google drive folder with a local folder, based on a manifest of remote metadata"""
+
+import json
+import logging
+import os.path
+import threading
+
+import encryption
+import gdrive
+
+MANIFEST_FIELDS = ('id', 'md5Checksum', 'modifiedTime', 'version')
+
+
+class Manifest:
+    """Record of the remote metadata of every synced file, as of the last time it was downloaded or uploaded.
+
+    A file only needs to be downloaded again if its remote metadata differs from the recorded one.
+    Thread safe, and written to disk on every change."""
+
+    def __init__(self, path: str):
+        """
+        :param path: json file the manifest is stored in"""
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        try:
+            with open(path, 'r') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as err:
+            logging.warning('Ignoring unreadable sync manifest {}: {}'.format(path, err))
+
+    def names(self):
+        """:return: list of all file names in the manifest"""
+        with self._lock:
+            return list(self._entries)
+
+    def is_current(self, file: dict) -> bool:
+        """Check if the recorded metadata of a remote file still matches
+
+        :param file: remote file metadata with name and MANIFEST_FIELDS, as returned by gdrive.list_files
+        :return: True if the file is unchanged since it was last recorded"""
+        with self._lock:
+            entry = self._entries.get(file['name'])
+        return entry is not None and all(entry.get(field) == file.get(field) for field in MANIFEST_FIELDS)
+
+    def update(self, *files: dict):
+        """Record the metadata of remote files. The manifest is written once for all of them
+
+        :param files: remote file metadata with name and MANIFEST_FIELDS"""
+        if not files:
+            return
+        with self._lock:
+            for file in files:
+                self._entries[file['name']] = {field: file.get(field) for field in MANIFEST_FIELDS}
+            self._save()
+
+    def remove(self, *names: str):
+        """Forget the files with names. The manifest is written once for all of them"""
+        with self._lock:
+            removed = [name for name in names if self._entries.pop(name, None) is not None]
+            if removed:
+                self._save()
+
+    def _save(self):
+        """Atomically write the manifest to disk. Must be called with the lock held"""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(temp_path, self.path)
+
+
+class FolderSync:
+    """Sync of a google drive folder into a local folder that runs in the background, see sync_folder.
+
+    The remote listing is available as soon as it arrived. Changed files are then downloaded in priority order, and
+    every file can be used as soon as its own download finished, while the others continue in the background.
+    A file somebody waits for is moved to the front of the queue."""
+
+    def __init__(self, parent_folder: str, target_path: str, manifest: Manifest, priority=None,
+                 max_workers: int = gdrive.DOWNLOAD_WORKERS, session: gdrive.DriveSession = None,
+                 keep_local: set = frozenset(), on_download=None):
+        """
+        :param parent_folder: name of the remote folder to sync
+        :param target_path: local folder to sync into
+        :param manifest: manifest of the files in target_path
+        :param priority: Optional function that sorts a list of file names, most urgent first
+        :param max_workers: maximum number of concurrent downloads
+        :param session: Drive session to use. If None, the default session is used
+        :param keep_local: names of local files that must neither be replaced nor deleted
+        :param on_download: Optional function called with the temporary local path of every downloaded file before
+        it replaces the local copy, e.g. segments.SegmentStore.expand"""
+        self.parent_folder = parent_folder
+        self.target_path = target_path
+        self.manifest = manifest
+        self.priority = priority
+        self.max_workers = max_workers
+        self.session = session if session is not None else gdrive.get_session()
+        self.keep_local = keep_local
+        self.on_download = on_download
+        self.failures = {}      # file name -> exception that made its download fail
+        self._files = None
+        self._queue = []        # files waiting to be downloaded, next one first
+        self._unfinished = set()    # names of files queued or being downloaded
+        self._listed = threading.Event()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='folder-sync', daemon=True)
+
+    def start(self):
+        """Start syncing in the background. :return: self"""
+        self._thread.start()
+        return self
+
+    def files(self, timeout: float = None):
+        """Wait until the remote folder is listed
+
+        :return: list of remote file metadata dicts, or None if the remote folder could not be listed"""
+        self._listed.wait(timeout)
+        return self._files
+
+    def wait_for(self, file_name: str, timeout: float = None) -> bool:
+        """Download file_name next if it is still queued, and wait until its local copy is up to date
+
+        :return: True if the local copy is up to date, False if its download failed or timed out"""
+        self._listed.wait(timeout)
+        with self._condition:
+            for i, file in enumerate(self._queue):
+                if file['name'] == file_name:
+                    self._queue.insert(0, self._queue.pop(i))
+                    break
+            if not self._condition.wait_for(lambda: file_name not in self._unfinished, timeout):
+                return False
+            return file_name not in self.failures
+
+    def join(self, timeout: float = None):
+        """Wait until the whole folder is synced
+
+        :return: list of remote file metadata dicts, or None if the remote folder could not be listed"""
+        self._thread.join(timeout)
+        return self._files
+
+    def _run(self):
+        try:
+            files = gdrive.list_files(self.parent_folder, fields='({})'.format(gdrive.FILE_FIELDS), file_type='file',
+                                      session=self.session)
+            if files is None:
+                return
+
+            if not os.path.isdir(self.target_path):
+                os.makedirs(self.target_path)
+
+            changed = {file['name']: file for file in files if file['name'] not in self.keep_local and
+                       (not self.manifest.is_current(file) or
+                        not os.path.exists(os.path.join(self.target_path, file['name'])))}
+            order = self.priority(list(changed)) if self.priority is not None else list(changed)
+            with self._condition:
+                self._queue = [changed[name] for name in order]
+                self._unfinished = set(changed)
+                self._files = files
+        finally:
+            self._listed.set()
+
+        workers = [threading.Thread(target=self._work, daemon=True)
+                   for _ in range(max(1, min(self.max_workers, len(changed))))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.manifest.update(*[file for file in changed.values() if file['name'] not in self.failures])
+
+        remote_names = {file['name'] for file in files}
+        removed = [name for name in self.manifest.names() if name not in remote_names and name not in self.keep_local]
+        for name in removed:
+            logging.info('"{}" was removed remotely, deleting local copy'.format(name))
+            try:
+                os.remove(os.path.join(self.target_path, name))
+            except FileNotFoundError:
+                pass
+        self.manifest.remove(*removed)
+
+    def _work(self):
+        """Download queued files until the queue is empty"""
+        while True:
+            with self._condition:
+                if not self._queue:
+                    return
+                file = self._queue.pop(0)
+            file_location = os.path.join(self.target_path, file['name'])
+            temp_location = file_location + '.tmp'
+            try:
+                # The local copy is only replaced once the download is complete, so a failed one keeps it intact
+                with open(temp_location, 'wb') as f:
+                    gdrive.download_stream(file['id'], f, session=self.session)
+                if self.on_download is not None:
+                    self.on_download(temp_location)
+                os.replace(temp_location, file_location)
+            except Exception as err:    # One broken file should not abort the whole sync
+                logging.error('Could not download "{}": {}'.format(file['name'], err))
+                self.failures[file['name']] = err
+                try:
+                    os.remove(temp_location)
+                except FileNotFoundError:
+                    pass
+            with self._condition:
+                self._unfinished.discard(file['name'])
+                self._condition.notify_all()
+
+
+def sync_folder(parent_folder: str, target_path: str, manifest: Manifest, max_workers: int = gdrive.DOWNLOAD_WORKERS,
+                session: gdrive.DriveSession = None, keep_local: set = frozenset(), on_download=None):
+    """Bring target_path up to date with parent_folder on google drive with a single listing call.
+
+    Only files that are new or changed remotely are downloaded. Local files that the manifest tracks but that no
+    longer exist remotely are deleted. Local files the manifest does not know about are left alone, and so are the
+    files in keep_local, e.g. because they have local changes that are not uploaded yet.
+
+    :param parent_folder: name of the remote folder to sync
+    :param target_path: local folder to sync into
+    :param manifest: manifest of the files in target_path
+    :param max_workers: maximum number of concurrent downloads
+    :param session: Drive session to use. If None, the default session is used
+    :param keep_local: names of local files that must neither be replaced nor deleted
+    :param on_download: Optional function called with the temporary local path of every downloaded file, see FolderSync
+    :return: list of remote file metadata dicts, or None if the remote folder could not be listed"""
+    return FolderSync(parent_folder, target_path, manifest, max_workers=max_workers, session=session,
+                      keep_local=keep_local, on_download=on_download).start().join()
+
+
+def sync_file(file_name: str, parent_folder: str, target_path: str, manifest: Manifest,
+              session: gdrive.DriveSession = None, on_download=None) -> bool:
+    """Bring a single local file up to date with google drive, without listing the whole folder. It is only
+    downloaded if it changed remotely
+
+    :param on_download: Optional function called with the temporary local path of the file if it was downloaded,
+    before it replaces the local copy
+    :return: True if the local file is up to date or does not exist remotely, False if drive could not be reached or
+    the downloaded file could not be decoded"""
+    files = gdrive.list_files(parent_folder, fields='({})'.format(gdrive.FILE_FIELDS), session=session,
+                              file_name=file_name)
+    if files is None:
+        return False
+    location = os.path.join(target_path, file_name)
+    if not files or (manifest.is_current(files[0]) and os.path.exists(location)):
+        return True
+    os.makedirs(target_path, exist_ok=True)
+    temp_location = location + '.tmp'
+    try:
+        # Like FolderSync, the local copy is only replaced once the download and on_download succeeded
+        with open(temp_location, 'wb') as f:
+            gdrive.download_stream(files[0]['id'], f, session=session)
+        if on_download is not None:
+            on_download(temp_location)
+        os.replace(temp_location, location)
+    except (gdrive.HttpError, encryption.InvalidToken, ValueError) + gdrive.NETWORK_ERRORS as err:
+        # ValueError and InvalidToken: on_download could not decode the file, e.g. a segment index
+        logging.error('Could not download "{}": {}'.format(file_name, err))
+        try:
+            os.remove(temp_location)
+        except FileNotFoundError:
+            pass
+        return False
+    manifest.update(files[0])
+    return True
+
+
+def save_file(file_name: str, parent_folder: str, file_path: str, data: bytes, manifest: Manifest,
+              session: gdrive.DriveSession = None):
+    """Save a file to google drive like gdrive.save_file, and record the new remote metadata in manifest,
+    so the next sync does not download the file again
+
+    :return: metadata of the saved file if successful, None otherwise"""
+    file = gdrive.save_file(file_name, parent_folder, file_path, data, session=session)
+    if file is not None:
+        manifest.update(file)
+    return file
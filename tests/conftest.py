@@ -0,0 +1,51 @@
+"""Shared fixtures. Every test runs in its own directory with a fresh key.key and Storage folder, and the process
+wide singletons of the modules are replaced, so tests never see each other's state"""
+
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import container    # noqa: E402
+import encryption   # noqa: E402
+import fakedrive    # noqa: E402
+import functions    # noqa: E402
+import gdrive       # noqa: E402
+import journal      # noqa: E402
+import passwords    # noqa: E402
+import retry        # noqa: E402
+import search       # noqa: E402
+import segments     # noqa: E402
+import upload_queue     # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workspace(tmp_path, monkeypatch):
+    """Run the test in an empty directory with a fresh encryption key and fresh process wide singletons"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(encryption.convert, 'key', None, raising=False)
+    monkeypatch.setattr(functions._preload_password_file, 'pre_loaded', False, raising=False)
+    monkeypatch.setattr(journal, 'default_layout', journal.PAGES)
+    for module in (container, passwords, segments):
+        monkeypatch.setattr(module, '_default_store', None)
+    monkeypatch.setattr(gdrive, '_default_session', None)
+    monkeypatch.setattr(journal, '_default_journal', None)
+    monkeypatch.setattr(search, '_default_index', None)
+    queue = upload_queue.UploadQueue(debounce=0)
+    monkeypatch.setattr(upload_queue, '_default_queue', queue)
+    os.makedirs('Storage')
+    yield tmp_path
+    queue.flush(timeout=10)
+
+
+@pytest.fixture
+def drive() -> fakedrive.FakeDrive:
+    """Fake drive with empty Notes and Password folders, used by the default drive session"""
+    fake = fakedrive.FakeDrive()
+    fake.notes_id = fake.add_folder('Notes')
+    fake.password_id = fake.add_folder('Password')
+    gdrive.set_session(fake.session(retry_policy=retry.RetryPolicy(base_delay=0.001, max_delay=0.01),
+                                    rate_limiter=retry.TokenBucket(rate=1e6, capacity=1e6)))
+    return fake
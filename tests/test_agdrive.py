@@ -0,0 +1,102 @@
+import asyncio
+import os.path
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+
+import agdrive
+import fakedrive
+import retry
+
+
+def _run(drive: fakedrive.FakeDrive, test):
+    """Run the coroutine function test with a client connected to drive served over local http"""
+    async def main():
+        server = TestServer(fakedrive.rest_app(drive))
+        await server.start_server()
+        try:
+            session = drive.session(retry_policy=retry.RetryPolicy(base_delay=0.001, max_delay=0.01),
+                                    rate_limiter=retry.TokenBucket(rate=1e6, capacity=1e6))
+            async with agdrive.AsyncDriveClient(session, base_url=str(server.make_url('')), token='test') as client:
+                return await test(client)
+        finally:
+            await server.close()
+    return asyncio.run(main())
+
+
+def test_concurrent_saves_lists_and_downloads(drive):
+    names = ['page{}.txt'.format(i) for i in range(20)]
+
+    async def test(client):
+        saved = await asyncio.gather(*(client.save_file(name, 'Notes', name.encode() * 100) for name in names))
+        listed = await client.list_files('Notes', fields='(id, name, md5Checksum)')
+        failures = await client.download_files(listed, 'Storage', max_concurrency=5)
+        return saved, listed, failures
+
+    saved, listed, failures = _run(drive, test)
+    assert all(file is not None and set(file) >= {'id', 'name', 'md5Checksum', 'version'} for file in saved)
+    assert sorted(file['name'] for file in listed) == sorted(names)
+    assert failures == {}
+    for name in names:
+        with open(os.path.join('Storage', name), 'rb') as f:
+            assert f.read() == name.encode() * 100
+        assert drive.find(name)[0]['parents'] == [drive.notes_id]
+
+
+def test_save_updates_existing_file_and_delete_removes_it(drive):
+    async def test(client):
+        first = await client.save_file('a.txt', 'Notes', b'one')
+        second = await client.save_file('a.txt', 'Notes', b'two')
+        assert second['id'] == first['id']
+        assert drive.content(first['id']) == b'two'
+        await client.delete_file('a.txt', 'Notes')
+        return await client.list_files('Notes')
+
+    assert _run(drive, test) == []
+
+
+def test_list_files_follows_pages(drive):
+    drive.page_size = 3
+    for i in range(10):
+        drive.add_file('{}.txt'.format(i), b'', drive.notes_id)
+
+    async def test(client):
+        return await client.list_files('Notes')
+
+    assert len(_run(drive, test)) == 10
+
+
+def test_transient_errors_are_retried(drive):
+    async def test(client):
+        await client.save_file('a.txt', 'Notes', b'data')
+        drive.fail_next(503, 2)
+        return await client.download_files([{'id': drive.find('a.txt')[0]['id'], 'name': 'a.txt'}], 'Storage')
+
+    assert _run(drive, test) == {}
+    with open(os.path.join('Storage', 'a.txt'), 'rb') as f:
+        assert f.read() == b'data'
+
+
+def test_failed_downloads_are_reported_per_file(drive):
+    async def test(client):
+        await client.save_file('a.txt', 'Notes', b'data')
+        return await client.download_files([{'id': drive.find('a.txt')[0]['id'], 'name': 'a.txt'},
+                                            {'id': 'missing', 'name': 'b.txt'}], 'Storage')
+
+    failures = _run(drive, test)
+    assert list(failures) == ['b.txt']
+    assert failures['b.txt'].status == 404
+
+
+def test_save_to_missing_folder_fails(drive):
+    async def test(client):
+        return await client.save_file('a.txt', 'Missing', b'data')
+
+    assert _run(drive, test) is None
+
+
+@pytest.mark.parametrize('err', [aiohttp.ServerDisconnectedError(), aiohttp.ClientConnectionError('reset'),
+                                 aiohttp.ClientPayloadError('truncated')])
+def test_dropped_connections_are_retryable(err):
+    assert retry.is_retryable(err)
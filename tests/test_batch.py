@@ -0,0 +1,24 @@
+import json
+import os.path
+
+import batch
+import encryption
+import sync
+
+
+def test_invalid_operations_fail_alone(drive):
+    with open(os.path.join('Storage', 'a.txt'), 'wb') as f:
+        f.write(encryption.encrypt(b'one\ntwo\n'))
+    operations = [{'op': 'delete', 'page': 'a', 'index': True},
+                  {'op': 'change', 'page': 'a', 'index': '0', 'note': 'x'},
+                  {'op': 'insert', 'page': 'a', 'index': 5, 'note': 'x'},
+                  {'op': 'change', 'page': 'a', 'index': 1},
+                  {'op': 'delete', 'page': 'a', 'index': 0}]
+    files = ['a.txt']
+    results = batch.run([json.dumps(operation) for operation in operations], 'Storage', files,
+                        sync.Manifest('Storage/.manifest.json'))
+
+    assert [result['ok'] for result in results] == [False, False, False, False, True]
+    assert results[0]['error'] == 'invalid note number True'
+    with open(os.path.join('Storage', 'a.txt'), 'rb') as f:
+        assert encryption.decrypt(f.read()) == b'two\n'
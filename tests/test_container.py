@@ -0,0 +1,92 @@
+import io
+import os.path
+
+import container
+import encryption
+import gdrive
+import journal
+import segments
+import sync
+
+PAGE = b''.join(b'note %d\n' % i for i in range(200))
+
+
+def _read(location: str) -> bytes:
+    with open(location, 'rb') as f:
+        return f.read()
+
+
+def _remote_entries(drive) -> dict:
+    packed = container.Container(io.BytesIO(drive.content(drive.find(container.CONTAINER_NAME)[0]['id'])))
+    return {name: packed.read(name) for name in packed.names()}
+
+
+def test_pack_and_read_entries():
+    files = {'Notes/a.txt': b'page a', 'Notes/b.txt': b'', 'Password/password.txt': b'hashes'}
+    packed = container.Container(io.BytesIO(container.pack(files)))
+    assert packed.names() == list(files)
+    assert packed.names('Notes') == ['a.txt', 'b.txt']
+    assert {name: packed.read(name) for name in files} == files
+
+
+def test_saves_from_two_devices_are_merged(drive):
+    os.makedirs('Other')
+    first = container.ContainerStore('Storage')
+    second = container.ContainerStore('Other')
+    assert first.save({'Notes/a.txt': b'a'}) is not None
+    assert second.save({'Notes/b.txt': b'b'}) is not None
+    assert first.save({'Notes/a.txt': b'a2'}) is not None
+    assert second.save({'Notes/c.txt': b'c', 'Notes/b.txt': None}) is not None
+    assert _remote_entries(drive) == {'Notes/a.txt': b'a2', 'Notes/c.txt': b'c'}
+    assert len(drive.find(container.CONTAINER_NAME)) == 1
+
+
+def test_save_fails_while_drive_is_unreachable(drive):
+    store = container.ContainerStore('Storage')
+    store.save({'Notes/a.txt': b'a'})
+    drive.fail_next(400)
+    assert store.save({'Notes/a.txt': b'a2'}) is None
+    assert _remote_entries(drive) == {'Notes/a.txt': b'a'}
+
+
+def test_sync_keeps_unsynced_password_changes(drive):
+    os.makedirs('Other')
+    container.ContainerStore('Other').save({'Notes/a.txt': b'remote page', 'Password/password.txt': b'remote hashes'})
+    with open(os.path.join('Storage', 'password.txt'), 'wb') as f:
+        f.write(b'local hashes')
+    journal.get_journal().append('set password', 'Password', 'password.txt', b'local hashes')
+
+    manifest = sync.Manifest('Storage/.manifest.json')
+    files = container.ContainerSync(container.ContainerStore('Storage'), manifest).start().join()
+    assert files == [{'name': 'a.txt'}]
+    assert _read('Storage/a.txt') == b'remote page'
+    assert _read('Storage/password.txt') == b'local hashes'
+    assert not [name for name in os.listdir('Storage') if name.endswith('.tmp')]
+
+
+def test_migration_packs_expanded_and_unsynced_pages(drive):
+    index = segments.SegmentStore(cache_path='uploader-cache').save_page(PAGE)
+    gdrive.save_file('segmented.txt', 'Notes', data=index)
+    gdrive.save_file('changed.txt', 'Notes', data=encryption.encrypt(b'remote version\n'))
+    gdrive.save_file('password.txt', 'Password', data=b'remote hashes')
+    local = encryption.encrypt(b'local version\n')
+    with open(os.path.join('Storage', 'changed.txt'), 'wb') as f:
+        f.write(local)
+    journal.get_journal().append('add', 'Notes', 'changed.txt', local)
+
+    assert container.migrate_to_container('Storage') is not None
+    entries = _remote_entries(drive)
+    assert encryption.decrypt(entries['Notes/segmented.txt']) == PAGE
+    assert entries['Notes/changed.txt'] == local
+    assert entries['Password/password.txt'] == b'remote hashes'
+
+
+def test_unpacking_deletes_pages_removed_while_packed(drive):
+    gdrive.save_file('kept.txt', 'Notes', data=b'old kept')
+    gdrive.save_file('deleted.txt', 'Notes', data=b'deleted')
+    container.ContainerStore('Storage').save({'Notes/kept.txt': b'new kept', 'Password/password.txt': b'hashes'})
+
+    assert container.migrate_to_pages('Storage')
+    assert drive.find('deleted.txt') == []
+    assert [drive.content(file['id']) for file in drive.find('kept.txt')] == [b'new kept']
+    assert [drive.content(file['id']) for file in drive.find('password.txt')] == [b'hashes']
@@ -0,0 +1,156 @@
+import os.path
+import socket
+import sys
+import threading
+
+import pytest
+
+import batch
+import daemon
+import note
+import page
+import passwords
+import sync
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='The daemon listens on a unix socket')
+
+
+def _serve_once(answer):
+    """Listen on the daemon socket and call answer with the connection of the first request"""
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(daemon.socket_path())
+    server.listen(1)
+
+    def run():
+        connection, _ = server.accept()
+        with connection:
+            connection.makefile('rb').readline()
+            answer(connection)
+        server.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_request_without_daemon():
+    assert daemon.request({'op': 'ping'}) is None
+
+
+def test_request_is_answered():
+    _serve_once(lambda connection: connection.sendall(b'{"ok": true, "pid": 1}\n'))
+    assert daemon.request({'op': 'ping'}, timeout=5) == {'ok': True, 'pid': 1}
+
+
+def test_request_to_a_hanging_daemon_times_out():
+    answered = threading.Event()
+    thread = _serve_once(lambda connection: answered.wait(5))
+    with pytest.raises(daemon.NoAnswer):
+        daemon.request({'op': 'ping'}, timeout=0.05)
+    answered.set()
+    thread.join()
+
+
+def test_request_to_a_daemon_that_stops_while_answering():
+    _serve_once(lambda connection: connection.sendall(b'{"ok": tr'))
+    with pytest.raises(daemon.NoAnswer):
+        daemon.request({'op': 'ping'}, timeout=5)
+
+
+def test_unanswered_note_is_not_added_again(monkeypatch):
+    answered = threading.Event()
+    thread = _serve_once(lambda connection: answered.wait(5))
+    monkeypatch.setattr(daemon, 'REQUEST_TIMEOUT', 0.05)
+    assert daemon.quick_add('todo', 'buy milk') is False     # Not None, which would add it in-process
+    answered.set()
+    thread.join()
+
+
+def test_unanswered_batch_is_not_run_again(monkeypatch):
+    with open('operations', 'w') as f:
+        f.write('{"op": "add", "page": "todo", "note": "buy milk"}\n')
+    monkeypatch.setattr(sys, 'argv', ['batch.py', 'operations'])
+
+    def hung(message, file_path='Storage', timeout=None):
+        raise daemon.NoAnswer('The daemon did not answer')
+
+    monkeypatch.setattr(daemon, 'request', hung)
+    monkeypatch.setattr(batch, 'run', None)     # Fails if the batch runs in-process
+    with pytest.raises(SystemExit) as exit_info:
+        batch.main()
+    assert exit_info.value.code == 1
+
+
+def _daemon() -> daemon.Daemon:
+    """Daemon of the Storage folder that did not sync"""
+    notebook = daemon.Daemon('Storage')
+    notebook.manifest = sync.Manifest(os.path.join('Storage', '.manifest.json'))
+    notebook.files = []
+    return notebook
+
+
+def test_requests_are_handled(drive):
+    notebook = _daemon()
+    assert notebook.handle({'op': 'ping'})['ok']
+    assert not notebook.handle({'op': 'unknown'})['ok']
+    assert not notebook.handle(['not', 'a', 'request'])['ok']
+    assert notebook.handle({'op': 'add', 'page': 'todo'}) == {'ok': False, 'error': 'add needs a page and a note'}
+
+    assert notebook.handle({'op': 'add', 'page': 'todo', 'note': 'buy milk'}) == {'ok': True}
+    assert notebook.handle({'op': 'add', 'page': 'todo', 'note': 'call bob'}) == {'ok': True}
+    assert notebook.files == ['todo.txt']
+    assert page.PageSession('todo.txt').notes == ['buy milk\n', 'call bob\n']
+    assert page.logged_pages() == set()     # Compacted, so uploaded
+
+
+def test_locked_page_needs_its_password(drive):
+    store = passwords.get_store()
+    store.set_password('secret.txt', 'right')
+    store.lock_all()
+    notebook = _daemon()
+    message = {'op': 'add', 'page': 'secret', 'note': 'hidden'}
+    assert notebook.handle(message)['password_required']
+    assert notebook.handle(dict(message, password='wrong')) == {'ok': False, 'error': 'Incorrect password'}
+    assert notebook.handle(dict(message, password='right')) == {'ok': True}
+    assert notebook.handle(message) == {'ok': True}    # Unlocked for a while
+    assert page.PageSession('secret.txt').notes == ['hidden\n', 'hidden\n']
+
+
+def test_quick_add_asks_for_the_password_of_a_locked_page(drive, monkeypatch):
+    store = passwords.get_store()
+    store.set_password('secret.txt', 'right')
+    store.lock_all()
+    notebook = _daemon()
+    server = threading.Thread(target=notebook.serve, daemon=True)
+    server.start()
+    while notebook.server is None or not os.path.exists(daemon.socket_path()):
+        server.join(0.01)
+    prompts = []
+    monkeypatch.setattr(daemon.getpass, 'getpass', lambda prompt: prompts.append(prompt) or 'right')
+    try:
+        assert daemon.quick_add('secret', 'hidden') is True
+        assert len(prompts) == 1
+    finally:
+        assert daemon.request({'op': 'stop'}, timeout=5)['ok']
+        server.join(5)
+    assert page.PageSession('secret.txt').notes == ['hidden\n']
+
+
+def test_requests_are_handled_during_a_resync(drive, monkeypatch):
+    notebook = _daemon()
+    listed = threading.Event()
+    waited = []
+
+    class SlowSync:
+        def join(self):
+            waited.append(listed.wait(5))
+            return [{'name': 'remote.txt'}]
+
+    monkeypatch.setattr(note, 'startup', lambda file_path: (SlowSync(), notebook.manifest))
+    resync = threading.Thread(target=notebook.resync)
+    resync.start()
+    assert notebook.handle({'op': 'add', 'page': 'todo', 'note': 'buy milk'}) == {'ok': True}
+    listed.set()
+    resync.join()
+    assert waited == [True]     # The request did not wait for the sync
+    assert sorted(notebook.files) == ['remote.txt', 'todo.txt']
@@ -0,0 +1,236 @@
+import io
+import os.path
+import threading
+import time
+
+import pytest
+
+import fakedrive
+import gdrive
+import retry
+import sync
+from idcache import IdCache
+
+
+def test_session_builds_one_service_per_thread():
+    built = []
+    session = gdrive.DriveSession(service_factory=lambda: built.append(1) or object())
+    first = session.service()
+    assert session.service() is first
+    other = []
+    thread = threading.Thread(target=lambda: other.append(session.service()))
+    thread.start()
+    thread.join()
+    assert other[0] is not first
+    assert len(built) == 2
+
+
+def test_id_cache_expires_evicts_and_persists(tmp_path):
+    path = str(tmp_path / 'ids.json')
+    cache = IdCache(ttl=None, max_entries=2, path=path)
+    cache.put('a', False, 'p', ['1'])
+    cache.put('b', False, 'p', ['2'])
+    cache.get('a', False, 'p')
+    cache.put('c', False, 'p', ['3'])   # Evicts b, the least recently used
+    assert cache.get('b', False, 'p') is None
+    assert IdCache(ttl=None, path=path).get('a', False, 'p') == ['1']
+    cache.invalidate('a', False, 'p')
+    assert IdCache(ttl=None, path=path).get('a', False, 'p') is None
+    assert IdCache(ttl=0, path=path).get('c', False, 'p') is None
+
+
+def test_cached_lookups_save_requests(drive):
+    gdrive.save_file('a.txt', 'Notes', data=b'one')
+    requests = drive.request_count
+    gdrive.save_file('a.txt', 'Notes', data=b'two')
+    assert drive.request_count - requests == 1     # Only the update, both lookups are cached
+    assert drive.content(drive.find('a.txt')[0]['id']) == b'two'
+
+
+def test_manifest_tracks_remote_metadata(tmp_path):
+    manifest = sync.Manifest(str(tmp_path / 'manifest.json'))
+    file = {'name': 'a.txt', 'id': '1', 'md5Checksum': 'x', 'modifiedTime': 't', 'version': '1'}
+    assert not manifest.is_current(file)
+    manifest.update(file)
+    assert sync.Manifest(manifest.path).is_current(file)
+    assert not manifest.is_current(dict(file, version='2'))
+    manifest.remove('a.txt')
+    assert sync.Manifest(manifest.path).names() == []
+
+
+def test_sync_folder_only_downloads_changes(drive):
+    for i in range(3):
+        drive.add_file('{}.txt'.format(i), b'page %d' % i, drive.notes_id)
+    manifest = sync.Manifest('Storage/.manifest.json')
+    assert len(sync.sync_folder('Notes', 'Storage', manifest)) == 3
+    requests = drive.request_count
+    assert len(sync.sync_folder('Notes', 'Storage', manifest)) == 3
+    assert drive.request_count - requests == 1     # Just the listing
+
+    gdrive.save_file('1.txt', 'Notes', data=b'changed')
+    gdrive.delete_file('2.txt', 'Notes')
+    sync.sync_folder('Notes', 'Storage', manifest)
+    with open('Storage/1.txt', 'rb') as f:
+        assert f.read() == b'changed'
+    assert sorted(manifest.names()) == ['0.txt', '1.txt']
+
+
+@pytest.mark.parametrize('status, retryable', [(500, True), (503, True), (429, True), (403, True), (404, False)])
+def test_retry_policy_retries_transient_errors(status, retryable):
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) == 1:
+            raise fakedrive._http_error(status)
+        return 'done'
+
+    policy = retry.RetryPolicy(base_delay=0.001)
+    if retryable:
+        assert policy.call(call, retry.TokenBucket()) == 'done'
+        assert len(calls) == 2
+    else:
+        with pytest.raises(Exception):
+            policy.call(call)
+        assert len(calls) == 1
+
+
+def test_rate_limit_halves_the_rate():
+    limiter = retry.TokenBucket(rate=10)
+    policy = retry.RetryPolicy(base_delay=0.001)
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) == 1:
+            raise fakedrive._http_error(429)
+
+    policy.call(call, limiter)
+    assert limiter.rate < 10
+
+
+def test_failing_requests_are_retried_through_the_session(drive):
+    drive.fail_next(503, 2)
+    assert gdrive.save_file('a.txt', 'Notes', data=b'data') is not None
+    assert drive.content(drive.find('a.txt')[0]['id']) == b'data'
+
+
+def test_save_with_stale_cached_id_creates_the_file_again(drive):
+    gdrive.save_file('a.txt', 'Notes', data=b'one')
+    drive._delete(drive.find('a.txt')[0]['id'])     # Deleted from another device, the id is still cached
+    file = gdrive.save_file('a.txt', 'Notes', data=b'two')
+    assert file is not None
+    assert [f['id'] for f in drive.find('a.txt')] == [file['id']]
+    assert drive.content(file['id']) == b'two'
+    assert gdrive.save_file('a.txt', 'Notes', data=b'three')['id'] == file['id']
+
+
+def test_save_with_stale_cached_id_updates_the_replacing_file(drive):
+    gdrive.save_file('a.txt', 'Notes', data=b'one')
+    drive._delete(drive.find('a.txt')[0]['id'])
+    new_id = drive.add_file('a.txt', b'from another device', drive.notes_id)
+    file = gdrive.save_file('a.txt', 'Notes', data=b'two')
+    assert file['id'] == new_id
+    assert drive.content(new_id) == b'two'
+
+
+def test_failed_update_of_current_id_is_not_duplicated(drive):
+    gdrive.save_file('a.txt', 'Notes', data=b'one')
+    drive.fail_next(400)
+    assert gdrive.save_file('a.txt', 'Notes', data=b'two') is None
+    assert len(drive.find('a.txt')) == 1
+
+
+def test_download_with_stale_cached_id_looks_the_file_up_again(drive):
+    gdrive.save_file('a.txt', 'Notes', data=b'one')
+    drive._delete(drive.find('a.txt')[0]['id'])     # Replaced from another device, the old id is still cached
+    drive.add_file('a.txt', b'from another device', drive.notes_id)
+    gdrive.download_file('a.txt', 'Notes', 'Storage')
+    with open('Storage/a.txt', 'rb') as f:
+        assert f.read() == b'from another device'
+
+    drive._delete(drive.find('a.txt')[0]['id'])
+    with pytest.raises(FileNotFoundError):
+        gdrive.download_file('a.txt', 'Notes', 'Storage')
+
+
+def test_download_stream_in_chunks_retries_and_resumes(drive):
+    data = bytes(range(256)) * 100
+    file_id = drive.add_file('a.txt', data, drive.notes_id)
+    sink = io.BytesIO()
+    requests = drive.request_count
+    assert gdrive.download_stream(file_id, sink, chunk_size=1000) == len(data)
+    assert sink.getvalue() == data
+    assert drive.request_count - requests == 26
+
+    sink = io.BytesIO(data[:12345])
+    sink.seek(0, io.SEEK_END)
+    drive.fail_next(503)
+    assert gdrive.download_stream(file_id, sink, chunk_size=4096, offset=12345) == len(data)
+    assert sink.getvalue() == data
+    assert gdrive.download_stream(file_id, io.BytesIO(), offset=len(data)) == len(data)
+
+
+def test_batch_runs_calls_in_chunks_and_reports_errors_per_call(drive, monkeypatch):
+    ids = [drive.add_file('{}.txt'.format(i), b'', drive.notes_id) for i in range(7)]
+    batch = gdrive.Batch(batch_size=3)
+    for file_id in ids[:3]:
+        batch.get(file_id)
+    batch.get('missing')
+    batch.update(ids[3], {'name': 'renamed.txt'})
+    for file_id in ids[4:]:
+        batch.delete(file_id)
+    chunks = []
+    execute = fakedrive._FakeBatch.execute
+    monkeypatch.setattr(fakedrive._FakeBatch, 'execute', lambda self: chunks.append(len(self._requests)) or
+                        execute(self))
+    results = batch.execute()
+
+    assert chunks == [3, 3, 2]
+    assert [response['name'] for response, error in results[:3]] == ['0.txt', '1.txt', '2.txt']
+    assert results[3][0] is None and results[3][1].resp.status == 404
+    assert results[4][0]['name'] == 'renamed.txt' and results[4][1] is None
+    assert all(error is None for _, error in results[5:])
+    assert [file['name'] for file in drive.find('renamed.txt')] == ['renamed.txt']
+    assert drive.find('4.txt') == drive.find('6.txt') == []
+
+
+def test_batch_retries_a_failed_batch_request(drive):
+    file_id = drive.add_file('a.txt', b'', drive.notes_id)
+    batch = gdrive.Batch()
+    batch.get(file_id)
+    drive.fail_next(503, 2)
+    assert batch.execute()[0][0]['name'] == 'a.txt'
+
+
+def test_batch_is_rate_limited_per_request(drive):
+    session = drive.session(rate_limiter=retry.TokenBucket(rate=10, capacity=1))
+    ids = [drive.add_file('{}.txt'.format(i), b'', drive.notes_id) for i in range(100)]
+    batch = gdrive.Batch(session)
+    for file_id in ids:
+        batch.get(file_id)
+    start = time.monotonic()
+    assert all(error is None for _, error in batch.execute())
+    assert time.monotonic() - start < 1
+
+
+def test_download_of_empty_file(drive):
+    file_id = drive.add_file('a.txt', b'', drive.notes_id)
+    assert gdrive.download_stream(file_id, io.BytesIO()) == 0
+    gdrive.download_file('a.txt', 'Notes', 'Storage')
+    assert os.path.getsize('Storage/a.txt') == 0
+
+
+def test_download_of_missing_file_fails(drive):
+    with pytest.raises(Exception) as info:
+        gdrive.download_stream('missing', io.BytesIO())
+    assert info.value.resp.status == 404
+
+
+def test_listing_asks_for_full_pages(drive):
+    for i in range(250):
+        drive.add_file('{}.txt'.format(i), b'', drive.notes_id)
+    gdrive.ensure_folder('Notes')
+    requests = drive.request_count
+    assert len(gdrive.list_files('Notes')) == 250
+    assert drive.request_count - requests == 1
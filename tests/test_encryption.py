@@ -0,0 +1,200 @@
+import io
+import os.path
+import subprocess
+import sys
+
+import googleapiclient.errors
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+
+import encryption
+import gdrive
+import page
+import rotation
+
+PLAIN = b''.join(b'Note number %d\n' % i for i in range(200))
+LARGE = b''.join(b'Line %d of a page in the stream format\n' % i for i in range(20000))
+
+
+def _legacy_header(codec, level, version=encryption.PAYLOAD_VERSION, cipher=None):
+    """Payload header without key id, as written before key ids were added: version 1 or 2"""
+    return bytes([{encryption.PAYLOAD_VERSION: 1, encryption.STREAM_VERSION: 2}[version],
+                  encryption.CODECS[codec][0], level])
+
+
+def test_legacy_fernet_token_decrypts():
+    token = encryption._fernet().encrypt(PLAIN)
+    assert encryption.decrypt(token) == PLAIN
+
+
+@pytest.mark.parametrize('data, cipher, version', [
+    (PLAIN, 'fernet', 1),
+    (LARGE, None, 2),
+], ids=['fernet', 'stream'])
+def test_versions_without_key_id_decrypt(monkeypatch, data, cipher, version):
+    with monkeypatch.context() as patch:
+        patch.setattr(encryption, '_header', _legacy_header)
+        payload = encryption.encrypt(data, cipher=cipher)
+    assert payload[len(encryption.PAYLOAD_MAGIC)] == version
+    assert encryption.payload_key_id(payload) is None
+    assert encryption.decrypt(payload) == data
+
+
+@pytest.mark.parametrize('data, cipher, version', [
+    (PLAIN, 'fernet', encryption.PAYLOAD_VERSION),
+    (LARGE, None, encryption.STREAM_VERSION),
+    (PLAIN, 'aes-gcm', encryption.AEAD_VERSION),
+    (PLAIN, 'chacha20-poly1305', encryption.AEAD_VERSION),
+], ids=['fernet', 'stream', 'aes-gcm', 'chacha20-poly1305'])
+def test_current_versions_round_trip(data, cipher, version):
+    payload = encryption.encrypt(data, cipher=cipher)
+    assert payload[len(encryption.PAYLOAD_MAGIC)] == version
+    assert encryption.payload_key_id(payload) == encryption.key_id(encryption._current_key())
+    assert encryption.decrypt(payload) == data
+
+
+@pytest.mark.parametrize('codec', list(encryption.CODECS))
+def test_codecs_round_trip(codec):
+    assert encryption.decrypt(encryption.encrypt(PLAIN, codec=codec)) == PLAIN
+
+
+def test_empty_data_stays_empty():
+    assert encryption.encrypt(b'') == b''
+    assert encryption.decrypt(b'') == b''
+
+
+@pytest.mark.parametrize('cipher', ['fernet', 'aes-gcm'])
+def test_tampered_header_does_not_verify(cipher):
+    payload = bytearray(encryption.encrypt(PLAIN, cipher=cipher))
+    payload[len(encryption.PAYLOAD_MAGIC) + 2] ^= 1     # Compression level
+    with pytest.raises((InvalidToken, ValueError)):
+        encryption.decrypt(bytes(payload))
+
+
+def test_aead_payload_with_fernet_cipher_byte_is_rejected():
+    payload = bytearray(encryption.encrypt(PLAIN, cipher='aes-gcm'))
+    payload[len(encryption.PAYLOAD_MAGIC) + 3] = encryption.CIPHERS['fernet'][0]
+    with pytest.raises(ValueError):
+        encryption.decrypt(bytes(payload))
+
+
+def test_truncated_stream_does_not_verify():
+    payload = encryption.encrypt(LARGE)
+    with pytest.raises(InvalidToken):
+        encryption.decrypt(payload[:-100])
+
+
+def test_stream_reader_reads_single_lines():
+    reader = encryption.StreamReader(io.BytesIO(encryption.encrypt(LARGE)))
+    lines = LARGE.splitlines(keepends=True)
+    assert reader.line_count == len(lines)
+    assert reader.lines(12345, 12348) == lines[12345:12348]
+
+
+def test_stream_lines_only_end_at_newlines():
+    data = LARGE + b''.join(b'Note %d with a \r, a \x0c and a \xe2\x80\xa8 inside\n' % i for i in range(20000))
+    reader = encryption.StreamReader(io.BytesIO(encryption.encrypt(data)))
+    assert reader.line_count == 40000
+    assert reader.lines(39999, 40000) == [b'Note 19999 with a \r, a \x0c and a \xe2\x80\xa8 inside\n']
+
+
+def test_lines_survive_line_framing():
+    for data in (PLAIN, b'\n\n\r\n', os.urandom(1000)):
+        line = encryption.encrypt_line(data)
+        assert b'\n' not in line
+        assert encryption.decrypt_line(line + b'\n') == data
+
+
+def test_unknown_key_id_is_rejected():
+    payload = encryption.encrypt(PLAIN)
+    encryption.use_keys(Fernet.generate_key(), [])
+    with pytest.raises(InvalidToken):
+        encryption.decrypt(payload)
+
+
+def _write_page(name: str, data: bytes, **kwargs):
+    with open(os.path.join('Storage', name), 'wb') as f:
+        f.write(encryption.encrypt(data, **kwargs))
+
+
+def _read_page(name: str) -> bytes:
+    with open(os.path.join('Storage', name), 'rb') as f:
+        return f.read()
+
+
+def test_rotation_reencrypts_pages_and_keeps_old_key(drive):
+    _write_page('small.txt', PLAIN, cipher='fernet')
+    _write_page('large.txt', LARGE)
+    _write_page('password.txt', b'page.txt\thash\n')
+    old_key = encryption._current_key()
+    old_payload = encryption.encrypt(PLAIN)
+
+    assert rotation.Rotation('Storage').run(workers=1)
+
+    with open('key.key', 'rb') as f:
+        new_key = f.read().strip()
+    assert new_key != old_key
+    with open(encryption.OLD_KEYS_FILE, 'rb') as f:
+        assert old_key in f.read().split()
+    assert not os.path.exists(encryption.NEXT_KEY_FILE)
+    assert not os.path.exists(os.path.join('Storage', rotation.CHECKPOINT))
+
+    encryption.convert.key = None
+    assert encryption._current_key() == new_key
+    for name, data in (('small.txt', PLAIN), ('large.txt', LARGE)):
+        assert encryption.payload_key_id(_read_page(name)) == encryption.key_id(new_key)
+        assert encryption.decrypt(_read_page(name)) == data
+        assert drive.content(drive.find(name)[0]['id']) == _read_page(name)
+    assert encryption.decrypt(old_payload) == PLAIN     # Through key.old
+    assert drive.find('password.txt')[0]['parents'] == [drive.password_id]
+
+
+def test_rotation_keeps_edits_that_are_not_compacted(drive):
+    _write_page('a.txt', PLAIN)
+    session = page.PageSession('a.txt')
+    session.add('edited before the rotation')
+    session.save()
+    new = page.PageSession('b.txt')     # No page file yet
+    new.add('new page')
+    new.save()
+
+    assert rotation.Rotation('Storage').run(workers=1)
+    encryption.convert.key = None
+    assert page.logged_pages() == set()
+    assert encryption.decrypt(_read_page('a.txt')) == PLAIN + b'edited before the rotation\n'
+    assert page.PageSession('b.txt').notes == ['new page\n']
+    assert drive.content(drive.find('b.txt')[0]['id']) == _read_page('b.txt')
+
+
+def test_interrupted_rotation_continues(drive, monkeypatch):
+    _write_page('a.txt', PLAIN)
+    _write_page('b.txt', PLAIN)
+    interrupted = rotation.Rotation('Storage')
+    monkeypatch.setattr(interrupted, 'files', lambda: ['a.txt'])
+    assert interrupted.convert(workers=1) == {}
+    assert not interrupted.state['switched']
+
+    resumed = rotation.Rotation('Storage')
+    assert resumed.state['converted'] == ['a.txt']
+    assert resumed.run(workers=1)
+    encryption.convert.key = None
+    for name in ('a.txt', 'b.txt'):
+        assert encryption.payload_key_id(_read_page(name)) == encryption.key_id(encryption._current_key())
+        assert encryption.decrypt(_read_page(name)) == PLAIN
+
+
+def test_legacy_token_of_old_key_decrypts_after_rotation(drive):
+    token = encryption._fernet().encrypt(PLAIN)
+    _write_page('a.txt', PLAIN)
+    assert rotation.Rotation('Storage').run(workers=1)
+    encryption.convert.key = None
+    assert encryption.decrypt(token) == PLAIN
+
+
+def test_importing_the_app_does_not_import_cryptography_or_the_drive_client():
+    code = ('import sys, note\n'
+            'print(sorted({m.split(".")[0] for m in sys.modules} & {"cryptography", "googleapiclient"}))')
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]'
+    assert gdrive.HttpError is googleapiclient.errors.HttpError
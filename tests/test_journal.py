@@ -0,0 +1,143 @@
+import base64
+import json
+import os.path
+
+import encryption
+import fakedrive
+import functions
+import gdrive
+import journal
+import passwords
+import sync
+import upload_queue
+
+
+def _journal() -> journal.Journal:
+    return journal.Journal(os.path.join('Storage', '.journal'))
+
+
+def test_entries_keep_content_in_side_files():
+    log = _journal()
+    entry = log.append('add', 'Notes', 'a.txt', b'encrypted page')
+    assert os.listdir(log.data_path) == [str(entry['seq'])]
+    with open(log.path, 'rb') as f:
+        assert b'encrypted page' not in encryption.decrypt_line(f.readline())
+    assert log.data(entry) == b'encrypted page'
+    assert log.data(log.append(journal.DELETE_PAGE, 'Notes', 'b.txt')) is None
+
+
+def test_acknowledgements_are_appended_and_survive_reloads():
+    log = _journal()
+    first = log.append('add', 'Notes', 'a.txt', b'1')
+    second = log.append('add', 'Notes', 'a.txt', b'2')
+    other = log.append('add', 'Notes', 'b.txt', b'3')
+    size = os.path.getsize(log.path)
+    log.acknowledge(first)
+    assert os.path.getsize(log.path) > size     # Appended, not rewritten
+    assert [e['seq'] for e in log.pending()] == [second['seq'], other['seq']]
+
+    reloaded = _journal()
+    assert [e['seq'] for e in reloaded.pending()] == [second['seq'], other['seq']]
+    assert reloaded.data(reloaded.pending()[0]) == b'2'
+    assert sorted(os.listdir(log.data_path)) == sorted([str(second['seq']), str(other['seq'])])
+
+    newer = reloaded.append('add', 'Notes', 'a.txt', b'4')
+    assert newer['seq'] > other['seq']
+    reloaded.acknowledge(newer)     # Drops the older entry of a.txt too
+    assert [e['name'] for e in reloaded.pending()] == ['b.txt']
+    reloaded.acknowledge(other)
+    assert os.path.getsize(log.path) == 0
+    assert os.listdir(log.data_path) == []
+    assert len(_journal()) == 0
+
+
+def test_sequence_numbers_stay_unique_after_acknowledged_entries():
+    log = _journal()
+    pending = log.append('add', 'Notes', 'a.txt', b'a')
+    acknowledged = log.append('add', 'Notes', 'b.txt', b'b')
+    log.acknowledge(acknowledged)
+
+    reloaded = _journal()
+    entry = reloaded.append('add', 'Notes', 'b.txt', b'new b')
+    assert entry['seq'] > acknowledged['seq']
+    assert [e['seq'] for e in _journal().pending()] == [pending['seq'], entry['seq']]
+    assert _journal().data(entry) == b'new b'
+
+
+def test_orphaned_side_files_are_removed():
+    log = _journal()
+    log.append('add', 'Notes', 'a.txt', b'a')
+    with open(os.path.join(log.data_path, '99'), 'wb') as f:
+        f.write(b'crashed before its entry was written')
+    assert os.listdir(_journal().data_path) == ['1']
+
+
+def test_journals_with_inline_content_are_still_read():
+    entry = {'seq': 1, 'op': 'add', 'folder': 'Notes', 'name': 'a.txt', 'time': 0,
+             'data': base64.b64encode(b'old format').decode()}
+    with open(os.path.join('Storage', '.journal'), 'wb') as f:
+        f.write(encryption.encrypt_line(json.dumps(entry).encode()) + b'\n')
+    log = _journal()
+    assert log.data(log.pending()[0]) == b'old format'
+
+
+def test_offline_changes_are_replayed(drive):
+    manifest = sync.Manifest('Storage/.manifest.json')
+    drive.fail_next(400, 2)     # Offline: each upload fails at its first request
+    journal.record('add', 'Notes', 'a.txt', 'Storage', b'version 1', manifest)
+    journal.record('add', 'Notes', 'a.txt', 'Storage', b'version 2', manifest)
+    upload_queue.get_queue().flush()
+    assert len(journal.get_journal()) == 2
+
+    assert journal.replay('Storage', manifest) == 1
+    upload_queue.get_queue().flush()
+    assert len(journal.get_journal()) == 0
+    assert [drive.content(file['id']) for file in drive.find('a.txt')] == [b'version 2']
+    assert manifest.is_current(drive.find('a.txt')[0])
+
+
+def test_password_preload_survives_drive_errors(drive):
+    with open(os.path.join('Storage', 'password.txt'), 'wb') as f:
+        f.write(encryption.encrypt(b'a.txt\thash\n'))
+    drive.fail_next(400)
+    functions._preload_password_file()
+    with open(os.path.join('Storage', 'password.txt'), 'rb') as f:
+        assert encryption.decrypt(f.read()) == b'a.txt\thash\n'
+
+
+def test_failed_password_download_keeps_the_local_passwords(drive, monkeypatch):
+    with open(os.path.join('Storage', 'password.txt'), 'wb') as f:
+        f.write(encryption.encrypt(b'a.txt\thash\n'))
+    drive.add_file('password.txt', encryption.encrypt(b'b.txt\thash\n'), drive.password_id)
+
+    def interrupted(file_id, sink, *args, **kwargs):
+        sink.write(b'partial')
+        raise fakedrive._http_error(503)
+
+    monkeypatch.setattr(gdrive, 'download_stream', interrupted)
+    functions._preload_password_file()
+    with open(os.path.join('Storage', 'password.txt'), 'rb') as f:
+        assert encryption.decrypt(f.read()) == b'a.txt\thash\n'
+    assert not os.path.exists(os.path.join('Storage', 'password.txt.tmp'))
+    assert passwords.get_store().is_protected('a.txt')
+
+
+def test_entries_whose_payload_holds_line_ends_are_read_back(monkeypatch):
+    encrypt = encryption.encrypt
+
+    def encrypt_with_line_end(data, *args, **kwargs):
+        for _ in range(10000):     # Random nonces, so some payload holds a newline byte
+            payload = encrypt(data, *args, **kwargs)
+            if b'\n' in payload:
+                return payload
+        raise AssertionError('No payload with a line end')
+
+    monkeypatch.setattr(encryption, 'encrypt', encrypt_with_line_end)
+    log = _journal()
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        log.append('add', 'Notes', name, b'content of ' + name.encode())
+    log.acknowledge(log.pending()[0])
+
+    reloaded = _journal()
+    assert [entry['name'] for entry in reloaded.pending()] == ['b.txt', 'c.txt']
+    assert reloaded.data(reloaded.pending()[0]) == b'content of b.txt'
@@ -0,0 +1,122 @@
+import os
+import os.path
+
+import pytest
+
+import encryption
+import gdrive
+import note
+import page
+import sync
+import upload_queue
+
+
+def _write_page(data: bytes, name: str = 'a.txt'):
+    with open(os.path.join('Storage', name), 'wb') as f:
+        f.write(encryption.encrypt(data))
+
+
+def _read_page(name: str = 'a.txt') -> bytes:
+    with open(os.path.join('Storage', name), 'rb') as f:
+        return f.read()
+
+
+def test_saved_edits_are_replayed_from_the_log():
+    _write_page(b'one\ntwo\nthree\n')
+    session = page.PageSession('a.txt')
+    session.add('four')
+    session.delete(0)
+    assert session.save() is None
+    session.change(0, 'TWO')
+    session.insert(0, 'zero')
+    assert session.save() is None
+    session.add('not saved')
+
+    reopened = page.PageSession('a.txt')
+    assert reopened.notes == ['zero\n', 'TWO\n', 'three\n', 'four\n']
+    assert page.logged_pages() == {'a.txt'}
+    assert reopened.compact() is not None
+    assert page.logged_pages() == set()
+    assert page.PageSession('a.txt').notes == ['zero\n', 'TWO\n', 'three\n', 'four\n']
+
+
+def test_pages_are_compacted_every_compact_edits_saves(monkeypatch):
+    monkeypatch.setattr(page, 'COMPACT_EDITS', 3)
+    session = page.PageSession('a.txt')
+    for i in range(2):
+        session.add(str(i))
+        assert session.save() is None
+    session.add('2')
+    data = session.save()
+    assert encryption.decrypt(data) == b'0\n1\n2\n'
+    assert page.logged_pages() == set()
+
+
+def test_log_of_another_page_version_is_kept_aside():
+    _write_page(b'one\n')
+    session = page.PageSession('a.txt')
+    session.add('edit of the old version')
+    session.save()
+    _write_page(b'new version from drive\n')
+
+    reopened = page.PageSession('a.txt')
+    assert reopened.notes == ['new version from drive\n']
+    assert page.logged_pages() == set()
+    rejected = [name for name in os.listdir('Storage') if name.endswith('.rejected')]
+    assert len(rejected) == 1
+    with open(os.path.join('Storage', rejected[0]), 'rb') as f:
+        assert b'edit of the old version' in encryption.decrypt_line(f.readline())
+
+
+def test_idle_pages_are_uploaded(drive):
+    manifest = sync.Manifest('Storage/.manifest.json')
+    session = page.PageSession('a.txt')
+    session.add('first')
+    assert session.save() is None
+    idle_upload = note._IdleUpload(manifest, delay=0.01)
+    idle_upload.edited(session)
+    idle_upload._timer.join()
+    upload_queue.get_queue().flush()
+
+    assert not session.dirty
+    assert page.logged_pages() == set()
+    assert [encryption.decrypt(drive.content(file['id'])) for file in drive.find('a.txt')] == [b'first\n']
+
+
+def test_notes_only_end_at_newlines():
+    notes = ['carriage\rreturn\n', 'form\x0cfeed\n', 'line\u2028separator\n', 'last\n']
+    _write_page(''.join(notes).encode())
+    session = page.PageSession('a.txt')
+    assert session.notes == notes
+    session.add('group\x1dseparator\x85')
+    session.compact()
+    assert page.PageSession('a.txt').notes == notes + ['group\x1dseparator\x85\n']
+
+
+def test_deleting_the_open_page_from_the_page_menu_keeps_it_deleted(drive, monkeypatch):
+    manifest = sync.Manifest('Storage/.manifest.json')
+    _write_page(b'one\n')
+    gdrive.save_file('a.txt', 'Notes', data=_read_page())
+    answers = iter(['a', 'edited', 'n', 'd', '0', 'q'])    # Edit the page, then delete it from the page menu
+    monkeypatch.setattr('builtins.input', lambda prompt='': next(answers))
+    monkeypatch.setattr(os, 'system', lambda command: 0)
+    with pytest.raises(SystemExit):
+        note.list_notes('a.txt', 'Storage', ['a.txt'], manifest)
+
+    assert not os.path.exists(os.path.join('Storage', 'a.txt'))
+    assert page.logged_pages() == set()
+    assert drive.find('a.txt') == []
+
+
+def test_idle_timer_leaves_a_closed_page_alone(drive):
+    manifest = sync.Manifest('Storage/.manifest.json')
+    session = page.PageSession('a.txt')
+    session.add('first')
+    session.save()
+    idle_upload = note._IdleUpload(manifest, delay=60)
+    idle_upload.edited(session)
+    idle_upload.close(session)
+    os.remove(os.path.join('Storage', 'a.txt'))     # Deleted from the page menu
+    session.dirty = True    # Edits a late timer would otherwise write back
+    idle_upload._close(session)
+    assert not os.path.exists(os.path.join('Storage', 'a.txt'))
@@ -0,0 +1,36 @@
+import passwords
+import upload_queue
+
+
+def test_pages_stay_unlocked_until_the_timeout(drive, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(passwords.time, 'monotonic', lambda: now[0])
+    store = passwords.PasswordStore(unlock_timeout=60)
+    assert store.is_unlocked('open.txt')
+    store.set_password('secret.txt', 'right')
+    assert store.is_protected('secret.txt')
+    assert store.is_unlocked('secret.txt')     # Just set
+
+    store.lock_all()
+    assert not store.is_unlocked('secret.txt')
+    assert not store.verify('secret.txt', 'wrong')
+    assert not store.is_unlocked('secret.txt')
+    assert store.verify('secret.txt', 'right')
+    now[0] += 59
+    assert store.is_unlocked('secret.txt')
+    now[0] += 2
+    assert not store.is_unlocked('secret.txt')
+
+
+def test_passwords_are_read_back_from_the_password_file(drive):
+    store = passwords.PasswordStore()
+    store.set_password('a.txt', 'first')
+    store.set_password('b.txt', 'second')
+    store.remove('a.txt')
+
+    reloaded = passwords.PasswordStore()
+    assert not reloaded.is_protected('a.txt')
+    assert not reloaded.is_unlocked('b.txt')    # Unlocking is not stored
+    assert reloaded.verify('b.txt', 'second')
+    upload_queue.get_queue().flush()
+    assert drive.find('password.txt')[0]['parents'] == [drive.password_id]
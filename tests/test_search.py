@@ -0,0 +1,127 @@
+import os.path
+
+import encryption
+import page
+import search
+
+
+def _write_page(name: str, data: bytes):
+    with open(os.path.join('Storage', name), 'wb') as f:
+        f.write(encryption.encrypt(data))
+
+
+def test_saved_edits_are_searchable_and_pruned():
+    _write_page('a.txt', b'')
+    index = search.get_index()
+    index.refresh('Storage', ['a.txt'])
+    session = page.PageSession('a.txt')
+    session.add('buy milk')
+    session.add('call bob')
+    session.save()
+    assert index.search('MILK') == [('a.txt', 0)]
+
+    session.delete(0)
+    session.save()
+    assert index.search('milk') == []
+    assert 'milk' not in index._postings
+    session.compact()
+    assert index.search('bob') == [('a.txt', 0)]
+
+    index.remove('a.txt')
+    assert index._postings == {}
+
+
+def test_refresh_only_reads_changed_pages(monkeypatch):
+    _write_page('a.txt', b'apple\n')
+    _write_page('b.txt', b'banana\n')
+    index = search.get_index()
+    assert index.refresh('Storage', ['a.txt', 'b.txt']) == 2
+
+    fingerprinted = []
+    fingerprint = page.fingerprint
+    monkeypatch.setattr(page, 'fingerprint', lambda name, file_path: fingerprinted.append(name) or
+                        fingerprint(name, file_path))
+    assert index.refresh('Storage', ['a.txt', 'b.txt']) == 0
+    assert fingerprinted == []
+
+    _write_page('b.txt', b'cherry\n')    # E.g. downloaded
+    assert index.refresh('Storage', ['a.txt', 'b.txt']) == 1
+    assert fingerprinted == ['b.txt']
+    assert index.search('banana') == []
+    assert index.search('cherry') == [('b.txt', 0)]
+
+    assert index.refresh('Storage', ['a.txt']) == 0
+    assert index.search('cherry') == []
+    assert set(index._postings) == {'apple'}
+
+
+def test_refresh_trusts_edits_indexed_by_saves(monkeypatch):
+    index = search.get_index()
+    session = page.PageSession('a.txt')
+    session.add('apple')
+    session.compact()
+    assert index.refresh('Storage', ['a.txt']) == 0     # Indexed by compact, so only fingerprinted once
+    session.add('banana')
+    session.save()
+    assert index.refresh('Storage', ['a.txt']) == 0
+    index.save()
+
+    reloaded = search.SearchIndex(index.path)
+    assert reloaded.search('banana') == [('a.txt', 1)]
+    monkeypatch.setattr(page, 'fingerprint', None)    # Unchanged pages are not read at all
+    assert reloaded.refresh('Storage', ['a.txt']) == 0
+
+
+def test_notes_are_found_by_number_after_edits():
+    index = search.get_index()
+    session = page.PageSession('a.txt')
+    for note in ('buy milk', 'call bob', 'buy bread', 'milk the cow'):
+        session.add(note)
+    session.compact()
+    assert index.search('buy milk') == [('a.txt', 0)]    # Both words in the same note
+    session.insert(0, 'new first note about milk')
+    session.delete(2)
+    session.save()
+    assert session.notes == ['new first note about milk\n', 'buy milk\n', 'buy bread\n', 'milk the cow\n']
+    assert index.search('milk') == [('a.txt', 0), ('a.txt', 1), ('a.txt', 3)]
+    assert index.search('bob') == []
+    assert index.search('buy') == [('a.txt', 1), ('a.txt', 2)]
+
+
+def test_saves_are_logged_without_loading_the_index(monkeypatch):
+    session = page.PageSession('a.txt')
+    session.add('apple')
+    session.compact()
+    search.get_index().save()
+    search.get_index().compact()
+
+    index = search.SearchIndex(search.get_index().path)
+    monkeypatch.setattr(search, '_default_index', index)
+    session.add('banana')
+    session.save()
+    index.save()
+    assert index._pages is None     # Not decrypted to save an edit
+    assert os.path.exists(index.log_path)
+
+    reloaded = search.SearchIndex(index.path)
+    assert reloaded.search('banana') == [('a.txt', 1)]
+    assert reloaded.refresh('Storage', ['a.txt']) == 0
+
+
+def test_log_is_compacted_once_larger_than_the_index(monkeypatch):
+    monkeypatch.setattr(search, 'COMPACT_LOG_SIZE', 0)
+    index = search.get_index()
+    session = page.PageSession('a.txt')
+    for number in range(100):
+        session.add('note {}'.format(number))
+    session.compact()
+    logged = 0
+    for number in range(100, 150):
+        session.add('note {}'.format(number))
+        session.save()
+        index.save()
+        if os.path.exists(index.log_path):
+            logged += 1
+            assert os.path.getsize(index.log_path) <= os.path.getsize(index.path)
+    assert logged
+    assert search.SearchIndex(index.path).search('note 149') == [('a.txt', 149)]
@@ -0,0 +1,100 @@
+import os
+import os.path
+
+import pytest
+
+import encryption
+import fakedrive
+import gdrive
+import segments
+import sync
+
+PAGE = b''.join(b'note %d\n' % i for i in range(200))
+
+
+def _read(name: str) -> bytes:
+    with open(os.path.join('Storage', name), 'rb') as f:
+        return f.read()
+
+
+def _upload_segmented(data: bytes) -> bytes:
+    """Save data as the segmented page a.txt on drive. :return: its index"""
+    index = segments.SegmentStore(cache_path='uploader-cache').save_page(data)
+    gdrive.save_file('a.txt', 'Notes', data=index)
+    return index
+
+
+def test_pages_are_split_and_joined_again(drive):
+    assert b''.join(segments.split(PAGE)) == PAGE
+    index = segments.SegmentStore(cache_path='uploader-cache').save_page(PAGE)
+    assert segments.is_index(index)
+    assert segments.SegmentStore().load_page(index) == PAGE
+
+
+def test_downloaded_index_is_expanded(drive):
+    _upload_segmented(PAGE)
+    manifest = sync.Manifest('Storage/.manifest.json')
+    assert sync.sync_file('a.txt', 'Notes', 'Storage', manifest, on_download=segments.get_store().expand)
+    assert encryption.decrypt(_read('a.txt')) == PAGE
+
+
+def test_failed_expansion_keeps_the_local_page(drive):
+    with open(os.path.join('Storage', 'a.txt'), 'wb') as f:
+        f.write(encryption.encrypt(b'local page\n'))
+    _upload_segmented(PAGE)
+    first_segment = encryption.content_id(segments.split(PAGE)[0])
+    drive._delete(drive.find(first_segment)[0]['id'])     # Not downloadable, and not in the local cache
+    manifest = sync.Manifest('Storage/.manifest.json')
+
+    assert not sync.sync_file('a.txt', 'Notes', 'Storage', manifest, on_download=segments.get_store().expand)
+    assert encryption.decrypt(_read('a.txt')) == b'local page\n'
+    assert not [name for name in os.listdir('Storage') if name.endswith('.tmp')]
+
+    folder_sync = sync.FolderSync('Notes', 'Storage', manifest, on_download=segments.get_store().expand).start()
+    folder_sync.join()
+    assert 'a.txt' in folder_sync.failures
+    assert encryption.decrypt(_read('a.txt')) == b'local page\n'
+    assert not [name for name in os.listdir('Storage') if name.endswith('.tmp')]
+
+
+def test_repeated_segments_are_kept(drive):
+    data = b'x10\nother line\nx10\nx10\n' + b'\n' * 200
+    parts = segments.split(data)
+    assert len(set(parts)) < len(parts)
+    index = segments.SegmentStore(cache_path='uploader-cache').save_page(data)
+    assert segments.SegmentStore().load_page(index) == data
+    assert len(drive.find(encryption.content_id(parts[-1]))) == 1
+
+
+def test_broken_cached_segments_are_downloaded_again(drive, monkeypatch):
+    index = _upload_segmented(PAGE)
+    first, second = [encryption.content_id(segment) for segment in segments.split(PAGE)[:2]]
+    first_id = drive.find(first)[0]['id']
+    download_stream = gdrive.download_stream
+
+    def fail_first(file_id, sink, *args, **kwargs):
+        if file_id == first_id:
+            sink.write(b'partial')
+            raise fakedrive._http_error(503)
+        return download_stream(file_id, sink, *args, **kwargs)
+
+    store = segments.SegmentStore()
+    with monkeypatch.context() as patch:
+        patch.setattr(gdrive, 'download_stream', fail_first)
+        with pytest.raises(ConnectionError):
+            store.load_page(index)
+    assert not os.path.exists(os.path.join(segments.CACHE_PATH, first))
+    with open(os.path.join(segments.CACHE_PATH, second), 'wb'):
+        pass    # Left empty by a failed download of an older version
+    assert store.load_page(index) == PAGE
+
+
+def test_saving_an_edit_does_not_list_all_segments(drive):
+    _upload_segmented(PAGE)
+    folder_id = drive.find(segments.SEGMENT_FOLDER)[0]['id']
+    for i in range(500):    # Segments of other pages
+        drive.add_file('{:064x}'.format(i), b'', folder_id)
+    store = segments.SegmentStore()     # As in a new process
+    requests = drive.request_count
+    store.save_page(PAGE + b'one more note\n')
+    assert drive.request_count - requests == 2     # Looking up the segment names, and uploading the changed one
@@ -0,0 +1,114 @@
+import os.path
+import threading
+
+import encryption
+import gdrive
+import sync
+
+
+def _read(name: str) -> bytes:
+    with open(os.path.join('Storage', name), 'rb') as f:
+        return f.read()
+
+
+def _failing_download(file_id, sink, **kwargs):
+    sink.write(b'partial')
+    raise ConnectionError('Connection dropped')
+
+
+def test_failed_download_keeps_the_local_copy(drive, monkeypatch):
+    file_id = drive.add_file('a.txt', b'version 1', drive.notes_id)
+    manifest = sync.Manifest('Storage/.manifest.json')
+    sync.sync_folder('Notes', 'Storage', manifest)
+    gdrive.save_file('a.txt', 'Notes', data=b'version 2')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(gdrive, 'download_stream', _failing_download)
+        folder_sync = sync.FolderSync('Notes', 'Storage', manifest).start()
+        assert not folder_sync.wait_for('a.txt')
+        folder_sync.join()
+    assert _read('a.txt') == b'version 1'
+    assert not os.path.exists('Storage/a.txt.tmp')
+    assert not manifest.is_current(drive.find('a.txt')[0])     # Downloaded again by the next sync
+
+    sync.sync_folder('Notes', 'Storage', manifest)
+    assert _read('a.txt') == drive.content(file_id) == b'version 2'
+
+
+def test_failed_on_download_keeps_the_local_copy(drive):
+    drive.add_file('a.txt', b'version 1', drive.notes_id)
+    manifest = sync.Manifest('Storage/.manifest.json')
+    sync.sync_folder('Notes', 'Storage', manifest)
+    gdrive.save_file('a.txt', 'Notes', data=b'version 2')
+
+    def fail(location):
+        raise ConnectionError('Could not expand')
+
+    folder_sync = sync.FolderSync('Notes', 'Storage', manifest, on_download=fail).start()
+    folder_sync.join()
+    assert 'a.txt' in folder_sync.failures
+    assert _read('a.txt') == b'version 1'
+    assert not os.path.exists('Storage/a.txt.tmp')
+
+
+def test_undecodable_single_file_keeps_the_local_copy(drive):
+    drive.add_file('a.txt', b'version 1', drive.notes_id)
+    manifest = sync.Manifest('Storage/.manifest.json')
+    assert sync.sync_file('a.txt', 'Notes', 'Storage', manifest)
+    gdrive.save_file('a.txt', 'Notes', data=b'version 2')
+
+    for error in (ValueError('Not a segment index'), encryption.InvalidToken()):
+        def fail(location):
+            raise error
+
+        assert not sync.sync_file('a.txt', 'Notes', 'Storage', manifest, on_download=fail)
+        assert _read('a.txt') == b'version 1'
+        assert not os.path.exists('Storage/a.txt.tmp')
+
+
+def _downloaded_names(names: list):
+    """on_download that appends the names of the downloaded files to names"""
+    return lambda location: names.append(os.path.basename(location)[:-len('.tmp')])
+
+
+def test_files_are_downloaded_in_priority_order(drive):
+    for name in ('a.txt', 'b.txt', 'c.txt', 'kept.txt'):
+        drive.add_file(name, name.encode(), drive.notes_id)
+    downloaded = []
+    folder_sync = sync.FolderSync('Notes', 'Storage', sync.Manifest('Storage/.manifest.json'),
+                                  priority=lambda names: sorted(names, reverse=True), max_workers=1,
+                                  keep_local={'kept.txt'}, on_download=_downloaded_names(downloaded)).start()
+    assert [file['name'] for file in folder_sync.join()] == ['a.txt', 'b.txt', 'c.txt', 'kept.txt']
+    assert downloaded == ['c.txt', 'b.txt', 'a.txt']
+    assert not os.path.exists('Storage/kept.txt')
+
+
+def test_waited_for_file_is_downloaded_next(drive):
+    for name in ('a.txt', 'b.txt', 'c.txt', 'd.txt'):
+        drive.add_file(name, name.encode(), drive.notes_id)
+    downloaded = []
+    started, release = threading.Event(), threading.Event()
+    record = _downloaded_names(downloaded)
+
+    def slow_first_download(location):
+        record(location)
+        if len(downloaded) == 1:
+            started.set()
+            release.wait(5)
+
+    folder_sync = sync.FolderSync('Notes', 'Storage', sync.Manifest('Storage/.manifest.json'), priority=sorted,
+                                  max_workers=1, on_download=slow_first_download).start()
+    assert started.wait(5)
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(folder_sync.wait_for('d.txt', timeout=5)))
+    waiter.start()
+    while folder_sync._queue[0]['name'] != 'd.txt':
+        waiter.join(0.01)
+        assert waiter.is_alive()
+    release.set()
+    waiter.join()
+    folder_sync.join()
+    assert waited == [True]
+    assert downloaded == ['a.txt', 'd.txt', 'b.txt', 'c.txt']
+    assert _read('d.txt') == b'd.txt'
+    assert folder_sync.wait_for('a.txt', timeout=5)     # Already downloaded
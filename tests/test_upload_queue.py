@@ -0,0 +1,44 @@
+import threading
+import time
+
+import upload_queue
+
+
+def test_jobs_with_the_same_key_coalesce():
+    queue = upload_queue.UploadQueue(debounce=60)
+    runs = []
+    queue.submit(('Notes', 'a.txt'), runs.append, 'a version 1')
+    queue.submit(('Notes', 'b.txt'), runs.append, 'b')
+    queue.submit(('Notes', 'a.txt'), runs.append, 'a version 2')
+    assert queue.pending_count == 2
+    assert queue.flush(timeout=5)
+    assert runs == ['b', 'a version 2']     # Replacing a job also restarts its debounce
+    assert queue.pending_count == 0 and queue.in_flight_count == 0
+
+
+def test_jobs_wait_for_the_debounce():
+    queue = upload_queue.UploadQueue(debounce=0.2)
+    done = threading.Event()
+    submitted = time.monotonic()
+    queue.submit('key', done.set)
+    assert not done.wait(0.05)
+    assert done.wait(5)
+    assert time.monotonic() - submitted >= 0.2
+
+
+def test_flush_times_out_on_a_running_job():
+    queue = upload_queue.UploadQueue(debounce=0)
+    release = threading.Event()
+    queue.submit('slow', release.wait, 5)
+    assert not queue.flush(timeout=0.05)
+    release.set()
+    assert queue.flush(timeout=5)
+
+
+def test_failed_jobs_do_not_stop_the_worker():
+    queue = upload_queue.UploadQueue(debounce=0)
+    runs = []
+    queue.submit('broken', lambda: 1 / 0)
+    queue.submit('fine', runs.append, 'ran')
+    assert queue.flush(timeout=5)
+    assert runs == ['ran']
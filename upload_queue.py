@@ -0,0 +1,113 @@
+"""Write-behind queue that runs google drive uploads and deletes on one background worker thread"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+DEBOUNCE = 2.0  # Seconds a job waits for newer jobs with the same key before it is run
+
+
+class UploadQueue:
+    """Keyed queue of jobs run by a single background worker.
+
+    Submitting a job with the key of a job that has not started yet replaces that job, so repeated saves of the same
+    page coalesce into one upload of the latest content. A job only runs once no newer job with its key has been
+    submitted for debounce seconds, or as soon as the queue is flushed."""
+
+    def __init__(self, debounce: float = DEBOUNCE):
+        """
+        :param debounce: seconds a job waits for newer jobs with the same key before it is run"""
+        self.debounce = debounce
+        self._pending = OrderedDict()   # key -> (due time, function, args, kwargs)
+        self._in_flight = 0
+        self._flushing = 0
+        self._condition = threading.Condition()
+        self._worker = None
+
+    @property
+    def pending_count(self) -> int:
+        """Number of jobs waiting to be run"""
+        with self._condition:
+            return len(self._pending)
+
+    @property
+    def in_flight_count(self) -> int:
+        """Number of jobs currently running"""
+        with self._condition:
+            return self._in_flight
+
+    def submit(self, key, function, *args, **kwargs):
+        """Queue function(*args, **kwargs) to run in the background, replacing any pending job with the same key
+
+        :param key: hashable key identifying what the job writes, e.g. (folder name, file name)
+        :param function: function to run"""
+        with self._condition:
+            self._pending.pop(key, None)
+            self._pending[key] = (time.monotonic() + self.debounce, function, args, kwargs)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='upload-queue', daemon=True)
+                self._worker.start()
+            self._condition.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Run all pending jobs right away and wait until they are done
+
+        :param timeout: maximum number of seconds to wait. Waits until done if None
+        :return: True if all jobs are done, False if the timeout ran out first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                while self._pending or self._in_flight:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def _next_job(self):
+        """Wait for the next due job and take it out of the queue. Must be called with the condition held"""
+        while True:
+            if self._pending:
+                key, (due, function, args, kwargs) = min(self._pending.items(), key=lambda item: item[1][0])
+                wait = due - time.monotonic()
+                if self._flushing or wait <= 0:
+                    del self._pending[key]
+                    return key, function, args, kwargs
+                self._condition.wait(wait)
+            else:
+                self._condition.wait()
+
+    def _run(self):
+        """Worker loop that runs jobs one at a time"""
+        while True:
+            with self._condition:
+                key, function, args, kwargs = self._next_job()
+                self._in_flight += 1
+            try:
+                function(*args, **kwargs)
+            except Exception as err:    # A failed upload must not kill the worker
+                logging.error('Background job {} failed: {}'.format(key, err))
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+
+_default_queue = None
+_default_queue_lock = threading.Lock()
+
+
+def get_queue() -> UploadQueue:
+    """Return the process wide upload queue, creating it on first use. It is flushed when the interpreter exits"""
+    global _default_queue
+    with _default_queue_lock:
+        if _default_queue is None:
+            _default_queue = UploadQueue()
+            atexit.register(_default_queue.flush)
+        return _default_queue
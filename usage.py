@@ -0,0 +1,60 @@
+"""Local usage statistics of note pages, used to load the pages that are opened most first"""
+
+import json
+import logging
+import os.path
+import threading
+import time
+
+
+class UsageStats:
+    """How often and how recently every page was opened. Thread safe, and written to disk on every change."""
+
+    def __init__(self, path: str):
+        """
+        :param path: json file the statistics are stored in"""
+        self.path = path
+        self._lock = threading.Lock()
+        self._pages = {}    # page name -> {'count': times opened, 'last': time last opened}
+        try:
+            with open(path, 'r') as f:
+                self._pages = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as err:
+            logging.warning('Ignoring unreadable usage statistics {}: {}'.format(path, err))
+
+    def record(self, page: str):
+        """Record that page was opened"""
+        with self._lock:
+            stats = self._pages.setdefault(page, {'count': 0, 'last': 0})
+            stats['count'] += 1
+            stats['last'] = time.time()
+            self._save()
+
+    def ranked(self, pages: list) -> list:
+        """Sort pages by how often they were opened, then by how recently. Pages never opened keep their order
+
+        :return: new list of the page names, most used first"""
+        with self._lock:
+            def key(page):
+                stats = self._pages.get(page, {})
+                return -stats.get('count', 0), -stats.get('last', 0)
+            return sorted(pages, key=key)
+
+    def most_used(self):
+        """:return: name of the most used page, None if no page was opened yet"""
+        with self._lock:
+            if not self._pages:
+                return None
+            return max(self._pages, key=lambda page: (self._pages[page]['count'], self._pages[page]['last']))
+
+    def _save(self):
+        """Atomically write the statistics to disk. Must be called with the lock held"""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._pages, f)
+        os.replace(temp_path, self.path)